@@ -6,6 +6,41 @@ import torch.optim as optim
 from torch.autograd import Variable
 import numpy as np
 import pdb
+import itertools
+from math import comb
+
+# below that many relations a scale samples with randperm, above it distinct
+# ranks are drawn with randint (randperm would allocate all the ranks)
+RANDPERM_MAX_RELATIONS = 2 ** 16
+
+
+def unrank_relation(num_frames, scale, rank):
+    """The relation (frame indices) at rank in itertools.combinations(range(num_frames), scale)"""
+    relation = []
+    first = 0
+    for remaining in range(scale, 0, -1):
+        # comb(num_frames - first - 1, remaining - 1) relations start with frame first
+        count = comb(num_frames - first - 1, remaining - 1)
+        while rank >= count:
+            rank -= count
+            first += 1
+            count = comb(num_frames - first - 1, remaining - 1)
+        relation.append(first)
+        first += 1
+    return tuple(relation)
+
+
+def sample_relation_ranks(num_relations, k):
+    """k distinct ranks out of num_relations, with the torch RNG"""
+    if num_relations <= RANDPERM_MAX_RELATIONS:
+        return torch.randperm(num_relations)[:k]
+    ranks = []
+    while len(ranks) < k:
+        rank = int(torch.randint(num_relations, (1,)))
+        if rank not in ranks:
+            ranks.append(rank)
+    return torch.LongTensor(ranks)
+
 
 class RelationModule(torch.nn.Module):
     # this is the naive implementation of the n-frame relation module, as num_frames == num_frames_relation
@@ -39,12 +74,14 @@ class RelationModuleMultiScale(torch.nn.Module):
         self.img_feature_dim = img_feature_dim
         self.scales = [i for i in range(num_frames, 1, -1)] # generate the multiple frame relations
 
-        self.relations_scales = []
+        # the relations of a scale are not listed, they are decoded from their
+        # rank in itertools.combinations order when sampled
+        self.num_relations_scales = []
         self.subsample_scales = []
         for scale in self.scales:
-            relations_scale = self.return_relationset(num_frames, scale)
-            self.relations_scales.append(relations_scale)
-            self.subsample_scales.append(min(self.subsample_num, len(relations_scale))) # how many samples of relation to select in each forward pass
+            num_relations = comb(num_frames, scale)
+            self.num_relations_scales.append(num_relations)
+            self.subsample_scales.append(min(self.subsample_num, num_relations)) # how many samples of relation to select in each forward pass
 
         self.num_class = num_class
         self.num_frames = num_frames
@@ -61,28 +98,120 @@ class RelationModuleMultiScale(torch.nn.Module):
 
             self.fc_fusion_scales += [fc_fusion]
 
+        # eval mode over all the relations, see set_all_relations()
+        self.all_relations = False
+        self.max_relations = None
+        self.relation_chunk = 64
+        self._eval_relations = {}
+
         print('Multi-Scale Temporal Relation Network Module in use', ['%d-frame relation' % i for i in self.scales])
 
-    def forward(self, input):
-        # the first one is the largest scale
-        act_all = input[:, self.relations_scales[0][0] , :]
-        act_all = act_all.view(act_all.size(0), self.scales[0] * self.img_feature_dim)
-        act_all = self.fc_fusion_scales[0](act_all)
+    def set_all_relations(self, enabled=True, max_relations=256, chunk_size=64):
+        """In eval mode, score every relation of each scale instead of a random sample.
 
-        for scaleID in range(1, len(self.scales)):
-            # iterate over the scales
-            idx_relations_randomsample = np.random.choice(len(self.relations_scales[scaleID]), self.subsample_scales[scaleID], replace=False)
-            for idx in idx_relations_randomsample:
-                act_relation = input[:, self.relations_scales[scaleID][idx], :]
+        A scale adds subsample_scales times the mean of fc_fusion over its
+        relations, the expectation of the sampled sum, so the scores stay on
+        the scale the module was trained with. A scale with more than
+        max_relations relations (None or 0: no cap) uses max_relations of them
+        evenly spaced in rank order; the default keeps every relation up to
+        10 frames. chunk_size relations are fused at once.
+        """
+        if max_relations is not None and max_relations < 0:
+            raise ValueError('max_relations must be positive, 0 or None, got %d' % max_relations)
+        self.all_relations = enabled
+        self.max_relations = max_relations or None
+        self.relation_chunk = chunk_size
+        self._eval_relations = {}
+
+    def sample_relations(self):
+        """Indices of the relations summed up in each scale, drawn with the torch RNG.
+
+        The largest scale has a single relation, the others subsample_num of theirs.
+        """
+        return [sample_relation_ranks(self.num_relations_scales[scaleID], self.subsample_scales[scaleID])
+                for scaleID in range(len(self.scales))]
+
+    def return_relations(self, scaleID, ranks):
+        """(len(ranks), scale) LongTensor of the relations at ranks"""
+        return torch.LongTensor([unrank_relation(self.num_frames, self.scales[scaleID], rank)
+                                 for rank in ranks.tolist()])
+
+    def forward(self, input, samples=None):
+        if samples is None and self.all_relations and not self.training:
+            return self.forward_all(input)
+        # all the sampled relations of a scale go through its MLP as one batch
+        if samples is None:
+            samples = self.sample_relations()
+        act_all = None
+        for scaleID in range(len(self.scales)):
+            relations = self.return_relations(scaleID, samples[scaleID]).to(input.device)
+            act_relation = self.fuse_relations(input, scaleID, relations)
+            act_all = act_relation if act_all is None else act_all + act_relation
+        return act_all
+
+    def fuse_relations(self, input, scaleID, relations):
+        """Sum over the relations (k, scale) of the fc_fusion outputs of scaleID"""
+        batch_size = input.size(0)
+        num_relations, scale = relations.size()
+        act_relation = input[:, relations.view(-1), :]
+        act_relation = act_relation.view(batch_size * num_relations, scale * self.img_feature_dim)
+        act_relation = self.fc_fusion_scales[scaleID](act_relation)
+        return act_relation.view(batch_size, num_relations, -1).sum(1)
+
+    def eval_relations(self, scaleID, device):
+        """(m, scale) LongTensor of the relations scored by forward_all"""
+        key = (scaleID, str(device))
+        if key not in self._eval_relations:
+            num_relations, scale = self.num_relations_scales[scaleID], self.scales[scaleID]
+            if self.max_relations is None or num_relations <= self.max_relations:
+                relations = list(itertools.combinations(range(self.num_frames), scale))
+            else:
+                relations = [unrank_relation(self.num_frames, scale, i * num_relations // self.max_relations)
+                             for i in range(self.max_relations)]
+            self._eval_relations[key] = torch.LongTensor(relations).to(device)
+        return self._eval_relations[key]
+
+    def forward_all(self, input):
+        # the first Linear of fc_fusion applied to a relation (t_0, ..., t_s-1)
+        # is bias + sum_j W_j relu(x[t_j]), W_j the block of position j: the
+        # projections of the frames that can be at each position are computed
+        # once, and a relation is a sum of s of them. The last Linear is linear,
+        # it is applied once to the mean over the relations.
+        input = F.relu(input)
+        batch_size = input.size(0)
+        act_all = None
+        for scaleID, scale in enumerate(self.scales):
+            fc_hidden, fc_out = self.fc_fusion_scales[scaleID][1], self.fc_fusion_scales[scaleID][3]
+            weight = fc_hidden.weight.view(fc_hidden.out_features, scale, self.img_feature_dim)
+            # position j holds one of the frames j, ..., num_frames - scale + j
+            window = self.num_frames - scale + 1
+            # (window, batch, hidden): a relation gathers contiguous rows
+            proj = [torch.matmul(input[:, j:j + window], weight[:, j].t()).transpose(0, 1).contiguous()
+                    for j in range(scale)]
+            relations = self.eval_relations(scaleID, input.device)
+            # frame t_j is row t_j - j of the projections of position j
+            offsets = relations - torch.arange(scale, device=relations.device)
+            hidden_sum = 0
+            for chunk in offsets.split(self.relation_chunk):
+                hidden = proj[0].index_select(0, chunk[:, 0]) + fc_hidden.bias
+                for j in range(1, scale):
+                    hidden.add_(proj[j].index_select(0, chunk[:, j]))
+                hidden_sum = hidden_sum + F.relu_(hidden).sum(0)
+            act_relation = fc_out(hidden_sum / len(relations)) * self.subsample_scales[scaleID]
+            act_all = act_relation if act_all is None else act_all + act_relation
+        return act_all
+
+    def forward_reference(self, input, samples):
+        # one relation at a time, what forward computes in a batch
+        act_all = None
+        for scaleID in range(len(self.scales)):
+            for rank in samples[scaleID].tolist():
+                act_relation = input[:, unrank_relation(self.num_frames, self.scales[scaleID], rank), :]
                 act_relation = act_relation.view(act_relation.size(0), self.scales[scaleID] * self.img_feature_dim)
                 act_relation = self.fc_fusion_scales[scaleID](act_relation)
-                act_all += act_relation
+                act_all = act_relation if act_all is None else act_all + act_relation
         return act_all
 
-    def return_relationset(self, num_frames, num_frames_relation):
-        import itertools
-        return list(itertools.combinations([i for i in range(num_frames)], num_frames_relation))
-
 
 class RelationModuleMultiScaleWithClassifier(torch.nn.Module):
     # relation module in multi-scale with a classifier at the end
@@ -92,15 +221,15 @@ class RelationModuleMultiScaleWithClassifier(torch.nn.Module):
         self.img_feature_dim = img_feature_dim
         self.scales = [i for i in range(num_frames, 1, -1)] #
 
-        self.relations_scales = []
+        self.num_relations_scales = []
         self.subsample_scales = []
         for scale in self.scales:
-            relations_scale = self.return_relationset(num_frames, scale)
-            self.relations_scales.append(relations_scale)
-            self.subsample_scales.append(min(self.subsample_num, len(relations_scale))) # how many samples of relation to select in each forward pass
+            num_relations = comb(num_frames, scale)
+            self.num_relations_scales.append(num_relations)
+            self.subsample_scales.append(min(self.subsample_num, num_relations)) # how many samples of relation to select in each forward pass
 
         self.num_class = num_class
-        self.num_frames = num_frames_total
+        self.num_frames = num_frames
         num_bottleneck = 256
         self.fc_fusion_scales = nn.ModuleList() # high-tech modulelist
         self.classifier_scales = nn.ModuleList()
@@ -125,26 +254,22 @@ class RelationModuleMultiScaleWithClassifier(torch.nn.Module):
 
     def forward(self, input):
         # the first one is the largest scale
-        act_all = input[:, self.relations_scales[0][0] , :]
+        act_all = input[:, unrank_relation(self.num_frames, self.scales[0], 0), :]
         act_all = act_all.view(act_all.size(0), self.scales[0] * self.img_feature_dim)
         act_all = self.fc_fusion_scales[0](act_all)
         act_all = self.classifier_scales[0](act_all)
 
         for scaleID in range(1, len(self.scales)):
             # iterate over the scales
-            idx_relations_randomsample = np.random.choice(len(self.relations_scales[scaleID]), self.subsample_scales[scaleID], replace=False)
-            for idx in idx_relations_randomsample:
-                act_relation = input[:, self.relations_scales[scaleID][idx], :]
+            idx_relations_randomsample = sample_relation_ranks(self.num_relations_scales[scaleID], self.subsample_scales[scaleID])
+            for idx in idx_relations_randomsample.tolist():
+                act_relation = input[:, unrank_relation(self.num_frames, self.scales[scaleID], idx), :]
                 act_relation = act_relation.view(act_relation.size(0), self.scales[scaleID] * self.img_feature_dim)
                 act_relation = self.fc_fusion_scales[scaleID](act_relation)
                 act_relation = self.classifier_scales[scaleID](act_relation)
-                act_all += act_relation
+                act_all = act_all + act_relation
         return act_all
 
-    def return_relationset(self, num_frames, num_frames_relation):
-        import itertools
-        return list(itertools.combinations([i for i in range(num_frames)], num_frames_relation))
-
 def return_TRN(relation_type, img_feature_dim, num_frames, num_class):
     if relation_type == 'TRN':
         TRNmodel = RelationModule(img_feature_dim, num_frames, num_class)
@@ -0,0 +1,311 @@
+# data loading benchmarks on a list file
+#
+#   python benchmark.py decode video_datasets/something/val_videofolder.txt \
+#       /path/to/20bn-something-something-v1 --image_tmpl {:05d}.jpg --modality RGB
+#
+# and of the TRN consensus on random features (python benchmark.py relation)
+import time
+import argparse
+import numpy as np
+import torch
+import torchvision
+
+from dataset import TSNDataSet
+from transforms import *
+from frame_cache import SharedFrameCache
+from frame_storage import FolderFrameStore
+from video_storage import VideoFileStore
+from TRNmodule import RelationModuleMultiScale
+from models import input_normalization
+
+
+def add_dataset_args(parser):
+    parser.add_argument('list_file', type=str)
+    parser.add_argument('root_path', type=str)
+    parser.add_argument('--image_tmpl', type=str, default='img_{:05d}.jpg')
+    parser.add_argument('--modality', type=str, default='RGB', choices=['RGB', 'Flow', 'RGBDiff'])
+    parser.add_argument('--num_segments', type=int, default=8)
+    parser.add_argument('--input_size', type=int, default=224)
+    parser.add_argument('--phase', type=str, default='train', choices=['train', 'val'])
+    parser.add_argument('--num_videos', type=int, default=200)
+    parser.add_argument('--decoder', type=str, default='pil', choices=['pil', 'cv2', 'turbojpeg', 'auto'])
+
+
+def return_geometry(args):
+    # the geometric part of the main.py pipelines (see TSN.get_augmentation)
+    if args.phase == 'train':
+        scales = [1, .875, .75, .66] if args.modality == 'RGB' else [1, .875, .75]
+        return torchvision.transforms.Compose([
+            GroupMultiScaleCrop(args.input_size, scales),
+            GroupRandomHorizontalFlip(is_flow=args.modality == 'Flow')])
+    return torchvision.transforms.Compose([
+        GroupScale(args.input_size * 256 // 224),
+        GroupCenterCrop(args.input_size)])
+
+
+def make_dataset(args, transform, **kwargs):
+    return TSNDataSet(args.root_path, args.list_file, num_segments=args.num_segments,
+                      new_length=1 if args.modality == 'RGB' else 5,
+                      modality=args.modality, image_tmpl=args.image_tmpl,
+                      random_shift=args.phase == 'train',
+                      temp_transform=IdentityTransform(),
+                      transform=transform, decoder=args.decoder, **kwargs)
+
+
+def bench_decode(args):
+    transform = return_geometry(args)
+    print('modality %s, %s transform' % (args.modality, args.phase))
+    results = {}
+    for draft in (False, True):
+        dataset = make_dataset(args, transform, draft_decode=draft)
+        dataset.plan_epoch(np.random.RandomState(0))
+        num_videos = min(args.num_videos, len(dataset))
+        num_frames = 0
+        decode_time = 0.
+        total_time = 0.
+        for i in range(num_videos):
+            record = dataset._get_record(i)
+            idx_list = dataset._get_frame_indices(i, record)
+            start = time.time()
+            decoded = dataset._decode_frames(record, idx_list)
+            decode_time += time.time() - start
+            images = [img for p in idx_list for img in decoded[p]]
+            transform(images)
+            total_time += time.time() - start
+            num_frames += len(decoded)
+        size = images[0].size
+        results[draft] = decode_time
+        print('%-13s decoded size %4dx%-4d  decode %.2f ms/frame  decode+transform %.2f ms/frame' % (
+            'draft decode' if draft else 'full decode', size[0], size[1],
+            1000. * decode_time / num_frames, 1000. * total_time / num_frames))
+    print('decode time saving: %.1f%%' % (100. * (1 - results[True] / results[False])))
+
+
+def bench_loader(args):
+    geometry = return_geometry(args)
+    roll = args.arch in ['BNInception', 'InceptionV3']
+    div = not roll
+    # the normalization of TSN, 128 for BNInception flow
+    _, mean, std = input_normalization(args.arch, args.modality, 1 if args.modality == 'RGB' else 5)
+    pipelines = [
+        ('float32', torchvision.transforms.Compose([
+            geometry, Stack(roll=roll), ToTorchFormatTensor(div=div), GroupNormalize(mean, std)])),
+        ('uint8', torchvision.transforms.Compose([
+            geometry, Stack(roll=roll), ToTorchFormatTensor(div=div, uint8=True)])),
+    ]
+    for name, transform in pipelines:
+        dataset = make_dataset(args, transform)
+        dataset.plan_epoch()
+        loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                             num_workers=args.workers, pin_memory=True)
+        num_samples = 0
+        batch_bytes = 0
+        start = None
+        for i, (input, target) in enumerate(loader):
+            if i == 0:
+                # leave out the worker startup
+                start = time.time()
+                batch_bytes = input.numel() * input.element_size()
+                continue
+            num_samples += input.size(0)
+            if i == args.num_batches:
+                break
+        elapsed = time.time() - start
+        print('%-8s %7.2f MB per batch of %d  %7.1f samples/sec' % (
+            name, batch_bytes / 1024. ** 2, args.batch_size, num_samples / elapsed))
+
+
+def bench_cache(args):
+    transform = torchvision.transforms.Compose([
+        return_geometry(args), Stack(), ToTorchFormatTensor(uint8=True)])
+    for budget in (0, args.cache_mb):
+        frame_cache = SharedFrameCache(budget * 1024 ** 2) if budget > 0 else None
+        dataset = make_dataset(args, transform, frame_cache=frame_cache,
+                               cache_prescale=args.cache_prescale)
+        if frame_cache is not None:
+            frame_cache.size_slots(dataset.frame_bytes())
+        loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                             num_workers=args.workers, pin_memory=True)
+        for epoch in range(args.epochs):
+            dataset.plan_epoch()
+            start = time.time()
+            for input, target in loader:
+                pass
+            elapsed = time.time() - start
+            print('cache %5d MB  epoch %d  %7.1f samples/sec' % (budget, epoch, len(dataset) / elapsed))
+            if frame_cache is not None:
+                print(frame_cache.summary())
+                frame_cache.reset_stats()
+
+
+def bench_video(args):
+    # the same list read from extracted JPEG folders and from the video files
+    stores = [('jpeg', FolderFrameStore(args.root_path, args.image_tmpl)),
+              ('video', VideoFileStore(args.video_root, args.video_ext, args.backend))]
+    for name, storage in stores:
+        dataset = make_dataset(args, IdentityTransform(), storage=storage)
+        dataset.plan_epoch(np.random.RandomState(0))
+        num_videos = min(args.num_videos, len(dataset))
+        num_frames = 0
+        start = time.time()
+        for i in range(num_videos):
+            record = dataset._get_record(i)
+            num_frames += len(dataset._decode_frames(record, dataset._get_frame_indices(i, record)))
+        elapsed = time.time() - start
+        print('%-12s %6d frames  %7.1f frames/sec  %6.1f ms/video' % (
+            name, num_frames, num_frames / elapsed, 1000. * elapsed / num_videos))
+
+
+class _SlowStore(object):
+    """store whose reads take latency seconds more, like network storage"""
+    def __init__(self, store, latency):
+        self.store = store
+        self.latency = latency
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+    def open(self, directory):
+        reader = self.store.open(directory)
+        read = reader.read
+
+        def slow_read(idx):
+            time.sleep(self.latency)
+            return read(idx)
+        reader.read = slow_read
+        return reader
+
+
+def bench_threads(args):
+    transform = torchvision.transforms.Compose([
+        return_geometry(args), Stack(), ToTorchFormatTensor(uint8=True)])
+    storage = FolderFrameStore(args.root_path, args.image_tmpl)
+    if args.latency_ms > 0:
+        storage = _SlowStore(storage, args.latency_ms / 1000.)
+    print('samples/sec, %.1f ms added per frame read' % args.latency_ms)
+    print('workers ' + ''.join('%9s' % ('%d thr' % t) for t in args.threads))
+    for workers in args.workers:
+        line = '%7d ' % workers
+        for threads in args.threads:
+            dataset = make_dataset(args, transform, storage=storage, fetch_threads=threads)
+            dataset.plan_epoch()
+            loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                                 num_workers=workers, pin_memory=True)
+            num_samples = 0
+            start = time.time()
+            for i, (input, target) in enumerate(loader):
+                num_samples += input.size(0)
+                if i + 1 == args.num_batches:
+                    break
+            line += '%9.1f' % (num_samples / (time.time() - start))
+        print(line)
+
+
+def bench_relation(args):
+    torch.set_num_threads(args.num_threads)
+    print('RelationModuleMultiScale on CPU, batch %d, feature dim %d, %d classes, %d threads' % (
+        args.batch_size, args.img_feature_dim, args.num_class, args.num_threads))
+    print('frames  relations  per-relation ms  batched ms  speedup  max diff | '
+          'eval: sampled ms  all relations  all ms  ratio')
+    for num_frames in args.num_frames:
+        module = RelationModuleMultiScale(args.img_feature_dim, num_frames, args.num_class)
+        input = torch.randn(args.batch_size, num_frames, args.img_feature_dim, requires_grad=args.backward)
+        samples = module.sample_relations()
+        results = []
+        for forward in (module.forward_reference, module.forward):
+            best = float('inf')
+            for _ in range(args.repeats):
+                start = time.time()
+                output = forward(input, samples)
+                if args.backward:
+                    output.sum().backward()
+                best = min(best, time.time() - start)
+            results.append((best, output.detach()))
+        (loop_time, expected), (batched_time, output) = results
+        # inference: the sampled pass vs the deterministic one over all the relations
+        module.set_all_relations(max_relations=args.max_relations or None)
+        module.eval()
+        eval_times = []
+        with torch.no_grad():
+            for run in (lambda: module(input, samples), lambda: module(input)):
+                best = float('inf')
+                for _ in range(args.repeats):
+                    start = time.time()
+                    run()
+                    best = min(best, time.time() - start)
+                eval_times.append(best)
+        num_relations = sum(len(module.eval_relations(i, input.device)) for i in range(len(module.scales)))
+        print('%6d  %9d  %15.2f  %10.2f  %6.1fx   %.1e | %16.2f  %13d  %6.2f  %4.1fx' % (
+            num_frames, sum(len(x) for x in samples), 1000 * loop_time, 1000 * batched_time,
+            loop_time / batched_time, (output - expected).abs().max().item(),
+            1000 * eval_times[0], num_relations, 1000 * eval_times[1], eval_times[1] / eval_times[0]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="data loading benchmarks")
+    subparsers = parser.add_subparsers(dest='command')
+
+    decode_parser = subparsers.add_parser('decode', help='full vs reduced-size JPEG decoding')
+    add_dataset_args(decode_parser)
+
+    loader_parser = subparsers.add_parser('loader', help='float32 vs uint8 batches through the DataLoader')
+    add_dataset_args(loader_parser)
+    loader_parser.add_argument('--arch', type=str, default='BNInception')
+    loader_parser.add_argument('-b', '--batch_size', type=int, default=32)
+    loader_parser.add_argument('-j', '--workers', type=int, default=8)
+    loader_parser.add_argument('--num_batches', type=int, default=20)
+
+    cache_parser = subparsers.add_parser('cache', help='epochs with and without the shared frame cache')
+    add_dataset_args(cache_parser)
+    cache_parser.add_argument('--cache_mb', type=int, default=1024)
+    cache_parser.add_argument('--cache_prescale', default=False, action='store_true')
+    cache_parser.add_argument('--epochs', type=int, default=3)
+    cache_parser.add_argument('-b', '--batch_size', type=int, default=32)
+    cache_parser.add_argument('-j', '--workers', type=int, default=8)
+
+    video_parser = subparsers.add_parser('video', help='frames decoded from video files vs JPEG folders')
+    add_dataset_args(video_parser)
+    video_parser.add_argument('video_root', type=str)
+    video_parser.add_argument('--video_ext', type=str, default='.mp4')
+    video_parser.add_argument('--backend', type=str, default='cv2', choices=['av', 'cv2'])
+
+    threads_parser = subparsers.add_parser('threads', help='samples/sec across loader workers x fetch threads')
+    add_dataset_args(threads_parser)
+    threads_parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    threads_parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    threads_parser.add_argument('--latency_ms', type=float, default=0.,
+                                help='added to every frame read, to mimic network storage')
+    threads_parser.add_argument('-b', '--batch_size', type=int, default=8)
+    threads_parser.add_argument('--num_batches', type=int, default=10)
+
+    relation_parser = subparsers.add_parser('relation', help='per-relation vs batched TRNmultiscale forward')
+    relation_parser.add_argument('--num_frames', type=int, nargs='+', default=list(range(3, 17)))
+    relation_parser.add_argument('--img_feature_dim', type=int, default=256)
+    relation_parser.add_argument('--num_class', type=int, default=174)
+    relation_parser.add_argument('-b', '--batch_size', type=int, default=64)
+    relation_parser.add_argument('--num_threads', type=int, default=1)
+    relation_parser.add_argument('--repeats', type=int, default=20)
+    relation_parser.add_argument('--max_relations', type=int, default=256,
+                                 help='cap per scale of the all-relations pass (0: no cap)')
+    relation_parser.add_argument('--backward', default=False, action='store_true',
+                                 help='time forward + backward')
+
+    args = parser.parse_args()
+    if args.command == 'decode':
+        bench_decode(args)
+    elif args.command == 'loader':
+        bench_loader(args)
+    elif args.command == 'cache':
+        bench_cache(args)
+    elif args.command == 'video':
+        bench_video(args)
+    elif args.command == 'threads':
+        bench_threads(args)
+    elif args.command == 'relation':
+        bench_relation(args)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
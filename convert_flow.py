@@ -0,0 +1,116 @@
+# rewrite the flow frames of a list file into the compact 'xy' format read by
+# TSNDataSet(flow_format='xy')
+#
+# The extracted flow frames are RGB JPEGs holding (flow_x, flow_y, blank). The
+# compact frame is a single-channel JPEG with the flow_x plane stacked on top of
+# the flow_y plane, so decoding it produces the two planes the Flow modality
+# uses and nothing else. Each plane is padded (repeating its last row) to a
+# multiple of XY_BLOCK rows, so no JPEG block mixes x with y, also when
+# decoding at 1/8 with draft_decode; the height of the planes is written in a
+# JPEG comment for TSNDataSet to crop the padding off.
+#
+#   python convert_flow.py video_datasets/something/something_flow_train_split_1.txt \
+#       / /path/to/something_flow_xy --image_tmpl {:05d}.jpg \
+#       --out_list video_datasets/something/something_flow_xy_train_split_1.txt
+#
+# The converted videos keep their directory under out_root (a leading '/' is
+# dropped), so out_list can be used with root_path out_root. Frames that are
+# already converted are skipped, an interrupted run can be restarted.
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PIL import Image
+
+from manifest import load_manifest
+
+# 8 rows of a JPEG block times the largest draft reduction
+XY_BLOCK = 64
+XY_COMMENT = 'flow_xy height=%d'
+
+
+def xy_planes(x, y):
+    """uint8 (h, w) planes -> 'L' image of x over y, each padded to a multiple of XY_BLOCK rows"""
+    h = x.shape[0]
+    pad = -h % XY_BLOCK
+    planes = [np.pad(plane, ((0, pad), (0, 0)), mode='edge') for plane in (x, y)]
+    return Image.fromarray(np.concatenate(planes, axis=0))
+
+
+def save_xy(xy, height, path, quality):
+    xy.save(path, 'JPEG', quality=quality, comment=(XY_COMMENT % height).encode('ascii'))
+
+
+def xy_height(comment):
+    """height of the planes of an xy frame from its JPEG comment, None for
+    frames written without padding"""
+    if comment is None or not comment.startswith(b'flow_xy height='):
+        return None
+    return int(comment[len(b'flow_xy height='):])
+
+
+def flow_to_xy(flow):
+    """RGB (flow_x, flow_y, blank) image -> ('L' xy image, height of the planes)"""
+    flow = np.asarray(flow.convert('RGB'))
+    return xy_planes(flow[..., 0], flow[..., 1]), flow.shape[0]
+
+
+def convert_video(root_path, out_root, image_tmpl, directory, num_frames, quality):
+    src_dir = os.path.join(root_path, directory)
+    dst_dir = os.path.join(out_root, directory.lstrip('/'))
+    if not os.path.isdir(dst_dir):
+        try:
+            os.makedirs(dst_dir)
+        except OSError:
+            pass
+    converted = 0
+    # the flow list counts one frame more than there are flow frames
+    for idx in range(1, num_frames + 1):
+        src = os.path.join(src_dir, image_tmpl.format(idx))
+        dst = os.path.join(dst_dir, image_tmpl.format(idx))
+        if os.path.exists(dst) or not os.path.exists(src):
+            continue
+        tmp = dst + '.tmp'
+        xy, height = flow_to_xy(Image.open(src))
+        save_xy(xy, height, tmp, quality)
+        os.rename(tmp, dst)
+        converted += 1
+    return converted
+
+
+def main():
+    parser = argparse.ArgumentParser(description="convert RGB flow frames to the compact xy format")
+    parser.add_argument('list_file', type=str)
+    parser.add_argument('root_path', type=str)
+    parser.add_argument('out_root', type=str)
+    parser.add_argument('--image_tmpl', type=str, default='img_{:05d}.jpg')
+    parser.add_argument('--out_list', type=str, default=None,
+                        help='write the list file of the converted videos, relative to out_root')
+    parser.add_argument('--quality', type=int, default=95)
+    parser.add_argument('-j', '--workers', default=8, type=int)
+    args = parser.parse_args()
+
+    # the rows TSNDataSet reads, csv lists included
+    manifest = load_manifest(args.list_file)
+    rows = [(manifest.path(i), int(manifest.num_frames[i]), int(manifest.labels[i])) for i in range(len(manifest))]
+
+    start = time.time()
+    total = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        jobs = [pool.submit(convert_video, args.root_path, args.out_root, args.image_tmpl,
+                            row[0], row[1], args.quality) for row in rows]
+        for i, job in enumerate(jobs):
+            total += job.result()
+            if i % 1000 == 0:
+                print('%d/%d' % (i, len(rows)))
+    print('converted %d frames of %d videos in %.1f sec' % (total, len(rows), time.time() - start))
+
+    if args.out_list is not None:
+        with open(args.out_list, 'w') as f:
+            for row in rows:
+                f.write('%s %d %d\n' % (row[0].lstrip('/'), row[1], row[2]))
+
+
+if __name__ == '__main__':
+    main()
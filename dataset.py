@@ -4,8 +4,17 @@ import torch
 from PIL import Image
 import os
 import os.path
+import math
 import numpy as np
-from numpy.random import randint
+from concurrent.futures import ThreadPoolExecutor
+
+from frame_storage import FolderFrameStore, ArenaFrameStore
+from manifest import load_manifest
+from preflight import scan_videos
+from frame_planner import FramePlanner
+from transforms import decode_size_hint
+from image_decoders import return_decoder, calibrate_decoder, jpeg_comment
+from convert_flow import XY_BLOCK, xy_height
 
 class VideoRecord(object):
     def __init__(self, row):
@@ -31,7 +40,13 @@ class TSNDataSet(data.Dataset):
                  force_grayscale=False, random_shift=True, test_mode=False, 
                  temp_transform=None, 
                  score_sens_mode=False, 
-                 score_inf_mode=False):
+                 score_inf_mode=False, 
+                 storage=None, 
+                 preflight=False, preflight_workers=16, preflight_verify=False, 
+                 draft_decode=False, flow_format='rgb', 
+                 frame_cache=None, cache_prescale=False, 
+                 preload_mb=0, preload_workers=16, 
+                 fetch_threads=1, decoder='pil'):
 
         self.root_path = root_path
         self.list_file = list_file
@@ -45,26 +60,152 @@ class TSNDataSet(data.Dataset):
         self.test_mode = test_mode
         self.score_sens_mode = score_sens_mode
         self.score_inf_mode = score_inf_mode
+        # where the frames are read from, see frame_storage.py
+        self.storage = storage if storage is not None else \
+                FolderFrameStore(root_path, image_tmpl)
+        # scan the videos once at startup instead of checking them per sample
+        self.preflight = preflight
+        self.preflight_workers = preflight_workers
+        self.preflight_verify = preflight_verify
+        self._bad_frames = {}
+        # frames of a sample read by up to fetch_threads threads of the worker
+        self.fetch_threads = fetch_threads
+        self._pool = None
+        self._pool_pid = None
+        # read the compressed frames of the list into memory at startup
+        self.preload_mb = preload_mb
+        self.preload_workers = preload_workers
+        # decode JPEGs directly near the size the transform scales them to
+        self.decode_size = decode_size_hint(transform) if draft_decode else None
+        # 'rgb': (flow_x, flow_y, blank) JPEGs, 'xy': x over y planes, see convert_flow.py
+        if flow_format not in ('rgb', 'xy'):
+            raise ValueError('Unknown flow format ' + flow_format)
+        self.flow_format = flow_format
+        # decoded frames shared by the workers, see frame_cache.py
+        self.frame_cache = frame_cache
+        # shrink the frames to the size the transform scales them to before caching
+        self.prescale = decode_size_hint(transform) if cache_prescale else None
+
+        if self.modality == 'Flow' and getattr(self.storage, 'rgb_only', False):
+            raise ValueError('%s only holds RGB frames' % self.storage.describe())
 
         if self.modality == 'RGBDiff':
             self.new_length += 1# Diff needs one more image to calculate diff
 
-        self._parse_list()
+        self.planner = FramePlanner(self.num_segments, self.new_length)
+        if self.score_sens_mode or self.score_inf_mode:
+            self.sampling = 'val'
+        elif not self.test_mode:
+            self.sampling = 'train' if self.random_shift else 'val'
+        else:
+            self.sampling = 'test'
 
-    def _load_image(self, directory, idx):
+        self._parse_list()
+        # JPEG decoder backend, 'auto' times them on frames of the list, see image_decoders.py
+        self.decoder = self._return_decoder(decoder)
+        # draft decoding changes the size of the decoded frames
+        self._cache_tag = '%s:%s:%s:%s:%s' % (self.modality, self.flow_format, self.prescale,
+                                              self.decode_size, self.decoder.name)
+        # the val/test indices are fixed, plan them once
+        self._plan = None
+        # training plan in shared memory, see share_plan()
+        self._shared_plan = None
+        if self.sampling != 'train':
+            self._plan = self.planner.plan(self.manifest.num_frames, self.sampling)
+
+    def _decode_mode(self):
+        # (image mode, planes stacked in a frame) of the modality
+        if self.modality == 'Flow' and self.flow_format == 'xy':
+            return 'L', 2
+        return 'RGB', 1
+
+    def _return_decoder(self, name):
+        if name != 'auto':
+            try:
+                return return_decoder(name)
+            except ImportError as e:
+                print('%s, decoding with pil' % e)
+                return return_decoder('pil')
+        samples = self._calibration_frames()
+        if not samples:
+            return return_decoder('pil')
+        mode, planes = self._decode_mode()
+        return calibrate_decoder(samples, mode, self.decode_size, planes)
+
+    def _calibration_frames(self, num_videos=16):
+        # the middle frame of videos spread over the list
+        samples = []
+        rows = np.unique(np.linspace(0, len(self.manifest) - 1, min(num_videos, len(self.manifest))).astype(int))
+        for row in rows:
+            record = self._get_record(row)
+            try:
+                with self.storage.open(record.path) as reader:
+                    if hasattr(reader, 'decode'):
+                        # video files are decoded by their reader
+                        return []
+                    samples.append(reader.read_bytes(max(1, record.num_frames // 2)))
+            except Exception:
+                continue
+        return samples
+
+    def frame_bytes(self, num_videos=16):
+        """Bytes of the largest of the middle frames of videos spread over the
+        list, decoded as the frame cache stores them (see SharedFrameCache.size_slots)"""
+        largest = 0
+        rows = np.unique(np.linspace(0, len(self.manifest) - 1, min(num_videos, len(self.manifest))).astype(int))
+        for row in rows:
+            record = self._get_record(row)
+            try:
+                with self.storage.open(record.path) as reader:
+                    images = self._prescale(self._load_image(record.path, max(1, record.num_frames // 2), reader))
+            except Exception:
+                continue
+            largest = max(largest, sum(np.asarray(img).nbytes for img in images))
+        return largest
+
+    def _open_image(self, reader, idx, planes=1, mode='RGB'):
+        if hasattr(reader, 'decode'):
+            # video files, see video_storage.py
+            return reader.decode(idx).convert(mode)
+        if self.decoder.name == 'pil':
+            return self.decoder.open(reader.read(idx), self.decode_size, planes).convert(mode)
+        return self.decoder.decode(reader.read_bytes(idx), mode, self.decode_size, planes)
+
+    def _open_xy(self, reader, idx):
+        # (image, height of the planes or None), see convert_flow.py
+        data = reader.read_bytes(idx)
+        return self.decoder.decode(data, 'L', self.decode_size, 2), xy_height(jpeg_comment(data))
+
+    def _load_image(self, directory, idx, reader=None):
+        if reader is None:
+            with self.storage.open(directory) as reader:
+                return self._load_image(directory, idx, reader)
         if self.modality == 'RGB' or self.modality == 'RGBDiff':
             try:
-                return [Image.open(os.path.join(self.root_path, directory, self.image_tmpl.format(idx))).convert('RGB')]
+                return [self._open_image(reader, idx)]
             except Exception:
-                print('error loading image:', os.path.join(self.root_path, directory, self.image_tmpl.format(idx)))
-                return [Image.open(os.path.join(self.root_path, directory, self.image_tmpl.format(1))).convert('RGB')]
+                print('error loading image:', reader.name(idx))
+                return [self._open_image(reader, 1)]
+        elif self.modality == 'Flow' and self.flow_format == 'xy':
+            try:
+                flow, height = self._open_xy(reader, idx)
+            except Exception:
+                print('error loading flow file:', reader.name(idx))
+                flow, height = self._open_xy(reader, 1)
+            # single channel image, flow_x on top of flow_y
+            w, h = flow.size
+            if height is None:
+                return [flow.crop((0, 0, w, h // 2)), flow.crop((0, h - h // 2, w, h))]
+            # planes padded to XY_BLOCK rows, h // 2 is exact also under draft decoding
+            rows = int(math.ceil(height * h / (2. * (height + -height % XY_BLOCK))))
+            return [flow.crop((0, 0, w, rows)), flow.crop((0, h // 2, w, h // 2 + rows))]
         elif self.modality == 'Flow':
             try:
                 #idx_skip = 1 + (idx-1)*5
-                flow = Image.open(os.path.join(self.root_path, directory, self.image_tmpl.format(idx))).convert('RGB')
+                flow = self._open_image(reader, idx)
             except Exception:
-                print('error loading flow file:', os.path.join(self.root_path, directory, self.image_tmpl.format(idx)))
-                flow = Image.open(os.path.join(self.root_path, directory, self.image_tmpl.format(1))).convert('RGB')
+                print('error loading flow file:', reader.name(idx))
+                flow = self._open_image(reader, 1)
             # the input flow file is RGB image with (flow_x, flow_y, blank) for each channel
             flow_x, flow_y, _ = flow.split()
             x_img = flow_x.convert('L')
@@ -72,19 +213,108 @@ class TSNDataSet(data.Dataset):
 
             return [x_img, y_img]
 
+    def _decode_frames(self, record, indices):
+        """{frame index: images} for the distinct frames in indices.
+
+        Each frame is decoded once and in ascending order, so the reads are
+        sequential whatever order the temporal transform asks for.
+        """
+        bad = self._bad_frames.get(record.path)
+        decoded = {}
+        frames = sorted(set(indices))
+        if self.frame_cache is not None:
+            for p in frames:
+                images = self.frame_cache.get(record.path, p, self._cache_tag)
+                if images is not None:
+                    decoded[p] = images
+            frames = [p for p in frames if p not in decoded]
+            if not frames:
+                return decoded
+        # one reader per sample: a packed video is opened once for all its frames
+        with self.storage.open(record.path) as reader:
+            # frames quarantined by the preflight scan fall back to the first one
+            sources = dict((p, 1 if bad and p in bad else p) for p in frames)
+            todo = sorted(set(x for x in sources.values() if x not in decoded))
+            load = lambda p: self._prescale(self._load_image(record.path, p, reader))
+            if self.fetch_threads > 1 and len(todo) > 1 and not hasattr(reader, 'decode'):
+                # reads and JPEG decoding release the GIL; map keeps the order
+                # (video readers decode sequentially and stay on this thread)
+                loaded = dict(zip(todo, self._fetch_pool().map(load, todo)))
+            else:
+                loaded = dict((x, load(x)) for x in todo)
+            for p in frames:
+                decoded[p] = loaded[sources[p]] if sources[p] in loaded else decoded[sources[p]]
+                if self.frame_cache is not None:
+                    self.frame_cache.put(record.path, p, decoded[p], self._cache_tag)
+        return decoded
+
+    def _fetch_pool(self):
+        # one pool per worker process, made on first use since threads do
+        # not survive the fork of the DataLoader workers
+        if self._pool is None or self._pool_pid != os.getpid():
+            self._pool = ThreadPoolExecutor(max_workers=self.fetch_threads)
+            self._pool_pid = os.getpid()
+        return self._pool
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pool'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._shared_plan is not None:
+            # a pickled numpy view is a copy, look at the shared plan again
+            self._plan = self._shared_plan.numpy()
+
+    def _prescale(self, images):
+        if not self.prescale:
+            return images
+        # the same output size as GroupScale(prescale)
+        w, h = images[0].size
+        if min(w, h) <= self.prescale:
+            return images
+        if w <= h:
+            size = (self.prescale, int(self.prescale * h / w))
+        else:
+            size = (int(self.prescale * w / h), self.prescale)
+        return [img.resize(size, Image.BILINEAR) for img in images]
+
+    def _load_frames(self, record, indices):
+        decoded = self._decode_frames(record, indices)
+        images = list()
+        for p in indices:
+            images.extend(decoded[p])
+        return images
+
     def _parse_list(self):
         # check the frame number is large >3:
         # usualy it is [video_id, num_frames, class_idx]
-        tmp = [x.strip().split(' ') for x in open(self.list_file)]
-        tmp = [item for item in tmp if int(item[1])>=3]
+        # the rows are kept as numpy columns, see manifest.py
+        manifest = load_manifest(self.list_file)
+        manifest = manifest.select(manifest.num_frames >= 3)
 
         if self.modality == 'Flow':
             # flow model has one frame less
-            for i in range(len(tmp)):
-                tmp[i][1] = str(int(tmp[i][1]) - 1)
+            manifest.num_frames = manifest.num_frames - 1
+
+        if self.preflight:
+            index = scan_videos(self.list_file, manifest, self.storage,
+                                workers=self.preflight_workers, verify=self.preflight_verify)
+            self._bad_frames = index.bad_frames(manifest)
+            manifest = manifest.select(index.valid)
 
-        self.video_list = [VideoRecord(item) for item in tmp]
-        print('video number:%d'%(len(self.video_list)))
+        if self.preload_mb > 0:
+            self.storage = ArenaFrameStore(self.storage, manifest.paths(), manifest.num_frames,
+                                           self.preload_mb * 1024 ** 2, workers=self.preload_workers)
+
+        self.manifest = manifest
+        print('video number:%d'%(len(self.manifest)))
+
+    def _get_record(self, index):
+        manifest = self.manifest
+        return VideoRecord((manifest.path(index), manifest.num_frames[index],
+                            manifest.labels[index]))
 
     def _sample_indices(self, record):
         """
@@ -92,52 +322,52 @@ class TSNDataSet(data.Dataset):
         :param record: VideoRecord
         :return: list
         """
-
-        average_duration = (record.num_frames - self.new_length + 1) // self.num_segments
-        if average_duration > 0:
-            offsets = np.multiply(list(range(self.num_segments)), average_duration) + randint(average_duration, size=self.num_segments)
-        elif record.num_frames > self.num_segments:
-            offsets = np.sort(randint(record.num_frames - self.new_length + 1, size=self.num_segments))
-        else:
-            offsets = np.zeros((self.num_segments,))
-        return offsets + 1
+        return self.planner.train_offsets([record.num_frames])[0]
 
     def _get_val_indices(self, record):
-        if record.num_frames > self.num_segments + self.new_length - 1:
-            tick = (record.num_frames - self.new_length + 1) / float(self.num_segments)
-            offsets = np.array([int(tick / 2.0 + tick * x) for x in range(self.num_segments)])
-        else:
-            offsets = np.zeros((self.num_segments,))
-        return offsets + 1
+        return self.planner.val_offsets([record.num_frames])[0]
 
     def _get_test_indices(self, record):
-
-        tick = (record.num_frames - self.new_length + 1) / float(self.num_segments)
-
-        offsets = np.array([int(tick / 2.0 + tick * x) for x in range(self.num_segments)])
-
-        return offsets + 1
-
-    def _get_normal_plus_shuffle(self, record):
-        segment_indices = self._get_val_indices(record)
-        norm_images = list()
-        abnorm_images = list()
-        idx_list = list()
-        for seg_ind in segment_indices:
-            p = int(seg_ind)
-            for i in range(self.new_length):
-                idx_list.append(p)
-                seg_imgs = self._load_image(record.path, p)
-                norm_images.extend(seg_imgs)
-                if p < record.num_frames:
-                    p += 1
+        return self.planner.test_offsets([record.num_frames])[0]
+
+    def plan_epoch(self, rng=np.random):
+        """Draw the frame indices of every video for the next training epoch.
+        Call it before iterating, the DataLoader workers then read their rows."""
+        if self.sampling == 'train':
+            plan = self.planner.plan(self.manifest.num_frames, 'train', rng)
+            if self._shared_plan is not None:
+                self._shared_plan.copy_(torch.from_numpy(plan))
+            else:
+                self._plan = plan
+
+    def share_plan(self):
+        """Keep the training plan in shared memory.
+
+        Workers that outlive an epoch (persistent_workers) then read the plan
+        of every later plan_epoch() instead of the one they started with.
+        """
+        if self.sampling != 'train' or self._shared_plan is not None:
+            return
+        plan = self.planner.plan(self.manifest.num_frames, 'train')
+        self._shared_plan = torch.from_numpy(plan).share_memory_()
+        self._plan = self._shared_plan.numpy()
+
+    def _get_frame_indices(self, index, record):
+        if self._plan is not None:
+            return self._plan[index].reshape(-1).tolist()
+        # no epoch plan drawn, sample this video alone
+        plan = self.planner.plan([record.num_frames], self.sampling)
+        return plan[0].reshape(-1).tolist()
+
+    def _get_normal_plus_shuffle(self, record, idx_list):
         # print('before:', idx_list)
         ab_idx_list = self.temp_transform(idx_list)
         # print('after: ', ab_idx_list)
         # input('...')
-        for p in ab_idx_list:
-            seg_imgs = self._load_image(record.path, p)
-            abnorm_images.extend(seg_imgs)
+        # both clips index the same decoded frames
+        decoded = self._decode_frames(record, idx_list)
+        norm_images = [img for p in idx_list for img in decoded[p]]
+        abnorm_images = [img for p in ab_idx_list for img in decoded[p]]
 
         trans_norm_images = self.transform(norm_images)
         trans_abnorm_images = self.transform(abnorm_images)
@@ -148,72 +378,45 @@ class TSNDataSet(data.Dataset):
                 record.path], \
                     record.label
 
-    def _get_normal_inf(self, record):
-        images = list()
-        idx_list = list()
-        indices = self._get_val_indices(record)
-        # print(indices)
-        for seg_ind in indices:
-            p = int(seg_ind)
-            for i in range(self.new_length):
-                idx_list.append(p)
-                # seg_imgs = self._load_image(record.path, p)
-                # images.extend(seg_imgs)
-                if p < record.num_frames:
-                    p += 1
-
+    def _get_normal_inf(self, record, idx_list):
         # print('before temp trans: ', idx_list)
         # print(record.path)
         process_idx_list = self.temp_transform(idx_list)
         # print(process_idx_list)
         # input('...')
-        for p in process_idx_list:
-            seg_imgs = self._load_image(record.path, p)
-            images.extend(seg_imgs)
+        images = self._load_frames(record, process_idx_list)
         process_data = self.transform(images)
         return [process_data, record.path], record.label
 
     def __getitem__(self, index):
-        record = self.video_list[index]
-        # check this is a legit video folder
-        while not os.path.exists(os.path.join(self.root_path, record.path, 
-            self.image_tmpl.format(1))):
+        record = self._get_record(index)
+        # check this is a legit video folder, unless the preflight scan did already
+        while not self.preflight and not self.storage.exists(record.path):
             # print(os.path.join(self.root_path, record.path, self.image_tmpl.format(1)))
-            index = np.random.randint(len(self.video_list))
-            record = self.video_list[index]
+            index = np.random.randint(len(self.manifest))
+            record = self._get_record(index)
+
+        idx_list = self._get_frame_indices(index, record)
+        return self._get_sample(record, idx_list)
 
+    def _get_sample(self, record, idx_list):
         if self.score_sens_mode:
-            return self._get_normal_plus_shuffle(record)
+            return self._get_normal_plus_shuffle(record, idx_list)
         elif self.score_inf_mode:
-            return self._get_normal_inf(record)
-        elif not self.test_mode:
-            segment_indices = self._sample_indices(record) if self.random_shift else self._get_val_indices(record)
-        else:
-            segment_indices = self._get_test_indices(record)
+            return self._get_normal_inf(record, idx_list)
 
-        return self.get(record, segment_indices)
+        return self.get(record, idx_list)
     
-    def get(self, record, indices):
-
-        images = list()
-        idx_list = list()
-        # print(indices)
-        for seg_ind in indices:
-            p = int(seg_ind)
-            for i in range(self.new_length):
-                idx_list.append(p)
-                # seg_imgs = self._load_image(record.path, p)
-                # images.extend(seg_imgs)
-                if p < record.num_frames:
-                    p += 1
+    def get(self, record, idx_list):
+        # idx_list holds new_length consecutive frames for every segment
 
         # print('before temp trans: ', idx_list)
+        # the temporal transform only reorders, the frames themselves are
+        # decoded once in file order by _load_frames
         process_idx_list = self.temp_transform(idx_list)
         # print(process_idx_list)
         # input('...')
-        for p in process_idx_list:
-            seg_imgs = self._load_image(record.path, p)
-            images.extend(seg_imgs)
+        images = self._load_frames(record, process_idx_list)
         process_data = self.transform(images)
         return process_data, record.label
 
@@ -232,4 +435,4 @@ class TSNDataSet(data.Dataset):
         # return process_data, record.label
 
     def __len__(self):
-        return len(self.video_list)
+        return len(self.manifest)
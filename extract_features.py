@@ -0,0 +1,127 @@
+# compute the backbone features of the frames of a list into a feature store
+#
+#   python extract_features.py video_datasets/something/train_videofolder.txt \
+#       /path/to/20bn-something-something-v1 /path/to/features/train \
+#       --image_tmpl {:05d}.jpg --arch BNInception --weights model/TRN_something_RGB_best.pth.tar
+#
+# Every stride-th frame of each video goes through TSN.base_model once, with
+# the center crop of the validation transform, and its output (the input of
+# new_fc) is stored as float16, see feature_store.py. --weights takes the
+# backbone of a main.py checkpoint, otherwise the ImageNet weights are used.
+# main.py --train_features/--val_features then trains new_fc and the consensus
+# on the stored features. RGB only.
+import time
+import argparse
+import torch
+import torch.utils.data as data
+import torchvision
+
+from dataset import TSNDataSet
+from models import TSN
+from transforms import *
+from frame_storage import return_storage
+from feature_store import FeatureStoreWriter, stored_frames
+
+
+class _VideoFrames(data.Dataset):
+    """(row, uint8 tensor of the stored frames) of every video of dataset"""
+    def __init__(self, dataset, stride, transform):
+        self.dataset = dataset
+        self.stride = stride
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, row):
+        record = self.dataset._get_record(row)
+        indices = stored_frames(record.num_frames, self.stride)
+        try:
+            decoded = self.dataset._decode_frames(record, indices)
+        except Exception as e:
+            # the video is left out of the store
+            print('could not read %s: %s' % (record.path, e))
+            return row, None
+        return row, self.transform([img for p in indices for img in decoded[p]])
+
+
+def _single(batch):
+    return batch[0]
+
+
+def load_backbone(net, weights):
+    checkpoint = torch.load(weights, map_location='cpu')
+    state_dict = checkpoint.get('state_dict', checkpoint)
+    # main.py saves the DataParallel model, 'module.base_model.*'
+    base_dict = dict((k[len('module.'):] if k.startswith('module.') else k, v) for k, v in state_dict.items())
+    base_dict = dict((k, v) for k, v in base_dict.items()
+                     if k.startswith('base_model.') and k in net.state_dict() and
+                     v.size() == net.state_dict()[k].size())
+    net.load_state_dict(base_dict, strict=False)
+    print('loaded %d backbone tensors from %s' % (len(base_dict), weights))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="store the backbone features of the frames of a list")
+    parser.add_argument('list_file', type=str)
+    parser.add_argument('root_path', type=str)
+    parser.add_argument('out_dir', type=str)
+    parser.add_argument('--image_tmpl', type=str, default='img_{:05d}.jpg')
+    parser.add_argument('--storage', type=str, default='folder', choices=['folder', 'packed', 'video'])
+    parser.add_argument('--pack_root', type=str, default='')
+    parser.add_argument('--video_ext', type=str, default='')
+    parser.add_argument('--arch', type=str, default='BNInception')
+    parser.add_argument('--weights', type=str, default='')
+    parser.add_argument('--stride', type=int, default=1, help='features of every stride-th frame')
+    parser.add_argument('-b', '--batch_size', type=int, default=128, help='frames per forward pass')
+    parser.add_argument('-j', '--workers', type=int, default=8)
+    args = parser.parse_args()
+
+    # new_fc and the consensus are not used, the base model ends with a
+    # Dropout that is the identity in eval mode
+    net = TSN(1, 1, 'RGB', base_model=args.arch, consensus_type='avg', dropout=0.8, print_spec=False)
+    if args.weights:
+        load_backbone(net, args.weights)
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    net = net.to(device)
+    # TSN.train() returns nothing, eval() cannot be chained
+    net.eval()
+
+    transform = torchvision.transforms.Compose([
+        GroupScale(net.scale_size),
+        GroupCenterCrop(net.crop_size),
+        Stack(roll=args.arch in ['BNInception', 'InceptionV3']),
+        ToTorchFormatTensor(uint8=True)])
+    storage = return_storage(args.storage, args.root_path, args.image_tmpl, args.pack_root, args.video_ext)
+    dataset = TSNDataSet(args.root_path, args.list_file, num_segments=1, image_tmpl=args.image_tmpl,
+                         test_mode=True, storage=storage)
+    manifest = dataset.manifest
+    writer = FeatureStoreWriter(args.out_dir, manifest.paths(), manifest.num_frames, args.stride)
+    loader = data.DataLoader(_VideoFrames(dataset, args.stride, transform), batch_size=1,
+                             num_workers=args.workers, collate_fn=_single)
+
+    start = time.time()
+    num_frames = 0
+    with torch.no_grad():
+        for i, (row, clip) in enumerate(loader):
+            if clip is None:
+                continue
+            frames = clip.view((-1, 3) + clip.size()[-2:])
+            features = []
+            for chunk in frames.split(args.batch_size):
+                # uint8 frames, normalized by TSN.features like in TSN.forward
+                features.append(net.features(chunk.to(device)).view(chunk.size(0), -1).cpu())
+            writer.write(row, torch.cat(features).numpy())
+            num_frames += frames.size(0)
+            if i % 100 == 0:
+                elapsed = time.time() - start
+                print('%d/%d videos, %.1f videos/sec, %.1f frames/sec' % (
+                    i, len(dataset), (i + 1) / elapsed, num_frames / elapsed))
+    writer.close(arch=args.arch, weights=args.weights, list_file=args.list_file, root_path=args.root_path,
+                 image_tmpl=args.image_tmpl, modality='RGB')
+    print('stored the features of %d frames of %d videos in %s (%.1f sec)' % (
+        num_frames, int(writer.written.sum()), args.out_dir, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+# compute the optical flow frames of the Flow modality from extracted RGB frames
+#
+#   python extract_flow.py video_datasets/something/train_videofolder.txt \
+#       /path/to/20bn-something-something-v1 /path/to/something_flow \
+#       --image_tmpl {:05d}.jpg --algorithm farneback -j 16
+#
+# Flow i is computed between RGB frames i and i+1 of each video of the list, so a
+# video of n frames gets n - 1 flow frames (the Flow modality reads one frame
+# less than the list says). A missing frame repeats the previous one and
+# missing leading frames the first readable one, their pairs get zero flow.
+# Both components are clipped to [-bound, bound] and mapped to [0, 255], and
+# written as out_root/<folder>/image_tmpl in the format TSNDataSet reads:
+#   rgb:  RGB JPEG of (flow_x, flow_y, blank), the default of _load_image
+#   xy:   single channel JPEG with flow_x over flow_y, each plane padded to
+#         whole JPEG blocks (--flow_format xy, as written by convert_flow.py)
+#
+# Videos run in a process pool, one OpenCV thread each. A video is written to
+# a .tmp folder renamed when complete, the videos whose folder exists are
+# skipped. out_root/flow_timing.txt gets [folder, flow frames, seconds] for
+# every video, and the run ends with an estimate for the whole list.
+import os
+import time
+import shutil
+import argparse
+from multiprocessing import Pool
+import numpy as np
+from PIL import Image
+
+from manifest import load_manifest
+from convert_flow import xy_planes, save_xy
+
+TIMING_FILE = 'flow_timing.txt'
+
+
+def _init_worker():
+    import cv2
+    cv2.setNumThreads(1)
+
+
+def _flow_function(algorithm):
+    import cv2
+    if algorithm == 'farneback':
+        return lambda prev, cur: cv2.calcOpticalFlowFarneback(prev, cur, None, 0.5, 3, 15, 3, 5, 1.2, 0)
+    elif algorithm == 'tvl1':
+        # needs the contrib modules (opencv-contrib-python)
+        if hasattr(cv2, 'optflow'):
+            tvl1 = cv2.optflow.DualTVL1OpticalFlow_create()
+        elif hasattr(cv2, 'DualTVL1OpticalFlow_create'):
+            tvl1 = cv2.DualTVL1OpticalFlow_create()
+        else:
+            raise ImportError('TV-L1 needs opencv-contrib-python')
+        return lambda prev, cur: tvl1.calc(prev, cur, None)
+    elif algorithm == 'dis':
+        dis = cv2.DISOpticalFlow_create(cv2.DISOPTICAL_FLOW_PRESET_MEDIUM)
+        return lambda prev, cur: dis.calc(prev, cur, None)
+    raise ValueError('Unknown flow algorithm ' + algorithm)
+
+
+def _read_gray(path, short_side):
+    import cv2
+    if not os.path.exists(path):
+        return None
+    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return None
+    h, w = img.shape
+    if 0 < short_side < min(w, h):
+        scale = short_side / float(min(w, h))
+        img = cv2.resize(img, (int(round(w * scale)), int(round(h * scale))), interpolation=cv2.INTER_AREA)
+    return img
+
+
+def quantize(flow, bound):
+    return np.round((np.clip(flow, -bound, bound) + bound) * (255. / (2 * bound))).astype(np.uint8)
+
+
+def save_flow(flow, bound, flow_format, path, quality):
+    x, y = quantize(flow[..., 0], bound), quantize(flow[..., 1], bound)
+    if flow_format == 'xy':
+        save_xy(xy_planes(x, y), x.shape[0], path, quality)
+    else:
+        Image.fromarray(np.dstack([x, y, np.zeros_like(x)])).save(path, 'JPEG', quality=quality)
+
+
+def extract_video(job):
+    """Flow frames of one video, (folder, flow frames, seconds, error)"""
+    (folder, num_frames, root_path, out_root, image_tmpl, algorithm, bound,
+     flow_format, short_side, quality) = job
+    out_dir = os.path.join(out_root, folder.lstrip('/'))
+    tmp_dir = out_dir + '.tmp'
+    start = time.time()
+    try:
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        calc = _flow_function(algorithm)
+        prev = None
+        readable = 0
+        for idx in range(1, num_frames + 1):
+            cur = _read_gray(os.path.join(root_path, folder, image_tmpl.format(idx)), short_side)
+            if cur is not None:
+                readable += 1
+            elif prev is not None:
+                # a missing frame repeats the previous one
+                cur = prev
+            else:
+                continue
+            if prev is None:
+                # missing leading frames fall forward to the first readable
+                # one, their pairs get zero flow so that flow i stays (i, i+1)
+                pairs = [(j, np.zeros(cur.shape + (2,), np.float32)) for j in range(1, idx)]
+            elif cur is prev:
+                pairs = [(idx - 1, np.zeros(cur.shape + (2,), np.float32))]
+            else:
+                pairs = [(idx - 1, calc(prev, cur))]
+            for j, flow in pairs:
+                save_flow(flow, bound, flow_format, os.path.join(tmp_dir, image_tmpl.format(j)), quality)
+            prev = cur
+        if readable < 2:
+            raise IOError('no flow computed, fewer than 2 readable frames')
+        count = num_frames - 1
+        os.rename(tmp_dir, out_dir)
+        return folder, count, time.time() - start, None
+    except Exception as e:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return folder, 0, time.time() - start, str(e).replace('\n', ' ')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="compute optical flow frames from RGB frames")
+    parser.add_argument('list_file', type=str)
+    parser.add_argument('root_path', type=str)
+    parser.add_argument('out_root', type=str)
+    parser.add_argument('--image_tmpl', type=str, default='img_{:05d}.jpg')
+    parser.add_argument('--algorithm', type=str, default='farneback', choices=['farneback', 'tvl1', 'dis'])
+    parser.add_argument('--bound', type=float, default=20.,
+                        help='flow values are clipped to [-bound, bound] pixels')
+    parser.add_argument('--flow_format', type=str, default='rgb', choices=['rgb', 'xy'])
+    parser.add_argument('--short_side', type=int, default=0,
+                        help='scale the frames to this short side before computing the flow')
+    parser.add_argument('--quality', type=int, default=95)
+    parser.add_argument('-j', '--workers', default=8, type=int)
+    args = parser.parse_args()
+
+    # the rows TSNDataSet reads, csv lists included
+    manifest = load_manifest(args.list_file)
+    rows = [(manifest.path(i), int(manifest.num_frames[i])) for i in range(len(manifest))]
+    # the algorithm is checked before starting the pool
+    _flow_function(args.algorithm)
+    if not os.path.isdir(args.out_root):
+        os.makedirs(args.out_root)
+    jobs = [(row[0], row[1], args.root_path, args.out_root, args.image_tmpl, args.algorithm,
+             args.bound, args.flow_format, args.short_side, args.quality)
+            for row in rows if not os.path.isdir(os.path.join(args.out_root, row[0].lstrip('/')))]
+    print('%d/%d videos done already, %d to go' % (len(rows) - len(jobs), len(rows), len(jobs)))
+
+    start = time.time()
+    video_time = 0.
+    num_flows = 0
+    failed = 0
+    with open(os.path.join(args.out_root, TIMING_FILE), 'a') as timing:
+        pool = Pool(args.workers, initializer=_init_worker)
+        try:
+            for i, (folder, count, seconds, error) in enumerate(pool.imap_unordered(extract_video, jobs)):
+                if error is not None:
+                    failed += 1
+                    print('failed %s: %s' % (folder, error))
+                    continue
+                timing.write('%s %d %.3f\n' % (folder, count, seconds))
+                timing.flush()
+                video_time += seconds
+                num_flows += count
+                if i % 100 == 0:
+                    print('%d/%d, %.2f sec/video, %.1f flow frames/sec per process' % (
+                        i, len(jobs), video_time / (i + 1 - failed), num_flows / max(video_time, 1e-6)))
+        finally:
+            pool.terminate()
+
+    elapsed = time.time() - start
+    done = len(jobs) - failed
+    print('computed %d flow frames of %d videos in %.1f sec, %d failed' % (num_flows, done, elapsed, failed))
+    if done:
+        # sizing: the measured cost per video over the whole list
+        per_video = video_time / done
+        print('%.2f sec/video, %.1f flow frames/sec per process; the %d videos of the list take ~%.1f h '
+              'with %d processes' % (per_video, num_flows / max(video_time, 1e-6), len(rows),
+                                     per_video * len(rows) / args.workers / 3600., args.workers))
+
+
+if __name__ == '__main__':
+    main()
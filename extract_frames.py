@@ -0,0 +1,162 @@
+# extract the frames of raw videos into the image folders read by TSNDataSet
+#
+#   python extract_frames.py video_list.txt /path/to/videos /path/to/frames \
+#       --image_tmpl {:05d}.jpg --short_side 256 --out_list train_videofolder.txt -j 16
+#
+# video_list.txt has one [video file, class index] row per video, the file
+# relative to video_root. Each video is decoded by a process of the pool and
+# written to out_root/<video file without extension>/image_tmpl, scaled so its
+# short side is --short_side (0 keeps the original size). The frames go to a
+# .tmp folder first that is renamed once the video is complete.
+#
+# Finished videos are appended to out_root/extract_journal.txt, a run that was
+# killed picks up from the journal when started again with the same command.
+# --out_list gets the [folder num_frames class_idx] rows of the videofolder
+# lists for every extracted video.
+import os
+import re
+import time
+import shutil
+import argparse
+import subprocess
+from multiprocessing import Pool
+
+JOURNAL_FILE = 'extract_journal.txt'
+
+
+def _scaled_size(w, h, short_side):
+    if short_side <= 0 or min(w, h) <= short_side:
+        return w, h
+    if w <= h:
+        return short_side, int(round(h * short_side / float(w)))
+    return int(round(w * short_side / float(h))), short_side
+
+
+def _extract_cv2(video_file, out_dir, image_tmpl, short_side, quality):
+    import cv2
+    cap = cv2.VideoCapture(video_file)
+    if not cap.isOpened():
+        raise IOError('could not open %s' % video_file)
+    count = 0
+    try:
+        while True:
+            ok, img = cap.read()
+            if not ok:
+                break
+            h, w = img.shape[:2]
+            size = _scaled_size(w, h, short_side)
+            if size != (w, h):
+                img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+            count += 1
+            cv2.imwrite(os.path.join(out_dir, image_tmpl.format(count)), img,
+                        [cv2.IMWRITE_JPEG_QUALITY, quality])
+    finally:
+        cap.release()
+    return count
+
+
+def _ffmpeg_pattern(image_tmpl):
+    # '{:05d}.jpg' -> '%05d.jpg'
+    pattern = re.sub(r'\{:0?(\d*)d\}', lambda m: '%0' + m.group(1) + 'd' if m.group(1) else '%d',
+                     image_tmpl.replace('%', '%%'))
+    if '{' in pattern:
+        raise ValueError('image_tmpl %s has no ffmpeg equivalent' % image_tmpl)
+    return pattern
+
+
+def _extract_ffmpeg(video_file, out_dir, image_tmpl, short_side, quality):
+    args = ['ffmpeg', '-loglevel', 'error', '-i', video_file]
+    if short_side > 0:
+        args += ['-vf', "scale='if(gt(iw,ih),-2,min(iw,%d))':'if(gt(iw,ih),min(ih,%d),-2)'" % (
+            short_side, short_side)]
+    # ffmpeg's -q:v runs from 2 (best) to 31
+    args += ['-q:v', str(max(2, int(round(31 - quality * 29 / 100.)))), '-start_number', '1',
+             os.path.join(out_dir, _ffmpeg_pattern(image_tmpl))]
+    subprocess.check_call(args)
+    return len(os.listdir(out_dir))
+
+
+def extract_video(job):
+    """Extract one video, (folder, num_frames, label, error)"""
+    video_file, folder, label, out_root, image_tmpl, short_side, quality, backend = job
+    out_dir = os.path.join(out_root, folder)
+    tmp_dir = out_dir + '.tmp'
+    try:
+        if os.path.isdir(out_dir):
+            # renamed, but the run stopped before the journal entry
+            return folder, len(os.listdir(out_dir)), label, None
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        extract = _extract_ffmpeg if backend == 'ffmpeg' else _extract_cv2
+        num_frames = extract(video_file, tmp_dir, image_tmpl, short_side, quality)
+        os.rename(tmp_dir, out_dir)
+        return folder, num_frames, label, None
+    except Exception as e:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return folder, 0, label, str(e).replace('\n', ' ')
+
+
+def read_journal(journal_file):
+    done = {}
+    if os.path.exists(journal_file):
+        for line in open(journal_file):
+            items = line.rstrip('\n').split(' ')
+            # a partly written last line is ignored
+            if len(items) == 4 and items[0] == 'done':
+                done[items[1]] = (int(items[2]), int(items[3]))
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description="extract the frames of raw videos")
+    parser.add_argument('video_list', type=str, help='rows of [video file, class index]')
+    parser.add_argument('video_root', type=str)
+    parser.add_argument('out_root', type=str)
+    parser.add_argument('--image_tmpl', type=str, default='img_{:05d}.jpg')
+    parser.add_argument('--short_side', type=int, default=256)
+    parser.add_argument('--quality', type=int, default=95)
+    parser.add_argument('--backend', type=str, default='cv2', choices=['cv2', 'ffmpeg'])
+    parser.add_argument('--out_list', type=str, default=None)
+    parser.add_argument('-j', '--workers', default=8, type=int)
+    args = parser.parse_args()
+
+    rows = [x.strip().split(' ') for x in open(args.video_list) if x.strip()]
+    videos = [(row[0], os.path.splitext(row[0])[0], int(row[1])) for row in rows]
+    if not os.path.isdir(args.out_root):
+        os.makedirs(args.out_root)
+    journal_file = os.path.join(args.out_root, JOURNAL_FILE)
+    done = read_journal(journal_file)
+    jobs = [(os.path.join(args.video_root, video), folder, label, args.out_root, args.image_tmpl,
+             args.short_side, args.quality, args.backend)
+            for video, folder, label in videos if folder not in done]
+    print('%d/%d videos already extracted, %d to go' % (len(videos) - len(jobs), len(videos), len(jobs)))
+
+    start = time.time()
+    failed = 0
+    with open(journal_file, 'a') as journal:
+        pool = Pool(args.workers)
+        try:
+            for i, (folder, num_frames, label, error) in enumerate(
+                    pool.imap_unordered(extract_video, jobs)):
+                if error is None:
+                    done[folder] = (num_frames, label)
+                    journal.write('done %s %d %d\n' % (folder, num_frames, label))
+                else:
+                    failed += 1
+                    journal.write('failed %s %s\n' % (folder, error))
+                journal.flush()
+                if i % 100 == 0:
+                    print('%d/%d, %.1f videos/sec' % (i, len(jobs), (i + 1) / (time.time() - start)))
+        finally:
+            pool.terminate()
+    print('extracted %d videos in %.1f sec, %d failed' % (len(jobs) - failed, time.time() - start, failed))
+
+    if args.out_list is not None:
+        with open(args.out_list, 'w') as f:
+            f.write('\n'.join('%s %d %d' % (folder, done[folder][0], done[folder][1])
+                              for video, folder, label in videos if folder in done))
+
+
+if __name__ == '__main__':
+    main()
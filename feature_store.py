@@ -0,0 +1,116 @@
+# backbone features of every frame of a list, for training the TSN head alone
+#
+# extract_features.py runs TSN.base_model (the input of new_fc) over the
+# frames 1, 1 + stride, 1 + 2 * stride, ... of every video of a list and
+# writes them to a directory:
+#   features.npy:  (stored frames, feature_dim) float16, read memory-mapped
+#   index.npz:     paths, num_frames, begin, count of every video and the stride
+#   meta.json:     what the features were computed with
+# index.npz is written last, a directory without it is incomplete.
+#
+# FeatureDataSet samples the frame indices of the segments like TSNDataSet
+# (same planner, same temp_transform) and returns the stored features of the
+# nearest extracted frames instead of images, a (num_segments, feature_dim)
+# float tensor per video: new_fc and the consensus train on that at thousands
+# of videos per second (main.py --train_features).
+import os
+import json
+import numpy as np
+import torch
+
+from dataset import TSNDataSet
+
+FEATURES_FILE = 'features.npy'
+INDEX_FILE = 'index.npz'
+META_FILE = 'meta.json'
+
+
+def stored_frames(num_frames, stride):
+    """the frame indices of a video of num_frames that get features"""
+    return list(range(1, num_frames + 1, stride))
+
+
+class FeatureStoreWriter(object):
+    def __init__(self, path, paths, num_frames, stride):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.paths = list(paths)
+        self.num_frames = np.asarray(num_frames, dtype=np.int64)
+        self.stride = stride
+        self.count = np.array([len(stored_frames(n, stride)) for n in self.num_frames], dtype=np.int64)
+        self.begin = np.concatenate([[0], np.cumsum(self.count)[:-1]]).astype(np.int64)
+        self.written = np.zeros(len(self.paths), dtype=bool)
+        self.features = None
+
+    def write(self, row, features):
+        """(count[row], feature_dim) features of the video at row"""
+        if self.features is None:
+            self.features = np.lib.format.open_memmap(
+                os.path.join(self.path, FEATURES_FILE), mode='w+', dtype=np.float16,
+                shape=(int(self.count.sum()), features.shape[1]))
+        self.features[self.begin[row]:self.begin[row] + self.count[row]] = features
+        self.written[row] = True
+
+    def close(self, **meta):
+        """Write the index of the videos written, the others are left out"""
+        if self.features is None:
+            # nothing gives the feature dimension, and the store would be of no use
+            raise ValueError('no features written to %s (%d videos in the list)' % (self.path, len(self.paths)))
+        self.features.flush()
+        written = self.written
+        if not written.all():
+            print('%d of %d videos have no features, left out of %s' % (
+                (~written).sum(), len(self.paths), self.path))
+        meta = dict(meta, stride=self.stride, feature_dim=self.features.shape[1],
+                    num_videos=int(written.sum()), num_features=int(self.count[written].sum()))
+        with open(os.path.join(self.path, META_FILE), 'w') as f:
+            json.dump(meta, f, indent=1, sort_keys=True)
+        np.savez(os.path.join(self.path, INDEX_FILE), paths=np.array(self.paths)[written],
+                 num_frames=self.num_frames[written], begin=self.begin[written], count=self.count[written],
+                 stride=self.stride)
+        self.features = None
+
+
+class FeatureStore(object):
+    def __init__(self, path):
+        self.path = path
+        index = np.load(os.path.join(path, INDEX_FILE))
+        self.features = np.load(os.path.join(path, FEATURES_FILE), mmap_mode='r')
+        self.stride = int(index['stride'])
+        self.begin = index['begin']
+        self.count = index['count']
+        self.rows = dict((p, i) for i, p in enumerate(index['paths'].tolist()))
+        self.feature_dim = self.features.shape[1]
+
+    # the storage interface TSNDataSet checks the videos with
+    def exists(self, directory):
+        return directory in self.rows
+
+    def describe(self):
+        return 'features:%s' % self.path
+
+    def frames(self, path, idx_list):
+        """float32 (len(idx_list), feature_dim) features of the frames idx_list (1-based)"""
+        row = self.rows[path]
+        k = np.round((np.asarray(idx_list, dtype=np.float64) - 1) / self.stride).astype(np.int64)
+        k = np.clip(k, 0, self.count[row] - 1)
+        return self.features[self.begin[row] + k].astype(np.float32)
+
+
+class FeatureDataSet(TSNDataSet):
+    def __init__(self, feature_path, list_file, num_segments=3, **kwargs):
+        self.store = FeatureStore(feature_path)
+        super(FeatureDataSet, self).__init__(feature_path, list_file, num_segments=num_segments,
+                                             new_length=1, modality='RGB', storage=self.store, **kwargs)
+
+    def _parse_list(self):
+        super(FeatureDataSet, self)._parse_list()
+        stored = np.array([self.store.exists(p) for p in self.manifest.paths()], dtype=bool)
+        if not stored.all():
+            print('%d videos of %s have no features in %s' % ((~stored).sum(), self.list_file, self.store.path))
+            self.manifest = self.manifest.select(stored)
+
+    def _get_sample(self, record, idx_list):
+        idx_list = self.temp_transform(idx_list)
+        return torch.from_numpy(self.store.frames(record.path, idx_list)), record.label
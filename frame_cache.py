@@ -0,0 +1,184 @@
+# decoded frame cache shared by the DataLoader workers
+#
+# The cache is a fixed-size arena of shared memory created in the main process
+# before the workers start, so every worker sees (and fills) the same frames.
+# The arena is cut into equal slots: one slot holds the images of one frame
+# (one RGB image, or the x/y planes of a flow frame). size_slots() sizes them
+# on the largest of frames sampled over the lists (TSNDataSet.frame_bytes),
+# with a quarter of headroom; without it the first stored frame sets the size.
+# Larger frames are not cached and counted as 'too large' in summary(). The
+# slots are grouped into buckets of WAYS slots, and a hash of (video path,
+# frame index, tag) picks the bucket of a frame: a lookup or an insert only
+# looks at the WAYS slots of that bucket, and the least recently used of them
+# is evicted when they are all taken.
+#
+# This is LRU within a bucket, not over the whole cache, on purpose: a global
+# LRU needs one recency order shared by every worker, that is one lock around
+# every lookup. With 16 ways a bucket only thrashes when more than 16 frames
+# of the working set hash to it, under 1% of misses at a 60% full cache
+# (uniform keys), in exchange for lookups that touch 16 slots under one of
+# LOCK_STRIPES locks.
+#
+# Each bucket is guarded by one of LOCK_STRIPES locks, so workers fetching
+# frames of different buckets do not wait for each other. Frames are copied
+# out of the arena under the lock, the images handed to the transform never
+# alias the shared memory.
+import hashlib
+import multiprocessing
+import numpy as np
+import torch
+from PIL import Image
+
+MIN_SLOT_BYTES = 16 * 1024
+# headroom of a slot over the first cached frame, for varying aspect ratios
+SLOT_HEADROOM = 1.25
+# slots a frame can go to, and locks shared by the buckets
+WAYS = 16
+LOCK_STRIPES = 64
+_MODES = ['L', 'RGB']
+# counters of each lock stripe
+_HITS, _MISSES, _INSERTS, _EVICTIONS, _SKIPPED, _TICK = range(6)
+# layout, set by the first put
+_SLOT_BYTES, _NUM_SLOTS, _WAYS = range(3)
+
+
+class SharedFrameCache(object):
+    def __init__(self, budget_bytes):
+        self.budget_bytes = int(budget_bytes)
+        max_slots = max(1, self.budget_bytes // MIN_SLOT_BYTES)
+        # torch shared tensors survive both fork and spawn started workers
+        self._arena = torch.zeros(self.budget_bytes, dtype=torch.uint8).share_memory_()
+        self._keys = torch.zeros(max_slots, dtype=torch.int64).share_memory_()
+        self._used = torch.zeros(max_slots, dtype=torch.int64).share_memory_()
+        # images, height, width, mode of the frame in each slot
+        self._shapes = torch.zeros(max_slots, 4, dtype=torch.int32).share_memory_()
+        self._counters = torch.zeros(LOCK_STRIPES, 6, dtype=torch.int64).share_memory_()
+        self._layout = torch.zeros(3, dtype=torch.int64).share_memory_()
+        self._locks = [multiprocessing.Lock() for _ in range(LOCK_STRIPES)]
+        self._layout_lock = multiprocessing.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # numpy views are rebuilt in each process
+        state.pop('_views', None)
+        return state
+
+    def _np(self):
+        views = self.__dict__.get('_views')
+        if views is None:
+            views = self._views = (self._arena.numpy(), self._keys.numpy(), self._used.numpy(),
+                                   self._shapes.numpy(), self._counters.numpy(), self._layout.numpy())
+        return views
+
+    @staticmethod
+    def _key(path, idx, tag):
+        digest = hashlib.md5(('%s|%d|%s' % (path, idx, tag)).encode('utf-8')).digest()
+        # 0 marks an empty slot
+        return (int(np.frombuffer(digest[:8], dtype='<i8')[0]) & 0x7fffffffffffffff) or 1
+
+    def _bucket(self, key, layout):
+        """(first slot, number of slots, lock stripe) of the bucket of key"""
+        ways = int(layout[_WAYS])
+        bucket = key % (int(layout[_NUM_SLOTS]) // ways)
+        return bucket * ways, ways, bucket % LOCK_STRIPES
+
+    def size_slots(self, frame_bytes):
+        """Cut the arena into slots for frames of up to frame_bytes (plus
+        SLOT_HEADROOM), before the first put. Returns the slot size."""
+        if frame_bytes > 0:
+            self._set_layout(frame_bytes)
+        return int(self._layout[_SLOT_BYTES])
+
+    def _set_layout(self, nbytes):
+        with self._layout_lock:
+            layout = self._np()[5]
+            if layout[_SLOT_BYTES] == 0:
+                slot_bytes = max(MIN_SLOT_BYTES, int(nbytes * SLOT_HEADROOM))
+                num_slots = min(len(self._keys), self.budget_bytes // slot_bytes)
+                ways = max(1, min(WAYS, num_slots))
+                layout[_NUM_SLOTS] = num_slots // ways * ways
+                layout[_WAYS] = ways
+                # written last, the other fields are set once it is
+                layout[_SLOT_BYTES] = slot_bytes
+
+    def get(self, path, idx, tag=''):
+        """The images of a cached frame, or None"""
+        key = self._key(path, idx, tag)
+        arena, keys, used, shapes, counters, layout = self._np()
+        slot_bytes = int(layout[_SLOT_BYTES])
+        if slot_bytes == 0 or layout[_NUM_SLOTS] == 0:
+            with self._locks[0]:
+                counters[0, _MISSES] += 1
+            return None
+        first, ways, stripe = self._bucket(key, layout)
+        counters = counters[stripe]
+        with self._locks[stripe]:
+            slot = np.flatnonzero(keys[first:first + ways] == key)
+            if len(slot) == 0:
+                counters[_MISSES] += 1
+                return None
+            slot = first + slot[0]
+            counters[_HITS] += 1
+            counters[_TICK] += 1
+            used[slot] = counters[_TICK]
+            n, h, w, mode = shapes[slot].tolist()
+            c = len(_MODES[mode])
+            begin = slot * slot_bytes
+            data = arena[begin:begin + n * h * w * c].copy()
+        data = data.reshape(n, h, w, c) if c > 1 else data.reshape(n, h, w)
+        return [Image.fromarray(img) for img in data]
+
+    def put(self, path, idx, images, tag=''):
+        """Store the images of a frame (all of the same size and mode)"""
+        mode = images[0].mode
+        if mode not in _MODES:
+            return False
+        data = np.stack([np.asarray(img) for img in images])
+        key = self._key(path, idx, tag)
+        arena, keys, used, shapes, counters, layout = self._np()
+        if layout[_SLOT_BYTES] == 0:
+            self._set_layout(data.nbytes)
+        slot_bytes = int(layout[_SLOT_BYTES])
+        if data.nbytes > slot_bytes or layout[_NUM_SLOTS] == 0:
+            with self._locks[0]:
+                counters[0, _SKIPPED] += 1
+            return False
+        first, ways, stripe = self._bucket(key, layout)
+        counters = counters[stripe]
+        with self._locks[stripe]:
+            bucket_keys = keys[first:first + ways]
+            if (bucket_keys == key).any():
+                # stored by another worker meanwhile
+                return True
+            slot = first + int(np.argmin(used[first:first + ways]))
+            if keys[slot] != 0:
+                counters[_EVICTIONS] += 1
+            counters[_INSERTS] += 1
+            counters[_TICK] += 1
+            keys[slot] = key
+            used[slot] = counters[_TICK]
+            shapes[slot] = (data.shape[0], data.shape[1], data.shape[2], _MODES.index(mode))
+            begin = slot * slot_bytes
+            arena[begin:begin + data.nbytes] = data.reshape(-1)
+        return True
+
+    def stats(self):
+        counters = self._counters.sum(0).tolist()
+        layout = self._layout.tolist()
+        return {'hits': counters[_HITS], 'misses': counters[_MISSES],
+                'inserts': counters[_INSERTS], 'evictions': counters[_EVICTIONS],
+                'skipped': counters[_SKIPPED], 'slots': layout[_NUM_SLOTS],
+                'slot_bytes': layout[_SLOT_BYTES]}
+
+    def reset_stats(self):
+        for stripe, lock in enumerate(self._locks):
+            with lock:
+                self._counters[stripe, _HITS:_SKIPPED + 1] = 0
+
+    def summary(self, phase=None):
+        stats = self.stats()
+        lookups = stats['hits'] + stats['misses']
+        stored = int((self._keys[:stats['slots']] != 0).sum())
+        return 'frame cache%s: %.1f%% hits (%d/%d), %d/%d slots of %d KB used, %d evictions, %d too large' % (
+            ' (%s)' % phase if phase else '', 100. * stats['hits'] / max(lookups, 1), stats['hits'], lookups, stored,
+            stats['slots'], stats['slot_bytes'] // 1024, stats['evictions'], stats['skipped'])
@@ -0,0 +1,68 @@
+# vectorized segment sampling for TSNDataSet
+#
+# The planner computes the frame indices of a whole epoch at once, as a
+# (videos, num_segments, new_length) matrix, from the num_frames column of the
+# manifest. It follows the per-video sampling of TSN:
+#   train:  one random offset inside each of the num_segments equal segments
+#   val:    the center of each segment
+#   test:   the center of each segment, without the short video fallback
+# Offsets are 1-based like the frame file names, and each offset is expanded
+# into new_length consecutive frames that stop at the last frame.
+import numpy as np
+
+
+class FramePlanner(object):
+    def __init__(self, num_segments, new_length):
+        self.num_segments = num_segments
+        self.new_length = new_length
+
+    def train_offsets(self, num_frames, rng=np.random):
+        num_frames = np.asarray(num_frames, dtype=np.int64)
+        num_segments, new_length = self.num_segments, self.new_length
+        offsets = np.zeros((len(num_frames), num_segments), dtype=np.int64)
+
+        average_duration = (num_frames - new_length + 1) // num_segments
+        rows = average_duration > 0
+        if rows.any():
+            duration = average_duration[rows][:, None]
+            jitter = (rng.random_sample((int(rows.sum()), num_segments)) * duration).astype(np.int64)
+            offsets[rows] = np.arange(num_segments)[None, :] * duration + jitter
+
+        # fewer usable frames than segments: sorted random frames
+        rows = (average_duration <= 0) & (num_frames > num_segments)
+        if rows.any():
+            span = np.maximum(num_frames[rows] - new_length + 1, 1)[:, None]
+            picks = (rng.random_sample((int(rows.sum()), num_segments)) * span).astype(np.int64)
+            offsets[rows] = np.sort(picks, axis=1)
+        return offsets + 1
+
+    def _center_offsets(self, num_frames):
+        tick = (num_frames - self.new_length + 1) / float(self.num_segments)
+        return (tick[:, None] / 2.0 + tick[:, None] * np.arange(self.num_segments)[None, :]).astype(np.int64)
+
+    def val_offsets(self, num_frames):
+        num_frames = np.asarray(num_frames, dtype=np.int64)
+        offsets = self._center_offsets(num_frames)
+        offsets[num_frames <= self.num_segments + self.new_length - 1] = 0
+        return offsets + 1
+
+    def test_offsets(self, num_frames):
+        num_frames = np.asarray(num_frames, dtype=np.int64)
+        return self._center_offsets(num_frames) + 1
+
+    def expand(self, offsets, num_frames):
+        """(videos, segments) offsets -> (videos, segments, new_length) frame indices"""
+        offsets = np.asarray(offsets, dtype=np.int64)[:, :, None]
+        last = np.maximum(offsets, np.asarray(num_frames, dtype=np.int64)[:, None, None])
+        return np.minimum(offsets + np.arange(self.new_length)[None, None, :], last)
+
+    def plan(self, num_frames, mode, rng=np.random):
+        if mode == 'train':
+            offsets = self.train_offsets(num_frames, rng)
+        elif mode == 'val':
+            offsets = self.val_offsets(num_frames)
+        elif mode == 'test':
+            offsets = self.test_offsets(num_frames)
+        else:
+            raise ValueError('Unknown sampling mode ' + mode)
+        return self.expand(offsets, num_frames).astype(np.int32)
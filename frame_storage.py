@@ -0,0 +1,383 @@
+# storage backends for the video frames read by TSNDataSet
+#
+#   FolderFrameStore:   one image file per frame, root_path/directory/image_tmpl
+#   PackedFrameStore:   one packed file per video (written by pack_frames.py),
+#                       frames are read out of an mmap by slice
+#   VideoFileStore:     frames decoded straight out of video files, see video_storage.py
+#   ArenaFrameStore:    the compressed frames of a list preloaded into one shared
+#                       memory arena in front of one of the above
+#
+# A store is opened once per video and the returned reader serves every frame
+# of that sample, so the packed layout costs a single file handle per sample.
+import io
+import os
+import mmap
+import time
+import struct
+import hashlib
+import threading
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+PACK_SUFFIX = '.pack'
+PACK_MAGIC = b'TRNPACK1'
+# trailer: [frame offsets int64 (n+1)] [n int64] [magic]
+_TRAILER = struct.Struct('<q8s')
+
+
+class FolderFrameStore(object):
+    """Frames stored as individual files under root_path/directory"""
+    def __init__(self, root_path, image_tmpl):
+        self.root_path = root_path
+        self.image_tmpl = image_tmpl
+
+    def frame_path(self, directory, idx):
+        return os.path.join(self.root_path, directory, self.image_tmpl.format(idx))
+
+    def exists(self, directory):
+        return os.path.exists(self.frame_path(directory, 1))
+
+    def open(self, directory):
+        return FolderFrameReader(self, directory)
+
+    def describe(self):
+        return 'folder:%s:%s' % (self.root_path, self.image_tmpl)
+
+    def signature(self, directory, files=False):
+        # adding, removing or renaming frames changes the folder mtime; a
+        # frame overwritten in place (a re-extraction into the same folder)
+        # only shows in the size and mtime of its file, hashed with files=True
+        path = os.path.join(self.root_path, directory)
+        try:
+            if not files:
+                return os.stat(path).st_mtime
+            h = hashlib.md5()
+            with os.scandir(path) as it:
+                for entry in sorted(it, key=lambda entry: entry.name):
+                    st = entry.stat()
+                    h.update(('%s %d %d\n' % (entry.name, st.st_size, st.st_mtime_ns)).encode('utf-8'))
+        except OSError:
+            return -1.
+        # 52 bits, exact in the float64 signatures of the preflight index
+        return float(int(h.hexdigest()[:13], 16))
+
+    def list_frames(self, directory, num_frames):
+        """Indices in [1, num_frames] whose frame file is present"""
+        try:
+            with os.scandir(os.path.join(self.root_path, directory)) as it:
+                names = set(entry.name for entry in it)
+        except OSError:
+            return []
+        return [i for i in range(1, num_frames + 1) if self.image_tmpl.format(i) in names]
+
+    def frame_sizes(self, directory, num_frames):
+        """Byte size of frames 1..num_frames, 0 for missing ones"""
+        sizes = np.zeros(num_frames, dtype=np.int64)
+        for i in range(num_frames):
+            try:
+                sizes[i] = os.stat(self.frame_path(directory, i + 1)).st_size
+            except OSError:
+                pass
+        return sizes
+
+
+class FolderFrameReader(object):
+    def __init__(self, store, directory):
+        self.store = store
+        self.directory = directory
+
+    def read(self, idx):
+        # Image.open accepts the path directly
+        return self.store.frame_path(self.directory, idx)
+
+    def read_bytes(self, idx):
+        with open(self.store.frame_path(self.directory, idx), 'rb') as f:
+            return f.read()
+
+    def name(self, idx):
+        return self.store.frame_path(self.directory, idx)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PackedFrameStore(object):
+    """Frames of each video packed into pack_root/directory.pack"""
+    def __init__(self, pack_root):
+        self.pack_root = pack_root
+
+    def pack_path(self, directory):
+        # list files may hold absolute video paths (e.g. ucf101 with root_path '/')
+        return os.path.join(self.pack_root, directory.lstrip('/') + PACK_SUFFIX)
+
+    def exists(self, directory):
+        return os.path.exists(self.pack_path(directory))
+
+    def open(self, directory):
+        return PackedFrameReader(self.pack_path(directory))
+
+    def describe(self):
+        return 'packed:%s' % self.pack_root
+
+    def signature(self, directory, files=False):
+        # a pack is rewritten whole, its mtime covers its frames
+        try:
+            return os.stat(self.pack_path(directory)).st_mtime
+        except OSError:
+            return -1.
+
+    def list_frames(self, directory, num_frames):
+        try:
+            reader = self.open(directory)
+        except (IOError, OSError):
+            return []
+        with reader:
+            lengths = np.diff(reader.offsets)
+            return [i for i in range(1, min(num_frames, reader.num_frames) + 1) if lengths[i - 1] > 0]
+
+    def frame_sizes(self, directory, num_frames):
+        sizes = np.zeros(num_frames, dtype=np.int64)
+        try:
+            reader = self.open(directory)
+        except (IOError, OSError):
+            return sizes
+        with reader:
+            lengths = np.diff(reader.offsets)[:num_frames]
+            sizes[:len(lengths)] = lengths
+        return sizes
+
+
+class PackedFrameReader(object):
+    """Frames of a pack file, or of the pack bytes in data (shards, see shard_dataset.py)"""
+    def __init__(self, path, data=None):
+        self.path = path
+        if data is not None:
+            self._mm = data
+        else:
+            with open(path, 'rb') as f:
+                # the mapping stays valid after the file object is closed
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(self._mm)
+        num_frames, magic = _TRAILER.unpack(self._mm[size - _TRAILER.size:])
+        if magic != PACK_MAGIC:
+            self.close()
+            raise IOError('not a frame pack: %s' % path)
+        start = size - _TRAILER.size - 8 * (num_frames + 1)
+        self.offsets = np.frombuffer(self._mm[start:size - _TRAILER.size], dtype='<i8')
+        self.num_frames = num_frames
+
+    def read(self, idx):
+        # frame indices are 1-based like image_tmpl
+        if idx < 1 or idx > self.num_frames:
+            raise IndexError('frame %d out of range in %s' % (idx, self.path))
+        begin, end = self.offsets[idx - 1], self.offsets[idx]
+        if begin == end:
+            raise IOError('frame %d missing in %s' % (idx, self.path))
+        return io.BytesIO(self._mm[begin:end])
+
+    def read_bytes(self, idx):
+        return self.read(idx).getvalue()
+
+    def name(self, idx):
+        return '%s[%d]' % (self.path, idx)
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ArenaFrameStore(object):
+    """The compressed frames 1..num_frames of every video in paths, read once
+    into a shared memory arena so the workers decode from memory. Videos that
+    no longer fit in budget_bytes, and frames that changed size while loading,
+    are read from store."""
+    def __init__(self, store, paths, num_frames, budget_bytes, workers=16):
+        self.store = store
+        start = time.time()
+        num_frames = [int(n) for n in num_frames]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            sizes = list(pool.map(store.frame_sizes, paths, num_frames))
+
+        # whole videos in list order, skipping those that do not fit in what is
+        # left of the budget so that smaller ones further on still get in
+        # (nothing to load for missing videos, or stores that only decode like
+        # video files)
+        video_bytes = np.array([s.sum() for s in sizes], dtype=np.int64)
+        loaded = []
+        left = budget_bytes
+        for i, nbytes in enumerate(video_bytes):
+            if 0 < nbytes <= left:
+                loaded.append(i)
+                left -= nbytes
+        loaded = np.array(loaded, dtype=np.int64)
+        self.rows = dict((paths[i], row) for row, i in enumerate(loaded))
+        lengths = [sizes[i] for i in loaded]
+        self.first = np.cumsum([0] + [len(x) for x in lengths]).astype(np.int64)
+        self.lengths = np.concatenate(lengths + [np.zeros(0, np.int64)])
+        self.begins = np.concatenate([[0], np.cumsum(self.lengths)]).astype(np.int64)
+        # torch shared memory reaches the DataLoader workers however they start
+        self.arena = torch.empty(int(self.begins[-1]), dtype=torch.uint8).share_memory_()
+
+        arena = self.arena.numpy()
+
+        def load(row):
+            directory = paths[loaded[row]]
+            first = self.first[row]
+            with store.open(directory) as reader:
+                for i in range(self.first[row + 1] - first):
+                    length = self.lengths[first + i]
+                    if length == 0:
+                        continue
+                    try:
+                        data = reader.read_bytes(i + 1)
+                    except (IOError, OSError, IndexError):
+                        data = b''
+                    if len(data) != length:
+                        self.lengths[first + i] = -1
+                        continue
+                    begin = self.begins[first + i]
+                    arena[begin:begin + length] = np.frombuffer(data, dtype=np.uint8)
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(load, range(len(loaded))))
+        elapsed = time.time() - start
+        print('preload: %d/%d videos (%.1f%% of %.1f MB), %d frames, %.1f MB in %.1f sec (%.1f MB/s), '
+              '%d videos left on %s' % (
+                  len(loaded), len(paths), 100. * video_bytes[loaded].sum() / max(video_bytes.sum(), 1),
+                  video_bytes.sum() / 1024. ** 2, int((self.lengths > 0).sum()), self.begins[-1] / 1024. ** 2,
+                  elapsed, self.begins[-1] / 1024. ** 2 / max(elapsed, 1e-6), len(paths) - len(loaded),
+                  store.describe()))
+
+    def exists(self, directory):
+        row = self.rows.get(directory)
+        if row is None:
+            return self.store.exists(directory)
+        return self.first[row + 1] > self.first[row] and self.lengths[self.first[row]] != 0
+
+    def open(self, directory):
+        row = self.rows.get(directory)
+        if row is None:
+            return self.store.open(directory)
+        return ArenaFrameReader(self, directory, row)
+
+    def describe(self):
+        return self.store.describe()
+
+    def signature(self, directory, files=False):
+        return self.store.signature(directory, files)
+
+    def list_frames(self, directory, num_frames):
+        return self.store.list_frames(directory, num_frames)
+
+    def frame_sizes(self, directory, num_frames):
+        return self.store.frame_sizes(directory, num_frames)
+
+
+class ArenaFrameReader(object):
+    def __init__(self, store, directory, row):
+        self.store = store
+        self.directory = directory
+        self.first = store.first[row]
+        self.num_frames = store.first[row + 1] - self.first
+        self._disk = None
+        # frames of a sample may be fetched by several threads
+        self._lock = threading.Lock()
+
+    def _disk_reader(self):
+        with self._lock:
+            if self._disk is None:
+                self._disk = self.store.store.open(self.directory)
+        return self._disk
+
+    def read(self, idx):
+        if idx < 1 or idx > self.num_frames:
+            return self._disk_reader().read(idx)
+        length = self.store.lengths[self.first + idx - 1]
+        if length == 0:
+            raise IOError('frame %d missing in %s' % (idx, self.directory))
+        elif length < 0:
+            return self._disk_reader().read(idx)
+        begin = self.store.begins[self.first + idx - 1]
+        return io.BytesIO(self.store.arena.numpy()[begin:begin + length].tobytes())
+
+    def read_bytes(self, idx):
+        data = self.read(idx)
+        return data.getvalue() if isinstance(data, io.BytesIO) else self._disk_reader().read_bytes(idx)
+
+    def name(self, idx):
+        return '%s[%d] (preloaded)' % (self.directory, idx)
+
+    def close(self):
+        if self._disk is not None:
+            self._disk.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _write_frames(f, frames):
+    # frames: the encoded bytes of frame 1, 2, ..., None for a missing frame
+    offsets = [0]
+    for data in frames:
+        if data is not None:
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+        else:
+            offsets.append(offsets[-1])
+    f.write(np.asarray(offsets, dtype='<i8').tobytes())
+    f.write(_TRAILER.pack(len(offsets) - 1, PACK_MAGIC))
+    return offsets[-1]
+
+
+def _read_file(frame_file):
+    if frame_file is None:
+        return None
+    with open(frame_file, 'rb') as src:
+        return src.read()
+
+
+def write_pack(path, frame_files):
+    """Pack frame_files (frame 1, 2, ...) into a single file; a None entry
+    keeps the slot of a missing frame so the indices stay aligned"""
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        total = _write_frames(f, (_read_file(x) for x in frame_files))
+    os.rename(tmp_path, path)
+    return total
+
+
+def pack_bytes(frames):
+    """The pack of the encoded frames (bytes or None), as bytes"""
+    f = io.BytesIO()
+    _write_frames(f, frames)
+    return f.getvalue()
+
+
+def return_storage(storage, root_path, image_tmpl, pack_root=None, video_ext=''):
+    if storage == 'folder':
+        return FolderFrameStore(root_path, image_tmpl)
+    elif storage == 'packed':
+        if not pack_root:
+            raise ValueError('packed storage needs a pack_root')
+        return PackedFrameStore(pack_root)
+    elif storage == 'video':
+        from video_storage import VideoFileStore
+        return VideoFileStore(root_path, video_ext)
+    else:
+        raise ValueError('Unknown storage ' + storage)
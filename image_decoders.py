@@ -0,0 +1,217 @@
+# JPEG decoder backends for TSNDataSet
+#
+#   pil:        Pillow, the reference
+#   cv2:        OpenCV's imdecode
+#   turbojpeg:  libjpeg-turbo through PyTurboJPEG (pip install PyTurboJPEG)
+#
+# All of them return PIL images in RGB (or L) channel order, the order the
+# transforms and Stack(roll=...) expect: the BGR output of OpenCV is converted
+# back. Draft decoding (decode_size) downscales by 1/2, 1/4 or 1/8 inside the
+# decoder with the same rule as PIL's Image.draft, so every backend gives
+# frames of the same size; pixel values can differ in the last bit between
+# JPEG libraries. Frames that are not JPEGs go through PIL whatever the
+# backend.
+#
+# calibrate_decoder() times the available backends on a few frames of the
+# dataset and returns the fastest.
+import io
+import math
+import time
+import struct
+import numpy as np
+from PIL import Image
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+try:
+    import turbojpeg
+except ImportError:
+    turbojpeg = None
+
+DECODERS = ['pil', 'cv2', 'turbojpeg']
+
+# start of frame markers, the ones carrying the image size
+_SOF_MARKERS = set(range(0xc0, 0xd0)) - set([0xc4, 0xc8, 0xcc])
+
+
+def jpeg_size(data):
+    """(w, h) from the header of a JPEG, None for other formats"""
+    if data[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xff:
+            return None
+        marker = data[i + 1]
+        if marker == 0xff:
+            # fill byte
+            i += 1
+        elif marker in _SOF_MARKERS:
+            h, w = struct.unpack('>HH', data[i + 5:i + 9])
+            return w, h
+        elif marker == 0x01 or 0xd0 <= marker <= 0xd8:
+            # markers without a length
+            i += 2
+        else:
+            i += 2 + struct.unpack('>H', data[i + 2:i + 4])[0]
+    return None
+
+
+def jpeg_comment(data):
+    """The first COM segment of the header of a JPEG, None if there is none"""
+    if data[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xff:
+            return None
+        marker = data[i + 1]
+        if marker == 0xff:
+            i += 1
+        elif marker in (0xd9, 0xda):
+            # end of image, start of scan: no more header
+            return None
+        elif marker == 0x01 or 0xd0 <= marker <= 0xd8:
+            i += 2
+        else:
+            length = struct.unpack('>H', data[i + 2:i + 4])[0]
+            if marker == 0xfe:
+                return bytes(data[i + 4:i + 2 + length])
+            i += 2 + length
+    return None
+
+
+def draft_scale(w, h, decode_size, planes=1):
+    """1, 2, 4 or 8, the reduction Image.draft picks for decode_size"""
+    if not decode_size:
+        return 1
+    scale = decode_size / float(min(w, h // planes))
+    if scale >= 1:
+        return 1
+    reduction = min(w // int(math.ceil(w * scale)), h // int(math.ceil(h * scale)))
+    for factor in (8, 4, 2):
+        if reduction >= factor:
+            return factor
+    return 1
+
+
+class PILDecoder(object):
+    name = 'pil'
+
+    def open(self, f, decode_size=None, planes=1):
+        img = Image.open(f)
+        if decode_size is not None:
+            # the JPEG decoder downscales by 1/2, 1/4 or 1/8 in the DCT domain,
+            # keeping the short side at least decode_size (no-op for other formats)
+            w, h = img.size
+            scale = decode_size / float(min(w, h // planes))
+            if scale < 1:
+                img.draft(img.mode, (int(math.ceil(w * scale)), int(math.ceil(h * scale))))
+        return img
+
+    def decode(self, data, mode='RGB', decode_size=None, planes=1):
+        # convert() decodes, also when the mode is already right
+        return self.open(io.BytesIO(data), decode_size, planes).convert(mode)
+
+
+class CV2Decoder(object):
+    name = 'cv2'
+
+    def __init__(self):
+        if cv2 is None:
+            raise ImportError('the cv2 decoder needs OpenCV (pip install opencv-python)')
+
+    def decode(self, data, mode='RGB', decode_size=None, planes=1):
+        size = jpeg_size(data)
+        if size is None or mode not in ('RGB', 'L'):
+            return PILDecoder().decode(data, mode, decode_size, planes)
+        factor = draft_scale(size[0], size[1], decode_size, planes)
+        if factor == 1:
+            flag = cv2.IMREAD_COLOR if mode == 'RGB' else cv2.IMREAD_GRAYSCALE
+        else:
+            flag = getattr(cv2, 'IMREAD_REDUCED_%s_%d' % ('COLOR' if mode == 'RGB' else 'GRAYSCALE', factor))
+        img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), flag)
+        if img is None:
+            raise IOError('cv2 could not decode the image')
+        if mode == 'RGB':
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+        return Image.fromarray(img, mode)
+
+
+class TurboJPEGDecoder(object):
+    name = 'turbojpeg'
+
+    def __init__(self):
+        if turbojpeg is None:
+            raise ImportError('the turbojpeg decoder needs PyTurboJPEG (pip install PyTurboJPEG)')
+        self._jpeg = None
+
+    def __getstate__(self):
+        # the library handle is loaded again in the worker processes
+        return {'_jpeg': None}
+
+    def decode(self, data, mode='RGB', decode_size=None, planes=1):
+        size = jpeg_size(data)
+        if size is None or mode not in ('RGB', 'L'):
+            return PILDecoder().decode(data, mode, decode_size, planes)
+        if self._jpeg is None:
+            self._jpeg = turbojpeg.TurboJPEG()
+        factor = draft_scale(size[0], size[1], decode_size, planes)
+        img = self._jpeg.decode(data, pixel_format=turbojpeg.TJPF_RGB if mode == 'RGB' else turbojpeg.TJPF_GRAY,
+                                scaling_factor=(1, factor) if factor > 1 else None)
+        if mode == 'L':
+            img = img.reshape(img.shape[:2])
+        return Image.fromarray(img, mode)
+
+
+def return_decoder(name='pil'):
+    if name == 'pil':
+        return PILDecoder()
+    elif name == 'cv2':
+        return CV2Decoder()
+    elif name == 'turbojpeg':
+        return TurboJPEGDecoder()
+    raise ValueError('Unknown decoder ' + name)
+
+
+def available_decoders():
+    decoders = []
+    for name in DECODERS:
+        try:
+            decoders.append(return_decoder(name))
+        except ImportError:
+            pass
+    return decoders
+
+
+def calibrate_decoder(samples, mode='RGB', decode_size=None, planes=1, repeats=3):
+    """The fastest of the available decoders on samples (encoded frames).
+
+    A backend that fails on a sample or gives frames of another size than PIL
+    is left out.
+    """
+    reference = [PILDecoder().decode(data, mode, decode_size, planes).size for data in samples]
+    timings = []
+    for decoder in available_decoders():
+        try:
+            sizes = [decoder.decode(data, mode, decode_size, planes).size for data in samples]
+        except Exception as e:
+            print('decoder %s failed: %s' % (decoder.name, e))
+            continue
+        if sizes != reference:
+            print('decoder %s left out, frame sizes differ from pil' % decoder.name)
+            continue
+        best = float('inf')
+        for _ in range(repeats):
+            start = time.time()
+            for data in samples:
+                decoder.decode(data, mode, decode_size, planes)
+            best = min(best, time.time() - start)
+        timings.append((best, decoder))
+    print('decoder calibration on %d frames: %s' % (len(samples), ', '.join(
+        '%s %.2f ms/frame' % (decoder.name, 1000. * t / len(samples)) for t, decoder in timings)))
+    best, decoder = min(timings, key=lambda x: x[0])
+    return decoder
@@ -7,13 +7,20 @@ import torchvision
 import torch.nn.parallel
 import torch.backends.cudnn as cudnn
 import torch.optim
-from torch.nn.utils import clip_grad_norm
+from torch.nn.utils import clip_grad_norm_
 
 from dataset import TSNDataSet
-from models import TSN
+from models import TSN, load_tsn_state
 from transforms import *
+from tensor_transforms import *
 from opts import parser
 import datasets_video
+from frame_storage import return_storage
+from frame_cache import SharedFrameCache
+from shared_loader import SharedWorkerLoader, TimedLoader
+from val_cache import CachedValLoader, val_cache_key
+from shard_dataset import ShardedTSNDataSet
+from feature_store import FeatureDataSet
 
 
 best_prec1 = 0
@@ -60,18 +67,29 @@ def main():
     input_mean = model.input_mean
     input_std = model.input_std
     policies = model.get_optim_policies()
-    train_augmentation = model.get_augmentation()
+    train_augmentation = model.get_augmentation(tensor=args.tensor_transforms)
 
-    model = torch.nn.DataParallel(model, device_ids=args.gpus).cuda()
+    if bool(args.train_features) != bool(args.val_features):
+        raise ValueError('--train_features and --val_features go together')
+    if args.train_features:
+        # train new_fc and the consensus alone on stored features, see
+        # feature_store.py; runs on the CPU when there is no GPU
+        model = model.head()
+        policies = model.get_optim_policies()
+
+    model = torch.nn.DataParallel(model, device_ids=args.gpus)
+    if torch.cuda.is_available():
+        model = model.cuda()
 
     if args.resume:
         args.resume = os.path.join(args.root_model, args.resume)
         if os.path.isfile(args.resume):
             print(("=> loading checkpoint '{}'".format(args.resume)))
-            checkpoint = torch.load(args.resume)
+            checkpoint = torch.load(args.resume, map_location=None if torch.cuda.is_available() else 'cpu')
             args.start_epoch = checkpoint['epoch']
             best_prec1 = checkpoint['best_prec1']
-            model.load_state_dict(checkpoint['state_dict'])
+            # a head takes its weights out of a full TSN checkpoint
+            load_tsn_state(model, checkpoint['state_dict'])
             print(("=> loaded checkpoint '{}' (epoch {})"
                   .format(args.evaluate, checkpoint['epoch'])))
         else:
@@ -80,36 +98,97 @@ def main():
     cudnn.benchmark = True
 
     # Data loading code
-    if args.modality != 'RGBDiff':
+    if args.modality == 'RGBDiff' or args.uint8_input:
+        # with uint8 clips TSN.forward normalizes
+        normalize = IdentityTransform()
+    elif args.tensor_transforms:
+        normalize = ClipNormalize(input_mean, input_std)
+    else:
         normalize = GroupNormalize(input_mean, input_std)
+
+    roll = args.arch in ['BNInception','InceptionV3']
+    div = args.arch not in ['BNInception','InceptionV3']
+    if args.tensor_transforms:
+        # the whole clip is stacked once and transformed as a tensor
+        train_transform = torchvision.transforms.Compose([
+            ToClipTensor(),
+            train_augmentation,
+            ClipToTorchFormat(roll=roll, div=div, uint8=args.uint8_input),
+            normalize
+        ])
+        val_transform = torchvision.transforms.Compose([
+            ToClipTensor(),
+            ClipScale(int(scale_size)),
+            ClipCenterCrop(crop_size),
+            ClipToTorchFormat(roll=roll, div=div, uint8=args.uint8_input),
+            normalize
+        ])
     else:
-        normalize = IdentityTransform()
+        train_transform = torchvision.transforms.Compose([
+            train_augmentation,
+            Stack(roll=roll),
+            ToTorchFormatTensor(div=div, uint8=args.uint8_input),
+            normalize
+        ])
+        val_transform = torchvision.transforms.Compose([
+            GroupScale(int(scale_size)),
+            GroupCenterCrop(crop_size),
+            Stack(roll=roll),
+            ToTorchFormatTensor(div=div, uint8=args.uint8_input),
+            normalize
+        ])
 
     if args.modality == 'RGB':
         data_length = 1
     elif args.modality in ['Flow', 'RGBDiff']:
         data_length = 5
 
+    storage = return_storage(args.storage, args.root_path, prefix, args.pack_root, args.video_ext)
+    # one cache for both loaders, created before their workers start
+    frame_cache = None
+    if args.frame_cache_mb > 0:
+        frame_cache = SharedFrameCache(args.frame_cache_mb * 1024 ** 2)
+
     if args.train_reverse:
         train_temp_transform = ReverseFrames(size=data_length*args.num_segments)
     elif args.train_shuffle:
         train_temp_transform = ShuffleFrames(size=data_length*args.num_segments)
     else:
         train_temp_transform = IdentityTransform()
-    train_loader = torch.utils.data.DataLoader(
-        TSNDataSet(args.root_path, args.train_list, num_segments=args.num_segments,
+    if args.train_features:
+        train_dataset = FeatureDataSet(args.train_features, args.train_list, num_segments=args.num_segments,
+                   temp_transform=train_temp_transform)
+    elif args.train_shards:
+        # stream the training videos from the shards of make_shards.py
+        train_dataset = ShardedTSNDataSet(args.train_shards, num_segments=args.num_segments,
+                   new_length=data_length,
+                   modality=args.modality,
+                   temp_transform=train_temp_transform, 
+                   shuffle_buffer=args.shuffle_buffer,
+                   draft_decode=args.draft_decode,
+                   decoder=args.decoder,
+                   flow_format=args.flow_format,
+                   frame_cache=frame_cache,
+                   cache_prescale=args.cache_prescale,
+                   fetch_threads=args.fetch_threads,
+                   transform=train_transform)
+    else:
+        train_dataset = TSNDataSet(args.root_path, args.train_list, num_segments=args.num_segments,
                    new_length=data_length,
                    modality=args.modality,
                    image_tmpl=prefix,
                    temp_transform=train_temp_transform, 
-                   transform=torchvision.transforms.Compose([
-                       train_augmentation,
-                       Stack(roll=(args.arch in ['BNInception','InceptionV3'])),
-                       ToTorchFormatTensor(div=(args.arch not in ['BNInception','InceptionV3'])),
-                       normalize
-                   ])),
-        batch_size=args.batch_size, shuffle=True,
-        num_workers=args.workers, pin_memory=True)
+                   storage=storage,
+                   preflight=args.preflight,
+                   preflight_verify=args.preflight_verify,
+                   draft_decode=args.draft_decode,
+                   decoder=args.decoder,
+                   flow_format=args.flow_format,
+                   frame_cache=frame_cache,
+                   cache_prescale=args.cache_prescale,
+                   fetch_threads=args.fetch_threads,
+                   preload_mb=args.preload_mb,
+                   transform=train_transform)
 
     if args.val_reverse:
         val_temp_transform = ReverseFrames(size=data_length*args.num_segments)
@@ -120,26 +199,76 @@ def main():
     else:
         val_temp_transform = IdentityTransform()
         print('using normal val')
-    val_loader = torch.utils.data.DataLoader(
-        TSNDataSet(args.root_path, args.val_list, num_segments=args.num_segments,
+    if args.val_features:
+        val_dataset = FeatureDataSet(args.val_features, args.val_list, num_segments=args.num_segments,
+                   random_shift=False, temp_transform=val_temp_transform)
+    else:
+        val_dataset = TSNDataSet(args.root_path, args.val_list, num_segments=args.num_segments,
                    new_length=data_length,
                    modality=args.modality,
                    image_tmpl=prefix,
                    random_shift=False,
                    temp_transform=val_temp_transform, 
-                   transform=torchvision.transforms.Compose([
-                       GroupScale(int(scale_size)),
-                       GroupCenterCrop(crop_size),
-                       Stack(roll=(args.arch in ['BNInception','InceptionV3'])),
-                       ToTorchFormatTensor(div=(args.arch not in ['BNInception','InceptionV3'])),
-                       normalize
-                   ])),
-        batch_size=args.batch_size, shuffle=False,
-        num_workers=args.workers, pin_memory=True)
+                   storage=storage,
+                   preflight=args.preflight,
+                   preflight_verify=args.preflight_verify,
+                   draft_decode=args.draft_decode,
+                   decoder=args.decoder,
+                   flow_format=args.flow_format,
+                   frame_cache=frame_cache,
+                   cache_prescale=args.cache_prescale,
+                   fetch_threads=args.fetch_threads,
+                   preload_mb=args.preload_mb,
+                   transform=val_transform)
+
+    if frame_cache is not None:
+        # slots sized on frames of both lists, not on the first frame stored
+        slot_bytes = frame_cache.size_slots(max(train_dataset.frame_bytes(), val_dataset.frame_bytes()))
+        print('frame cache: slots of %d KB' % (slot_bytes // 1024))
+
+    prefetch_factor = args.prefetch_factor if args.workers > 0 else None
+    if args.persistent_workers and not args.train_shards:
+        # one pool of workers for both sets, started once for the whole run
+        loader = SharedWorkerLoader([train_dataset, val_dataset], args.batch_size, shuffle=[True, False],
+                                    num_workers=args.workers, prefetch_factor=args.prefetch_factor)
+        train_loader, val_loader = loader.phase(0, 'train'), loader.phase(1, 'val')
+    else:
+        if args.persistent_workers:
+            print('--persistent_workers needs a map-style training set, --train_shards starts workers per epoch')
+        train_loader = TimedLoader(torch.utils.data.DataLoader(
+            train_dataset,
+            # a streamed dataset shuffles itself
+            batch_size=args.batch_size, shuffle=not args.train_shards,
+            num_workers=args.workers, pin_memory=True, prefetch_factor=prefetch_factor), 'train')
+        val_loader = TimedLoader(torch.utils.data.DataLoader(
+            val_dataset,
+            batch_size=args.batch_size, shuffle=False,
+            num_workers=args.workers, pin_memory=True, prefetch_factor=prefetch_factor), 'val')
+
+    if args.val_cache_dir and args.val_shuffle:
+        print('no val cache, the shuffled val clips differ at every validation')
+    elif args.val_cache_dir and not (args.preflight or args.val_features):
+        # without the scan a missing video is replaced by a random one per pass
+        print('no val cache without --preflight, the clips of missing videos would be random')
+    elif args.val_cache_dir:
+        # the first validation writes its clips, the next ones read them back
+        key = val_cache_key(args.val_list, root_path=args.root_path, storage=args.storage,
+                            modality=args.modality, image_tmpl=prefix, flow_format=args.flow_format,
+                            num_segments=args.num_segments, new_length=data_length,
+                            videos=val_dataset.manifest.paths(), val_reverse=args.val_reverse,
+                            decoder=args.decoder, draft_decode=args.draft_decode,
+                            cache_prescale=args.cache_prescale, tensor_transforms=args.tensor_transforms,
+                            scale_size=int(scale_size), crop_size=crop_size, roll=roll, div=div,
+                            uint8_input=args.uint8_input,
+                            normalize=None if isinstance(normalize, IdentityTransform) else
+                            [list(input_mean), list(input_std)])
+        val_loader = CachedValLoader(val_loader, args.val_cache_dir, key, args.batch_size)
 
     # define loss function (criterion) and optimizer
     if args.loss_type == 'nll':
-        criterion = torch.nn.CrossEntropyLoss().cuda()
+        criterion = torch.nn.CrossEntropyLoss()
+        if torch.cuda.is_available():
+            criterion = criterion.cuda()
     else:
         raise ValueError("Unknown loss type")
 
@@ -160,9 +289,14 @@ def main():
     log_training = open(os.path.join(args.root_log, '%s.csv' % args.store_name), 'a')
     for epoch in range(args.start_epoch, args.epochs):
         adjust_learning_rate(optimizer, epoch, args.lr_steps)
+        # draw this epoch's frame indices before the workers start
+        train_loader.dataset.plan_epoch()
 
         # train for one epoch
         train(train_loader, model, criterion, optimizer, epoch, log_training)
+        if frame_cache is not None:
+            print(frame_cache.summary('train'))
+            frame_cache.reset_stats()
 
         # evaluate on validation set
         if (epoch + 1) % args.eval_freq == 0 or epoch == args.epochs - 1:
@@ -170,6 +304,10 @@ def main():
                     # (epoch + 1) * len(train_loader), log_training)
             prec1 = validate(val_loader, model, criterion, 
                     (epoch + 1) * len(train_loader), log_val)
+            if frame_cache is not None:
+                # the val lookups are not counted in the next train epoch
+                print(frame_cache.summary('val'))
+                frame_cache.reset_stats()
             
 
             # remember best prec@1 and save checkpoint
@@ -203,19 +341,18 @@ def train(train_loader, model, criterion, optimizer, epoch, log):
         # measure data loading time
         data_time.update(time.time() - end)
 
-        target = target.cuda(async=True)
-        input_var = torch.autograd.Variable(input)
-        target_var = torch.autograd.Variable(target)
+        if torch.cuda.is_available():
+            target = target.cuda(non_blocking=True)
 
         # compute output
-        output = model(input_var)
-        loss = criterion(output, target_var)
+        output = model(input)
+        loss = criterion(output, target)
 
         # measure accuracy and record loss
-        prec1, prec5 = accuracy(output.data, target, topk=(1,5))
-        losses.update(loss.data[0], input.size(0))
-        top1.update(prec1[0], input.size(0))
-        top5.update(prec5[0], input.size(0))
+        prec1, prec5 = accuracy(output.detach(), target, topk=(1,5))
+        losses.update(loss.item(), input.size(0))
+        top1.update(prec1.item(), input.size(0))
+        top5.update(prec5.item(), input.size(0))
 
 
         # compute gradient and do SGD step
@@ -224,7 +361,7 @@ def train(train_loader, model, criterion, optimizer, epoch, log):
         loss.backward()
 
         if args.clip_gradient is not None:
-            total_norm = clip_grad_norm(model.parameters(), args.clip_gradient)
+            total_norm = clip_grad_norm_(model.parameters(), args.clip_gradient)
             if total_norm > args.clip_gradient:
                 print("clipping gradient: {} with coef {}".format(total_norm, args.clip_gradient / total_norm))
 
@@ -260,20 +397,20 @@ def validate(val_loader, model, criterion, iter, log):
 
     end = time.time()
     for i, (input, target) in enumerate(val_loader):
-        target = target.cuda(async=True)
-        input_var = torch.autograd.Variable(input, volatile=True)
-        target_var = torch.autograd.Variable(target, volatile=True)
+        if torch.cuda.is_available():
+            target = target.cuda(non_blocking=True)
 
         # compute output
-        output = model(input_var)
-        loss = criterion(output, target_var)
+        with torch.no_grad():
+            output = model(input)
+            loss = criterion(output, target)
 
         # measure accuracy and record loss
-        prec1, prec5 = accuracy(output.data, target, topk=(1,5))
+        prec1, prec5 = accuracy(output, target, topk=(1,5))
 
-        losses.update(loss.data[0], input.size(0))
-        top1.update(prec1[0], input.size(0))
-        top5.update(prec5[0], input.size(0))
+        losses.update(loss.item(), input.size(0))
+        top1.update(prec1.item(), input.size(0))
+        top5.update(prec5.item(), input.size(0))
 
         # measure elapsed time
         batch_time.update(time.time() - end)
@@ -348,7 +485,8 @@ def accuracy(output, target, topk=(1,)):
 
     res = []
     for k in topk:
-        correct_k = correct[:k].view(-1).float().sum(0)
+        # correct is a transposed view, reshape copies it
+        correct_k = correct[:k].reshape(-1).float().sum(0)
         res.append(correct_k.mul_(100.0 / batch_size))
     return res
 
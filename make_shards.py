@@ -0,0 +1,109 @@
+# convert the videos of a list file into tar shards streamed by
+# shard_dataset.ShardedTSNDataSet
+#
+#   python make_shards.py /data/vision/oliva/scratch/moments/split/rgb_trainingSet_nov17.csv \
+#       /data/vision/oliva/scratch/moments/moments_nov17_frames /path/to/moments_train_shards \
+#       --image_tmpl {:06d}.jpg --videos_per_shard 256 -j 8
+#
+# out_dir gets
+#   videos.txt          list file of the converted videos, in shard order
+#   shards.txt          [shard file, first row in videos.txt, number of videos]
+#   shard-000000.tar    one member per video, <row>.pack, holding all its frames
+#                       in the frame_storage pack layout
+# The videos are shuffled (--seed) before they are cut into shards, so every
+# shard mixes the classes of list files sorted by class. Videos the dataset
+# would skip (fewer than 3 frames, or no first frame) are left out.
+import os
+import io
+import time
+import tarfile
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from manifest import load_manifest
+from frame_storage import return_storage, pack_bytes
+
+VIDEOS_FILE = 'videos.txt'
+SHARDS_FILE = 'shards.txt'
+
+
+def _read_video(storage, directory, num_frames):
+    frames = []
+    with storage.open(directory) as reader:
+        for idx in range(1, num_frames + 1):
+            try:
+                frames.append(reader.read_bytes(idx))
+            except (IOError, OSError, IndexError):
+                frames.append(None)
+    return pack_bytes(frames)
+
+
+def write_shard(shard_path, storage, rows, first_row):
+    """rows: [path, num_frames, label] of the videos of the shard"""
+    tmp_path = shard_path + '.tmp'
+    total = 0
+    with tarfile.open(tmp_path, 'w') as tar:
+        for i, (directory, num_frames, label) in enumerate(rows):
+            data = _read_video(storage, directory, num_frames)
+            info = tarfile.TarInfo('%08d.pack' % (first_row + i))
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+            total += len(data)
+    os.rename(tmp_path, shard_path)
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description="convert a list file into tar shards for streaming")
+    parser.add_argument('list_file', type=str)
+    parser.add_argument('root_path', type=str)
+    parser.add_argument('out_dir', type=str)
+    parser.add_argument('--image_tmpl', type=str, default='img_{:05d}.jpg')
+    parser.add_argument('--storage', type=str, default='folder', choices=['folder', 'packed'])
+    parser.add_argument('--pack_root', type=str, default='')
+    parser.add_argument('--videos_per_shard', type=int, default=256)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--workers', default=8, type=int)
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+    storage = return_storage(args.storage, args.root_path, args.image_tmpl, args.pack_root)
+    manifest = load_manifest(args.list_file)
+    manifest = manifest.select(manifest.num_frames >= 3)
+    paths = manifest.paths()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        exists = np.array(list(pool.map(storage.exists, paths)), dtype=bool)
+    order = np.random.RandomState(args.seed).permutation(np.nonzero(exists)[0])
+    rows = [(paths[i], int(manifest.num_frames[i]), int(manifest.labels[i])) for i in order]
+    print('%d/%d videos to convert' % (len(rows), len(paths)))
+
+    with open(os.path.join(args.out_dir, VIDEOS_FILE), 'w') as f:
+        for row in rows:
+            f.write('%s %d %d\n' % row)
+
+    start = time.time()
+    shards = []
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        jobs = []
+        for first_row in range(0, len(rows), args.videos_per_shard):
+            name = 'shard-%06d.tar' % len(shards)
+            shard_rows = rows[first_row:first_row + args.videos_per_shard]
+            shards.append((name, first_row, len(shard_rows)))
+            jobs.append(pool.submit(write_shard, os.path.join(args.out_dir, name),
+                                    storage, shard_rows, first_row))
+        total_bytes = 0
+        for i, job in enumerate(jobs):
+            total_bytes += job.result()
+            print('%d/%d shards' % (i + 1, len(jobs)))
+
+    with open(os.path.join(args.out_dir, SHARDS_FILE), 'w') as f:
+        for shard in shards:
+            f.write('%s %d %d\n' % shard)
+    print('wrote %d shards, %.1f MB in %.1f sec' % (len(shards), total_bytes / 1024. ** 2,
+                                                   time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
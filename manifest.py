@@ -0,0 +1,121 @@
+# compiled, array-backed form of the video list files
+#
+# Each row of a list file is [video_path num_frames class_idx], separated by
+# spaces (ucf101 splits, something/jester videofolder lists) or by commas
+# (moments csv splits); a space separated path can hold spaces, the last two
+# fields are the numbers. The manifest keeps the paths in one byte table plus
+# numpy columns, so a dataset holds a handful of arrays instead of one Python
+# object per video, and DataLoader workers do not duplicate it through
+# copy-on-write. The compiled form is cached next to the list file and rebuilt
+# whenever the list file changes.
+#
+#   python manifest.py video_datasets/something/train_videofolder.txt ...
+import os
+import sys
+import numpy as np
+
+MANIFEST_SUFFIX = '.manifest.npz'
+MANIFEST_VERSION = 1
+
+
+class VideoManifest(object):
+    def __init__(self, path_data, path_begin, path_end, num_frames, labels):
+        self.path_data = path_data
+        self.path_begin = path_begin
+        self.path_end = path_end
+        self.num_frames = num_frames
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.num_frames)
+
+    def path(self, i):
+        return self.path_data[self.path_begin[i]:self.path_end[i]].tobytes().decode('utf-8')
+
+    def paths(self):
+        return [self.path(i) for i in range(len(self))]
+
+    def select(self, rows):
+        """Manifest restricted to rows (bool mask or indices), sharing the path table"""
+        return VideoManifest(self.path_data, self.path_begin[rows], self.path_end[rows],
+                             self.num_frames[rows], self.labels[rows])
+
+    @classmethod
+    def from_rows(cls, rows):
+        encoded = [row[0].encode('utf-8') for row in rows]
+        lengths = np.array([len(x) for x in encoded], dtype=np.int64)
+        path_end = np.cumsum(lengths)
+        path_begin = path_end - lengths
+        path_data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+        num_frames = np.array([int(row[1]) for row in rows], dtype=np.int32)
+        labels = np.array([int(row[2]) for row in rows], dtype=np.int32)
+        return cls(path_data, path_begin, path_end, num_frames, labels)
+
+    def save(self, f, source_stat=None):
+        mtime, size = source_stat if source_stat is not None else (0., 0)
+        np.savez(f, version=MANIFEST_VERSION, source_mtime=mtime, source_size=size,
+                 path_data=self.path_data, path_begin=self.path_begin,
+                 path_end=self.path_end, num_frames=self.num_frames, labels=self.labels)
+
+
+def _split_row(line):
+    if ',' in line:
+        row = line.split(',')
+        # a csv row, also when its path holds spaces
+        if ' ' not in line or row[1].isdigit():
+            return row
+    # the last two fields are numbers, the folder name can hold spaces
+    return line.rsplit(' ', 2)
+
+
+def parse_list_file(list_file):
+    rows = []
+    with open(list_file) as f:
+        for i, line in enumerate(f):
+            line = line.strip()
+            if not line:
+                continue
+            row = _split_row(line)
+            if i == 0 and not row[1].isdigit():
+                # csv header
+                continue
+            rows.append(row)
+    return VideoManifest.from_rows(rows)
+
+
+def _source_stat(list_file):
+    st = os.stat(list_file)
+    return st.st_mtime, st.st_size
+
+
+def load_manifest(list_file, cache=True):
+    """Load the manifest of list_file, compiling it on the first use"""
+    source_stat = _source_stat(list_file)
+    cache_file = list_file + MANIFEST_SUFFIX
+    if cache and os.path.exists(cache_file):
+        try:
+            with np.load(cache_file) as f:
+                if int(f['version']) == MANIFEST_VERSION and \
+                        (float(f['source_mtime']), int(f['source_size'])) == source_stat:
+                    return VideoManifest(f['path_data'], f['path_begin'], f['path_end'],
+                                         f['num_frames'], f['labels'])
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+
+    manifest = parse_list_file(list_file)
+    if cache:
+        tmp_file = cache_file + '.tmp'
+        try:
+            with open(tmp_file, 'wb') as f:
+                manifest.save(f, source_stat)
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError):
+            # read-only dataset folder, keep the compiled manifest in memory only
+            print('could not cache the manifest of %s' % list_file)
+    return manifest
+
+
+if __name__ == '__main__':
+    for list_file in sys.argv[1:]:
+        manifest = load_manifest(list_file)
+        print('%s: %d videos' % (list_file, len(manifest)))
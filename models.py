@@ -6,6 +6,38 @@ from torch.nn.init import normal, constant
 
 import TRNmodule
 
+
+def input_normalization(base_model, modality, new_length):
+    """(input_size, input_mean, input_std) of the inputs of base_model"""
+    if 'resnet' in base_model or 'vgg' in base_model:
+        input_size = 224
+        input_mean = [0.485, 0.456, 0.406]
+        input_std = [0.229, 0.224, 0.225]
+
+        if modality == 'Flow':
+            input_mean = [0.5]
+            input_std = [np.mean(input_std)]
+        elif modality == 'RGBDiff':
+            input_mean = [0.485, 0.456, 0.406] + [0] * 3 * new_length
+            input_std = input_std + [np.mean(input_std) * 2] * 3 * new_length
+    elif base_model in ['BNInception', 'InceptionV3']:
+        input_size = 224 if base_model == 'BNInception' else 299
+        input_mean = [104, 117, 128]
+        input_std = [1]
+
+        if modality == 'Flow':
+            input_mean = [128]
+        elif modality == 'RGBDiff':
+            input_mean = input_mean * (1 + new_length)
+    elif 'inception' in base_model:
+        input_size = 299
+        input_mean = [0.5]
+        input_std = [0.5]
+    else:
+        raise ValueError('Unknown base model: {}'.format(base_model))
+    return input_size, input_mean, input_std
+
+
 class TSN(nn.Module):
     def __init__(self, num_class, num_segments, modality,
                  base_model='resnet101', new_length=None,
@@ -14,7 +46,8 @@ class TSN(nn.Module):
                  crop_num=1, partial_bn=True, print_spec=True, 
                  bi_add_clf=False, bi_out_dims=101, 
                  bi_rank=1, bi_att_softmax=False, bi_filter_size=1, 
-                 bi_dropout=0., dataset='ucf101'):
+                 bi_dropout=0., dataset='ucf101', 
+                 all_relations=False, max_relations=256):
         super(TSN, self).__init__()
         self.modality = modality
         self.num_segments = num_segments
@@ -53,6 +86,7 @@ class TSN(nn.Module):
             """.format(base_model, self.modality, self.num_segments, self.new_length, consensus_type, self.dropout, self.img_feature_dim)))
 
         self._prepare_base_model(base_model)
+        self._prepare_input_normalization(base_model)
 
         if self.consensus_type == 'bilinear_att':
             print('preparing bilinear_att')
@@ -73,6 +107,9 @@ class TSN(nn.Module):
             # plug in the Temporal Relation Network Module
             self.consensus = TRNmodule.return_TRN(consensus_type, 
                     self.img_feature_dim, self.num_segments, num_class)
+            if all_relations and consensus_type == 'TRNmultiscale':
+                # deterministic eval scores over all the relations (TRN has a single one)
+                self.consensus.set_all_relations(max_relations=max_relations)
         elif consensus_type == 'bilinear_att':
             print('using bilinear_att consensus')
             self.consensus = BilinearAttentionFusion(self.feature_dim, 
@@ -138,49 +175,43 @@ class TSN(nn.Module):
         if 'resnet' in base_model or 'vgg' in base_model:
             self.base_model = getattr(torchvision.models, base_model)(True)
             self.base_model.last_layer_name = 'fc'
-            self.input_size = 224
-            self.input_mean = [0.485, 0.456, 0.406]
-            self.input_std = [0.229, 0.224, 0.225]
-
-            if self.modality == 'Flow':
-                self.input_mean = [0.5]
-                self.input_std = [np.mean(self.input_std)]
-            elif self.modality == 'RGBDiff':
-                self.input_mean = [0.485, 0.456, 0.406] + [0] * 3 * self.new_length
-                self.input_std = self.input_std + [np.mean(self.input_std) * 2] * 3 * self.new_length
         elif base_model == 'BNInception':
             import model_zoo
             self.base_model = getattr(model_zoo, base_model)()
             self.base_model.last_layer_name = 'fc'
-            self.input_size = 224
-            self.input_mean = [104, 117, 128]
-            self.input_std = [1]
-
-            if self.modality == 'Flow':
-                self.input_mean = [128]
-            elif self.modality == 'RGBDiff':
-                self.input_mean = self.input_mean * (1 + self.new_length)
         elif base_model == 'InceptionV3':
             import model_zoo
             self.base_model = getattr(model_zoo, base_model)()
             self.base_model.last_layer_name = 'top_cls_fc'
-            self.input_size = 299
-            self.input_mean = [104,117,128]
-            self.input_std = [1]
-            if self.modality == 'Flow':
-                self.input_mean = [128]
-            elif self.modality == 'RGBDiff':
-                self.input_mean = self.input_mean * (1+self.new_length)
-
         elif 'inception' in base_model:
             import model_zoo
             self.base_model = getattr(model_zoo, base_model)()
             self.base_model.last_layer_name = 'classif'
-            self.input_size = 299
-            self.input_mean = [0.5]
-            self.input_std = [0.5]
         else:
             raise ValueError('Unknown base model: {}'.format(base_model))
+        self.input_size, self.input_mean, self.input_std = input_normalization(
+            base_model, self.modality, self.new_length)
+
+    def _prepare_input_normalization(self, base_model):
+        # uint8 clips (ToTorchFormatTensor(uint8=True)) are normalized at the
+        # start of forward, as main.py would in the loader:
+        # (x [/ 255] - mean) / std, folded into x * scale + shift
+        div = base_model not in ['BNInception', 'InceptionV3']
+        if self.modality == 'RGBDiff':
+            # no mean/std for RGBDiff, see main.py
+            mean, std = np.zeros(1), np.ones(1)
+        else:
+            mean = np.array(self.input_mean, dtype=np.float64)
+            std = np.array(self.input_std, dtype=np.float64) * np.ones_like(mean)
+        scale = 1. / std / (255. if div else 1.)
+        shift = -mean / std
+        self.register_buffer('input_scale', torch.FloatTensor(scale).view(1, -1, 1, 1), persistent=False)
+        self.register_buffer('input_shift', torch.FloatTensor(shift).view(1, -1, 1, 1), persistent=False)
+
+    def _normalize_input(self, input):
+        c = self.input_scale.size(1)
+        x = input.view((-1, c) + input.size()[-2:]).float()
+        return torch.addcmul(self.input_shift, x, self.input_scale).view(input.size())
 
     def train(self, mode=True):
         """
@@ -255,14 +286,20 @@ class TSN(nn.Module):
              'name': "BN scale/shift"},
         ]
 
-    def forward(self, input):
+    def features(self, input):
+        """base_model output of every frame of input (uint8 or normalized), the input of new_fc"""
+        if input.dtype == torch.uint8:
+            input = self._normalize_input(input)
         sample_len = (3 if self.modality == "RGB" else 2) * self.new_length
 
         if self.modality == 'RGBDiff':
             sample_len = 3 * self.new_length
             input = self._get_diff(input)
 
-        base_out = self.base_model(input.view((-1, sample_len) + input.size()[-2:]))
+        return self.base_model(input.view((-1, sample_len) + input.size()[-2:]))
+
+    def forward(self, input):
+        base_out = self.features(input)
         if self.consensus_type == 'bilinear_att':
             output = self.bi_att_forward(base_out)
         else:
@@ -373,7 +410,13 @@ class TSN(nn.Module):
     def scale_size(self):
         return self.input_size * 256 // 224
 
-    def get_augmentation(self):
+    def get_augmentation(self, tensor=False):
+        if tensor:
+            # same augmentation on a stacked clip tensor, see tensor_transforms.py
+            from tensor_transforms import ClipMultiScaleCrop, ClipRandomHorizontalFlip
+            scales = [1, .875, .75, .66] if self.modality == 'RGB' else [1, .875, .75]
+            return torchvision.transforms.Compose([ClipMultiScaleCrop(self.input_size, scales),
+                                                   ClipRandomHorizontalFlip(is_flow=self.modality == 'Flow')])
         if self.modality == 'RGB':
             return torchvision.transforms.Compose([GroupMultiScaleCrop(self.input_size, [1, .875, .75, .66]),
                                                    GroupRandomHorizontalFlip(is_flow=False)])
@@ -383,3 +426,71 @@ class TSN(nn.Module):
         elif self.modality == 'RGBDiff':
             return torchvision.transforms.Compose([GroupMultiScaleCrop(self.input_size, [1, .875, .75]),
                                                    GroupRandomHorizontalFlip(is_flow=False)])
+
+    def head(self):
+        """new_fc and the consensus alone, on base_model features (see feature_store.py)"""
+        if self.new_fc is None or self.consensus_type == 'bilinear_att':
+            raise ValueError('the head needs new_fc (dropout > 0) and a segment consensus')
+        return TSNHead(self)
+
+
+def load_tsn_state(model, state_dict):
+    """load_state_dict across TSN and TSNHead checkpoints, only the
+    base_model.* weights may be left over (a TSN checkpoint into a head) or
+    missing (a head checkpoint into a TSN, which keeps its pretrained
+    base_model); the keys may start with module. (DataParallel)"""
+    def in_base(key):
+        return key.split('module.', 1)[-1].startswith('base_model.')
+    model_has_base = any(in_base(k) for k in model.state_dict())
+    state_has_base = any(in_base(k) for k in state_dict)
+    result = model.load_state_dict(state_dict, strict=False)
+    # a TSN takes all of a TSN checkpoint, a head leaves its base_model out
+    bad = [k for k in result.unexpected_keys if model_has_base or not in_base(k)]
+    # a TSN checkpoint fills all of a TSN, a head checkpoint all but base_model
+    bad += [k for k in result.missing_keys if state_has_base or not in_base(k)]
+    if bad:
+        raise RuntimeError('checkpoint does not match the model, keys: ' + ', '.join(bad))
+    return result
+
+
+class TSNHead(nn.Module):
+    # the part of TSN after base_model, its parameters keep the names they
+    # have in TSN (new_fc.*, consensus.*) so the checkpoints load both ways
+    # through load_tsn_state
+    def __init__(self, tsn):
+        super(TSNHead, self).__init__()
+        self.num_segments = tsn.num_segments
+        self.before_softmax = tsn.before_softmax
+        # the last layer of base_model
+        self.dropout = nn.Dropout(p=tsn.dropout)
+        self.new_fc = tsn.new_fc
+        self.consensus = tsn.consensus
+        if not self.before_softmax:
+            self.softmax = nn.Softmax()
+
+    def forward(self, input):
+        # (batch, num_segments, feature_dim) features of the segments
+        base_out = self.new_fc(self.dropout(input.view(-1, input.size(-1))))
+        if not self.before_softmax:
+            base_out = self.softmax(base_out)
+        base_out = base_out.view((-1, self.num_segments) + base_out.size()[1:])
+        return self.consensus(base_out).squeeze(1)
+
+    def partialBN(self, enable):
+        # no BatchNorm in the head
+        pass
+
+    def get_optim_policies(self):
+        weight = []
+        bias = []
+        for m in self.modules():
+            if isinstance(m, torch.nn.Linear):
+                weight.append(m.weight)
+                if m.bias is not None:
+                    bias.append(m.bias)
+            elif len(m._modules) == 0 and len(list(m.parameters())) > 0:
+                raise ValueError("New atomic module type: {}. Need to give it a learning policy".format(type(m)))
+        return [
+            {'params': weight, 'lr_mult': 1, 'decay_mult': 1, 'name': "normal_weight"},
+            {'params': bias, 'lr_mult': 2, 'decay_mult': 0, 'name': "normal_bias"},
+        ]
@@ -84,6 +84,48 @@ parser.add_argument('--start-epoch', default=0, type=int, metavar='N',
                     help='manual epoch number (useful on restarts)')
 parser.add_argument('--gpus', nargs='+', type=int, default=None)
 parser.add_argument('--flow_prefix', default="", type=str)
+parser.add_argument('--flow_format', type=str, default='rgb', choices=['rgb', 'xy'],
+                    help="flow frames as (x, y, blank) RGB JPEGs or as 'xy' frames written by convert_flow.py")
+parser.add_argument('--storage', type=str, default='folder', choices=['folder', 'packed', 'video'],
+                    help='read frames from image folders, from packs written by pack_frames.py or from video files')
+parser.add_argument('--pack_root', type=str, default='',
+                    help='root of the frame packs when --storage packed')
+parser.add_argument('--video_ext', type=str, default='',
+                    help='appended to the list paths when --storage video, e.g. .mp4')
+parser.add_argument('--preflight', default=False, action='store_true',
+                    help='scan the videos once at startup and skip the per-sample existence checks')
+parser.add_argument('--preflight_verify', default=False, action='store_true',
+                    help='also decode every frame during the preflight scan')
+parser.add_argument('--draft_decode', default=False, action='store_true',
+                    help='decode JPEGs at a reduced size that still covers the input transform')
+parser.add_argument('--decoder', type=str, default='pil', choices=['pil', 'cv2', 'turbojpeg', 'auto'],
+                    help="JPEG decoder, 'auto' times the available ones on frames of the lists")
+parser.add_argument('--train_shards', type=str, default='',
+                    help='stream the training set from this directory of make_shards.py shards')
+parser.add_argument('--shuffle_buffer', type=int, default=1000,
+                    help='videos held in the shuffle buffer when streaming shards')
+parser.add_argument('--train_features', type=str, default='',
+                    help='train new_fc and the consensus alone on this store of extract_features.py')
+parser.add_argument('--val_features', type=str, default='',
+                    help='feature store of the val list, with --train_features')
+parser.add_argument('--val_cache_dir', type=str, default='',
+                    help='keep the transformed val clips in a memory-mapped file in this directory')
+parser.add_argument('--persistent_workers', default=False, action='store_true',
+                    help='one pool of loader workers for training and validation, kept for the whole run')
+parser.add_argument('--prefetch_factor', type=int, default=2,
+                    help='batches loaded in advance by each loader worker')
+parser.add_argument('--fetch_threads', type=int, default=1,
+                    help='threads of each loader worker reading the frames of a sample')
+parser.add_argument('--preload_mb', type=int, default=0,
+                    help='read up to this many MB of compressed frames of each list into memory at startup')
+parser.add_argument('--frame_cache_mb', type=int, default=0,
+                    help='shared memory budget (MB) of the decoded frame cache of the workers, 0 disables it')
+parser.add_argument('--cache_prescale', default=False, action='store_true',
+                    help='scale the frames down to the size the transform needs before caching them')
+parser.add_argument('--tensor_transforms', default=False, action='store_true',
+                    help='run the augmentation on stacked clip tensors instead of lists of PIL images')
+parser.add_argument('--uint8_input', default=False, action='store_true',
+                    help='load uint8 clips and normalize them in the model')
 parser.add_argument('--root_log',type=str, default='log')
 parser.add_argument('--root_model', type=str, default='model')
 parser.add_argument('--root_output',type=str, default='output')
@@ -0,0 +1,73 @@
+# pack the extracted frames of every video in a list file into one file per
+# video, to be read by TSNDataSet through frame_storage.PackedFrameStore
+#
+#   python pack_frames.py video_datasets/something/train_videofolder.txt \
+#       /path/to/20bn-something-something-v1 /path/to/something_packed \
+#       --image_tmpl {:05d}.jpg -j 16
+#
+# Videos that already have a pack are skipped, so an interrupted run can be
+# restarted with the same command.
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from frame_storage import PackedFrameStore, write_pack
+from manifest import load_manifest
+
+
+def pack_video(store, root_path, image_tmpl, directory, num_frames):
+    pack_path = store.pack_path(directory)
+    if os.path.exists(pack_path):
+        return 0
+    # like FolderFrameStore.exists, a video without its first frame is left out
+    if not os.path.exists(os.path.join(root_path, directory, image_tmpl.format(1))):
+        return 0
+    dirname = os.path.dirname(pack_path)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            pass
+    frame_files = []
+    idx = 1
+    while True:
+        frame_file = os.path.join(root_path, directory, image_tmpl.format(idx))
+        if os.path.exists(frame_file):
+            frame_files.append(frame_file)
+        elif idx <= num_frames:
+            frame_files.append(None)
+        else:
+            break
+        idx += 1
+    return write_pack(pack_path, frame_files)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="pack per-video frames into single files")
+    parser.add_argument('list_file', type=str)
+    parser.add_argument('root_path', type=str)
+    parser.add_argument('pack_root', type=str)
+    parser.add_argument('--image_tmpl', type=str, default='img_{:05d}.jpg')
+    parser.add_argument('-j', '--workers', default=8, type=int)
+    args = parser.parse_args()
+
+    # the rows TSNDataSet reads, csv lists included
+    manifest = load_manifest(args.list_file)
+    store = PackedFrameStore(args.pack_root)
+
+    start = time.time()
+    total_bytes = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        jobs = [pool.submit(pack_video, store, args.root_path, args.image_tmpl,
+                            manifest.path(i), int(manifest.num_frames[i])) for i in range(len(manifest))]
+        for i, job in enumerate(jobs):
+            total_bytes += job.result()
+            if i % 1000 == 0:
+                print('%d/%d' % (i, len(manifest)))
+    print('packed %d videos, %.1f MB in %.1f sec' % (len(manifest),
+          total_bytes / 1024. ** 2, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
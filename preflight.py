@@ -0,0 +1,196 @@
+# startup scan of the frames referenced by a list file
+#
+# The scan runs once over every video with a thread pool and records which
+# videos are usable (their first frame is present) and which frames are
+# missing or corrupt. TSNDataSet drops the unusable videos and remaps the bad
+# frames up front, so __getitem__ never has to stat the filesystem. The index is
+# cached next to the list file; on the next run only the videos whose folder
+# (or pack) changed since are scanned again. The warm check is one stat per
+# video; with --verify it also covers the size and mtime of every frame file,
+# since a frame overwritten in place can turn corrupt without touching its
+# folder, see the signature() of the stores.
+#
+#   python preflight.py video_datasets/something/train_videofolder.txt \
+#       /path/to/20bn-something-something-v1 --image_tmpl {:05d}.jpg --verify
+import os
+import time
+import hashlib
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+BAD_MISSING = 0
+BAD_CORRUPT = 1
+_REASONS = {BAD_MISSING: 'missing', BAD_CORRUPT: 'corrupt'}
+
+
+class FrameIndex(object):
+    def __init__(self, signatures, valid, bad_video, bad_frame, bad_reason):
+        self.signatures = signatures
+        self.valid = valid
+        self.bad_video = bad_video
+        self.bad_frame = bad_frame
+        self.bad_reason = bad_reason
+
+    def bad_frames(self, manifest):
+        """{video path: frozenset of bad frame indices} for the usable videos"""
+        ret = {}
+        for video in np.unique(self.bad_video):
+            if self.valid[video]:
+                ret[manifest.path(video)] = frozenset(self.bad_frame[self.bad_video == video].tolist())
+        return ret
+
+    def summary(self):
+        return '%d/%d videos usable, %d missing and %d corrupt frames' % (
+            int(self.valid.sum()), len(self.valid),
+            int((self.bad_reason == BAD_MISSING).sum()),
+            int((self.bad_reason == BAD_CORRUPT).sum()))
+
+    def write_report(self, manifest, report_file):
+        with open(report_file, 'w') as f:
+            f.write(self.summary() + '\n')
+            for video in np.nonzero(~self.valid)[0]:
+                f.write('%s unusable\n' % manifest.path(video))
+            for video, frame, reason in zip(self.bad_video, self.bad_frame, self.bad_reason):
+                f.write('%s %d %s\n' % (manifest.path(video), frame, _REASONS[int(reason)]))
+
+
+def _scan_video(storage, directory, num_frames, verify):
+    signature = storage.signature(directory, verify)
+    present = storage.list_frames(directory, num_frames)
+    present_set = set(present)
+    missing = [i for i in range(1, num_frames + 1) if i not in present_set]
+    corrupt = []
+    if verify and present:
+        with storage.open(directory) as reader:
+            for i in present:
+                try:
+                    if hasattr(reader, 'decode'):
+                        reader.decode(i)
+                    else:
+                        Image.open(reader.read(i)).load()
+                except Exception:
+                    corrupt.append(i)
+    return signature, missing, corrupt
+
+
+def _manifest_digest(manifest):
+    h = hashlib.md5()
+    for column in (manifest.path_data, manifest.path_begin, manifest.path_end, manifest.num_frames):
+        h.update(np.ascontiguousarray(column).tobytes())
+    return h.hexdigest()
+
+
+def _load_index(cache_file, key, digest):
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as f:
+            if str(f['key']) != key or str(f['digest']) != digest:
+                return None
+            return FrameIndex(f['signatures'], f['valid'], f['bad_video'],
+                              f['bad_frame'], f['bad_reason'])
+    except (IOError, OSError, ValueError, KeyError):
+        return None
+
+
+def _save_index(cache_file, key, digest, index):
+    tmp_file = cache_file + '.tmp'
+    try:
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, key=key, digest=digest, signatures=index.signatures,
+                     valid=index.valid, bad_video=index.bad_video,
+                     bad_frame=index.bad_frame, bad_reason=index.bad_reason)
+        os.rename(tmp_file, cache_file)
+    except (IOError, OSError):
+        print('could not cache the preflight index %s' % cache_file)
+
+
+def scan_videos(list_file, manifest, storage, workers=16, verify=False, cache=True):
+    """Build (or refresh) the frame index of the videos in manifest.
+
+    With verify=True every present frame is also decoded to find corrupt
+    files; otherwise only their presence is checked.
+    """
+    start = time.time()
+    key = '%s|verify=%d' % (storage.describe(), int(verify))
+    digest = _manifest_digest(manifest)
+    cache_file = '%s.scan-%s.npz' % (list_file, hashlib.md5(key.encode('utf-8')).hexdigest()[:8])
+    old = _load_index(cache_file, key, digest) if cache else None
+
+    paths = manifest.paths()
+    num_frames = manifest.num_frames.tolist()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        if old is not None:
+            signatures = np.array(list(pool.map(lambda p: storage.signature(p, verify), paths)), dtype=np.float64)
+            todo = np.nonzero(signatures != old.signatures)[0]
+            if len(todo) == 0:
+                print('preflight: reusing %s (%s)' % (cache_file, old.summary()))
+                return old
+        else:
+            todo = np.arange(len(paths))
+        results = list(pool.map(lambda i: _scan_video(storage, paths[i], num_frames[i], verify), todo))
+
+    if old is not None:
+        signatures = old.signatures.copy()
+        valid = old.valid.copy()
+        keep = ~np.isin(old.bad_video, todo)
+        bad_video = [old.bad_video[keep]]
+        bad_frame = [old.bad_frame[keep]]
+        bad_reason = [old.bad_reason[keep]]
+    else:
+        signatures = np.zeros(len(paths), dtype=np.float64)
+        valid = np.zeros(len(paths), dtype=bool)
+        bad_video, bad_frame, bad_reason = [], [], []
+    for i, (signature, missing, corrupt) in zip(todo, results):
+        signatures[i] = signature
+        valid[i] = 1 not in missing and 1 not in corrupt
+        bad = missing + corrupt
+        bad_video.append(np.full(len(bad), i, dtype=np.int32))
+        bad_frame.append(np.array(bad, dtype=np.int32))
+        bad_reason.append(np.array([BAD_MISSING] * len(missing) + [BAD_CORRUPT] * len(corrupt), dtype=np.int8))
+
+    index = FrameIndex(signatures, valid,
+                       np.concatenate(bad_video + [np.zeros(0, np.int32)]),
+                       np.concatenate(bad_frame + [np.zeros(0, np.int32)]),
+                       np.concatenate(bad_reason + [np.zeros(0, np.int8)]))
+    print('preflight: scanned %d/%d videos in %.1f sec, %s' % (len(todo), len(paths),
+          time.time() - start, index.summary()))
+    if cache:
+        _save_index(cache_file, key, digest, index)
+        index.write_report(manifest, cache_file[:-len('.npz')] + '.txt')
+    return index
+
+
+def main():
+    from manifest import load_manifest
+    from frame_storage import return_storage
+
+    parser = argparse.ArgumentParser(description="scan the frames of a list file for missing and corrupt files")
+    parser.add_argument('list_file', type=str)
+    parser.add_argument('root_path', type=str)
+    parser.add_argument('--image_tmpl', type=str, default='img_{:05d}.jpg')
+    parser.add_argument('--storage', type=str, default='folder', choices=['folder', 'packed', 'video'])
+    parser.add_argument('--pack_root', type=str, default='')
+    parser.add_argument('--video_ext', type=str, default='')
+    parser.add_argument('--modality', type=str, default='RGB', choices=['RGB', 'Flow', 'RGBDiff'])
+    parser.add_argument('--verify', default=False, action='store_true',
+                        help='decode every frame to find corrupt files')
+    parser.add_argument('--report', type=str, default=None)
+    parser.add_argument('-j', '--workers', default=16, type=int)
+    args = parser.parse_args()
+
+    # same filtering as TSNDataSet._parse_list
+    manifest = load_manifest(args.list_file)
+    manifest = manifest.select(manifest.num_frames >= 3)
+    if args.modality == 'Flow':
+        manifest.num_frames = manifest.num_frames - 1
+    storage = return_storage(args.storage, args.root_path, args.image_tmpl, args.pack_root, args.video_ext)
+    index = scan_videos(args.list_file, manifest, storage, args.workers, args.verify)
+    if args.report is not None:
+        index.write_report(manifest, args.report)
+
+
+if __name__ == '__main__':
+    main()
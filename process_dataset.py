@@ -3,13 +3,29 @@
 #   category.txt:               the list of categories.
 #   train_videofolder.txt:      each row contains [videoname num_frames classIDX]
 #   val_videofolder.txt:        same as above
+#   short_videofolders.txt:     the videos with fewer than 3 frames, which
+#                               TSNDataSet leaves out
+#
+# The frames of the video folders are counted with a thread pool, and the
+# counts are cached in frame_counts.cache with the folder mtime: running the
+# script again only rescans the folders that changed.
 #
 # Bolei Zhou, Dec.2 2017
 #
 #
 import os
-import pdb
-dataset_name = 'something-something-v1' # 'jester-v1'
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+parser = argparse.ArgumentParser(description="generate the category and videofolder lists")
+parser.add_argument('--dataset_name', type=str, default='something-something-v1') # 'jester-v1'
+parser.add_argument('-j', '--workers', type=int, default=32)
+args = parser.parse_args()
+dataset_name = args.dataset_name
+cache_file = 'frame_counts.cache'
+# TSNDataSet._parse_list keeps the videos with at least that many frames
+min_frames = 3
+
 with open('%s-labels.csv'% dataset_name) as f:
     lines = f.readlines()
 categories = []
@@ -24,25 +40,71 @@ dict_categories = {}
 for i, category in enumerate(categories):
     dict_categories[category] = i
 
+# folder -> (mtime, number of frames) of the previous run
+cache = {}
+if os.path.exists(cache_file):
+    with open(cache_file) as f:
+        for line in f:
+            items = line.rstrip('\n').rsplit(' ', 2)
+            if len(items) == 3:
+                cache[items[0]] = (float(items[1]), int(items[2]))
+
+
+def count_frames(folder):
+    # counting the number of frames in each video folders
+    path = os.path.join('20bn-%s'%dataset_name, folder)
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return folder, -1., 0, True
+    cached = cache.get(folder)
+    if cached is not None and cached[0] == mtime:
+        return folder, mtime, cached[1], False
+    num_frames = 0
+    # closed right away, not when the iterator is collected
+    with os.scandir(path) as it:
+        for entry in it:
+            num_frames += 1
+    return folder, mtime, num_frames, True
+
+
 files_input = ['%s-validation.csv'%dataset_name,'%s-train.csv'%dataset_name]
 files_output = ['val_videofolder.txt','train_videofolder.txt']
-for (filename_input, filename_output) in zip(files_input, files_output):
-    with open(filename_input) as f:
-        lines = f.readlines()
-    folders = []
-    idx_categories = []
-    for line in lines:
-        line = line.rstrip()
-        items = line.split(';')
-        folders.append(items[0])
-        idx_categories.append(os.path.join(dict_categories[items[1]]))
-    output = []
-    for i in range(len(folders)):
-        curFolder = folders[i]
-        curIDX = idx_categories[i]
-        # counting the number of frames in each video folders
-        dir_files = os.listdir(os.path.join('20bn-%s'%dataset_name, curFolder))
-        output.append('%s %d %d'%(curFolder, len(dir_files), curIDX))
-        print('%d/%d'%(i, len(folders)))
-    with open(filename_output,'w') as f:
-        f.write('\n'.join(output))
+counts = {}
+short = []
+with ThreadPoolExecutor(max_workers=args.workers) as pool:
+    for (filename_input, filename_output) in zip(files_input, files_output):
+        with open(filename_input) as f:
+            lines = f.readlines()
+        folders = []
+        idx_categories = []
+        for line in lines:
+            line = line.rstrip()
+            items = line.split(';')
+            folders.append(items[0])
+            idx_categories.append(dict_categories[items[1]])
+        output = []
+        rescanned = 0
+        for i, (curFolder, mtime, num_frames, scanned) in enumerate(pool.map(count_frames, folders)):
+            curIDX = idx_categories[i]
+            counts[curFolder] = (mtime, num_frames)
+            rescanned += scanned
+            if num_frames < min_frames:
+                short.append((filename_output, curFolder, num_frames))
+            output.append('%s %d %d'%(curFolder, num_frames, curIDX))
+        print('%s: %d videos, %d folders scanned, %d from the cache'%(filename_output,
+              len(folders), rescanned, len(folders) - rescanned))
+        with open(filename_output,'w') as f:
+            f.write('\n'.join(output))
+
+with open(cache_file + '.tmp', 'w') as f:
+    for folder, (mtime, num_frames) in counts.items():
+        if mtime >= 0:
+            f.write('%s %r %d\n'%(folder, mtime, num_frames))
+os.rename(cache_file + '.tmp', cache_file)
+
+with open('short_videofolders.txt', 'w') as f:
+    for filename_output, folder, num_frames in short:
+        f.write('%s %s %d\n'%(filename_output, folder, num_frames))
+print('%d videos with no frames, %d with 1 to %d frames (left out by TSNDataSet), see short_videofolders.txt'%(
+    sum(1 for x in short if x[2] == 0), sum(1 for x in short if x[2] > 0), min_frames - 1))
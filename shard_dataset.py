@@ -0,0 +1,132 @@
+# streaming counterpart of TSNDataSet over the tar shards of make_shards.py
+#
+# Each shard is read sequentially, one member (the pack of one video) after the
+# other, instead of opening frame files at random. For training the order comes
+# from a per-epoch permutation of the shards plus a bounded shuffle buffer of
+# packed videos; val/test stream the shards in order. The shards are split
+# between the distributed ranks first and between the DataLoader workers of a
+# rank second, both deterministically from (seed, epoch), so no video is read
+# twice in an epoch. Sampling, decoding, temp_transform and transform are the
+# ones of TSNDataSet.
+import os
+import math
+import tarfile
+import numpy as np
+import torch
+import torch.utils.data as data
+
+from dataset import TSNDataSet
+from manifest import load_manifest
+from frame_storage import PackedFrameReader
+from make_shards import VIDEOS_FILE, SHARDS_FILE
+
+
+class _ShardVideoStore(object):
+    """The packs of the videos being decoded, read like any other store"""
+    def __init__(self):
+        self.videos = {}
+
+    def exists(self, directory):
+        return directory in self.videos
+
+    def open(self, directory):
+        return PackedFrameReader(directory, data=self.videos[directory])
+
+    def describe(self):
+        return 'shards'
+
+
+class ShardedTSNDataSet(TSNDataSet, data.IterableDataset):
+    def __init__(self, shard_dir, num_segments=3, new_length=1, modality='RGB',
+                 shuffle_buffer=1000, seed=0, rank=None, world_size=None, **kwargs):
+        self.shard_dir = shard_dir
+        self.shards = [x.strip().split(' ')[0] for x in open(os.path.join(shard_dir, SHARDS_FILE)) if x.strip()]
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+        if rank is None:
+            if torch.distributed.is_available() and torch.distributed.is_initialized():
+                rank, world_size = torch.distributed.get_rank(), torch.distributed.get_world_size()
+            else:
+                rank, world_size = 0, 1
+        self.rank = rank
+        self.world_size = world_size
+        super(ShardedTSNDataSet, self).__init__(shard_dir, os.path.join(shard_dir, VIDEOS_FILE),
+                                                num_segments=num_segments, new_length=new_length,
+                                                modality=modality, storage=_ShardVideoStore(),
+                                                **kwargs)
+
+    def _parse_list(self):
+        # the rows of videos.txt are the member names of the shards, they are
+        # not filtered (make_shards.py left the unusable videos out already)
+        manifest = load_manifest(self.list_file)
+        if self.modality == 'Flow':
+            manifest.num_frames = manifest.num_frames - 1
+        self.manifest = manifest
+        print('video number:%d in %d shards' % (len(self.manifest), len(self.shards)))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def plan_epoch(self, rng=None):
+        # train offsets are drawn per video while streaming, an epoch only
+        # reseeds the shard order and the sampling
+        self.epoch += 1
+
+    def _epoch_shards(self):
+        if self.sampling != 'train':
+            return list(self.shards)
+        order = np.random.RandomState([self.seed, self.epoch]).permutation(len(self.shards))
+        return [self.shards[i] for i in order]
+
+    def _read_shards(self, shards):
+        for name in shards:
+            # 'r|': a single sequential pass over the file
+            with tarfile.open(os.path.join(self.shard_dir, name), 'r|') as tar:
+                for member in tar:
+                    if member.name.endswith('.pack'):
+                        yield int(member.name[:-len('.pack')]), tar.extractfile(member).read()
+
+    def _shuffled(self, videos, rng):
+        if self.sampling != 'train' or self.shuffle_buffer <= 1:
+            for video in videos:
+                yield video
+            return
+        buffer = []
+        for video in videos:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(video)
+                continue
+            i = rng.randint(len(buffer))
+            buffer[i], video = video, buffer[i]
+            yield video
+        rng.shuffle(buffer)
+        for video in buffer:
+            yield video
+
+    def _stream_sample(self, row, pack, rng):
+        record = self._get_record(row)
+        if self._plan is not None:
+            idx_list = self._plan[row].reshape(-1).tolist()
+        else:
+            idx_list = self.planner.plan([record.num_frames], self.sampling, rng)[0].reshape(-1).tolist()
+        self.storage.videos = {record.path: pack}
+        try:
+            return self._get_sample(record, idx_list)
+        finally:
+            self.storage.videos = {}
+
+    def __iter__(self):
+        worker = data.get_worker_info()
+        worker_id, num_workers = (0, 1) if worker is None else (worker.id, worker.num_workers)
+        shards = self._epoch_shards()[self.rank::self.world_size][worker_id::num_workers]
+        rng = np.random.RandomState([self.seed, self.epoch, self.rank, worker_id])
+        for row, pack in self._shuffled(self._read_shards(shards), rng):
+            yield self._stream_sample(row, pack, rng)
+
+    def __getitem__(self, index):
+        raise TypeError('ShardedTSNDataSet is streamed, iterate over it')
+
+    def __len__(self):
+        # videos per rank, the shards are not split exactly evenly
+        return int(math.ceil(len(self.manifest) / float(self.world_size)))
@@ -0,0 +1,107 @@
+# one pool of DataLoader workers for the training and the validation set
+#
+# A DataLoader starts its workers on every iter() (each epoch, each
+# validation), and every worker imports torch and unpickles the dataset again.
+# SharedWorkerLoader runs a single DataLoader with persistent workers over
+# ConcatDataset([train, val]); the batch sampler only draws indices of the
+# phase being iterated, so the same workers serve both sets for the whole run:
+#
+#   loader = SharedWorkerLoader([train_dataset, val_dataset], batch_size,
+#                               shuffle=[True, False], num_workers=30)
+#   train_loader, val_loader = loader.phase(0, 'train'), loader.phase(1, 'val')
+#
+# The workers keep the datasets they started with, so the training plan is
+# moved to shared memory (TSNDataSet.share_plan) for plan_epoch() to reach
+# them. TimedLoader logs how long the first batch of every iteration takes,
+# which is where the worker startup shows.
+import math
+import time
+import torch
+import torch.utils.data as data
+
+
+class TimedLoader(object):
+    """Iterates over loader, printing the wait for the first batch"""
+    def __init__(self, loader, name):
+        self.loader = loader
+        self.name = name
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _workers_running(self):
+        return getattr(self.loader, '_iterator', None) is not None
+
+    def __iter__(self):
+        status = 'reusing workers' if self._workers_running() else \
+                'starting %d workers' % self.loader.num_workers
+        start = time.time()
+        for i, batch in enumerate(self.loader):
+            if i == 0:
+                print('%s loader: first batch after %.2f sec (%s)' % (self.name, time.time() - start, status))
+            yield batch
+
+
+class PhaseBatchSampler(data.Sampler):
+    """Batches of indices into ConcatDataset(datasets), of datasets[phase] only"""
+    def __init__(self, lengths, batch_size, shuffle):
+        self.lengths = list(lengths)
+        self.offsets = [sum(self.lengths[:i]) for i in range(len(self.lengths))]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.phase = 0
+
+    def __iter__(self):
+        n = self.lengths[self.phase]
+        order = torch.randperm(n).tolist() if self.shuffle[self.phase] else range(n)
+        offset = self.offsets[self.phase]
+        batch = []
+        for i in order:
+            batch.append(offset + i)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def __len__(self):
+        return int(math.ceil(self.lengths[self.phase] / float(self.batch_size)))
+
+
+class SharedWorkerLoader(object):
+    def __init__(self, datasets, batch_size, shuffle, num_workers, prefetch_factor=2, pin_memory=True):
+        self.datasets = datasets
+        for dataset in datasets:
+            if hasattr(dataset, 'share_plan'):
+                dataset.share_plan()
+        self.batch_sampler = PhaseBatchSampler([len(d) for d in datasets], batch_size, shuffle)
+        self.loader = data.DataLoader(
+            data.ConcatDataset(datasets), batch_sampler=self.batch_sampler,
+            num_workers=num_workers, pin_memory=pin_memory, persistent_workers=num_workers > 0,
+            prefetch_factor=prefetch_factor if num_workers > 0 else None)
+
+    def phase(self, phase, name):
+        return _PhaseLoader(self, phase, name)
+
+
+class _PhaseLoader(TimedLoader):
+    def __init__(self, owner, phase, name):
+        super(_PhaseLoader, self).__init__(owner.loader, name)
+        self.owner = owner
+        self.phase = phase
+
+    @property
+    def dataset(self):
+        return self.owner.datasets[self.phase]
+
+    def __len__(self):
+        return int(math.ceil(len(self.dataset) / float(self.owner.batch_sampler.batch_size)))
+
+    def __iter__(self):
+        # the sampler is read by the loader in this process at iter()
+        self.owner.batch_sampler.phase = self.phase
+        return super(_PhaseLoader, self).__iter__()
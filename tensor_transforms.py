@@ -0,0 +1,204 @@
+# tensor counterparts of the group transforms in transforms.py
+#
+# The clip is stacked once into a (N, H, W, C) uint8 tensor, N being the
+# number of images of the group (frames for RGB, x/y planes for Flow with
+# C == 1), and every following step works on the whole clip at once. The
+# results match the PIL pipeline up to resampling rounding:
+#
+#   GroupMultiScaleCrop + GroupRandomHorizontalFlip -> ClipMultiScaleCrop + ClipRandomHorizontalFlip
+#   GroupScale + GroupCenterCrop                    -> ClipScale + ClipCenterCrop
+#   GroupOverSample                                 -> ClipOverSample
+#   Stack + ToTorchFormatTensor + GroupNormalize    -> ClipToTorchFormat + ClipNormalize
+import random
+import numbers
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from transforms import GroupMultiScaleCrop
+
+
+def _resize(clip, size):
+    """Bilinear resize of a (N, H, W, C) uint8 clip to size = (w, h), like PIL"""
+    w, h = size
+    if clip.size(1) == h and clip.size(2) == w:
+        return clip
+    # (N, C, H, W) view of the channels-last data
+    x = clip.permute(0, 3, 1, 2)
+    # antialias follows PIL's bilinear filter when downscaling
+    try:
+        # uint8 kernels work on the channels-last layout directly
+        out = F.interpolate(x, size=(h, w), mode='bilinear', align_corners=False, antialias=True)
+    except (RuntimeError, NotImplementedError):
+        out = F.interpolate(x.float(), size=(h, w), mode='bilinear', align_corners=False, antialias=True)
+        out = out.round_().clamp_(0, 255).byte()
+    return out.permute(0, 2, 3, 1).contiguous()
+
+
+class ToClipTensor(object):
+    """Stack a list of PIL images into a (N, H, W, C) uint8 tensor"""
+    def __call__(self, img_group):
+        clip = np.stack([np.asarray(img) for img in img_group])
+        if clip.ndim == 3:
+            # 'L' images (flow planes)
+            clip = clip[..., None]
+        return torch.from_numpy(clip)
+
+    def decode_size_hint(self):
+        return 0
+
+
+class ClipMultiScaleCrop(GroupMultiScaleCrop):
+    """GroupMultiScaleCrop on a clip tensor. The crop candidates only depend on
+    the image size, so they are computed once per size."""
+    def __init__(self, *args, **kwargs):
+        super(ClipMultiScaleCrop, self).__init__(*args, **kwargs)
+        self._crop_tables = {}
+
+    def __call__(self, clip):
+        im_size = (clip.size(2), clip.size(1))
+        crop_w, crop_h, offset_w, offset_h = self._sample_crop_size(im_size)
+        crop = clip[:, offset_h:offset_h + crop_h, offset_w:offset_w + crop_w, :]
+        return _resize(crop, (self.input_size[0], self.input_size[1]))
+
+    def _crop_table(self, image_w, image_h):
+        table = self._crop_tables.get((image_w, image_h))
+        if table is None:
+            base_size = min(image_w, image_h)
+            crop_sizes = [int(base_size * x) for x in self.scales]
+            crop_h = [self.input_size[1] if abs(x - self.input_size[1]) < 3 else x for x in crop_sizes]
+            crop_w = [self.input_size[0] if abs(x - self.input_size[0]) < 3 else x for x in crop_sizes]
+            pairs = [(w, h) for i, h in enumerate(crop_h) for j, w in enumerate(crop_w)
+                     if abs(i - j) <= self.max_distort]
+            offsets = [self.fill_fix_offset(self.more_fix_crop, image_w, image_h, w, h) for w, h in pairs]
+            table = self._crop_tables[(image_w, image_h)] = (pairs, offsets)
+        return table
+
+    def _sample_crop_size(self, im_size):
+        # same random draws as GroupMultiScaleCrop._sample_crop_size
+        image_w, image_h = im_size[0], im_size[1]
+        pairs, offsets = self._crop_table(image_w, image_h)
+        i = pairs.index(random.choice(pairs))
+        crop_pair = pairs[i]
+        if not self.fix_crop:
+            w_offset = random.randint(0, image_w - crop_pair[0])
+            h_offset = random.randint(0, image_h - crop_pair[1])
+        else:
+            w_offset, h_offset = random.choice(offsets[i])
+        return crop_pair[0], crop_pair[1], w_offset, h_offset
+
+
+class ClipRandomHorizontalFlip(object):
+    def __init__(self, is_flow=False):
+        self.is_flow = is_flow
+
+    def __call__(self, clip):
+        v = random.random()
+        if v < 0.5:
+            clip = clip.flip(2)
+            if self.is_flow:
+                # invert flow_x when flipping
+                clip[0::2] = 255 - clip[0::2]
+        return clip
+
+    def decode_size_hint(self):
+        return 0
+
+
+class ClipScale(object):
+    """Rescale the clip so that its smaller edge is size"""
+    def __init__(self, size):
+        self.size = size
+
+    def __call__(self, clip):
+        h, w = clip.size(1), clip.size(2)
+        if w <= h:
+            size = (self.size, int(self.size * h / w))
+        else:
+            size = (int(self.size * w / h), self.size)
+        return _resize(clip, size)
+
+    def decode_size_hint(self):
+        return self.size
+
+
+class ClipCenterCrop(object):
+    def __init__(self, size):
+        if isinstance(size, numbers.Number):
+            self.size = (int(size), int(size))
+        else:
+            self.size = size
+
+    def __call__(self, clip):
+        h, w = clip.size(1), clip.size(2)
+        th, tw = self.size
+        i = int(round((h - th) / 2.))
+        j = int(round((w - tw) / 2.))
+        return clip[:, i:i + th, j:j + tw, :]
+
+    def decode_size_hint(self):
+        return None
+
+
+class ClipOverSample(object):
+    """GroupOverSample on a clip tensor: the 5 crops are strided views of the
+    scaled clip and the flips reversed-stride views of those, the 10 crops
+    are only copied once into the output clip (N * 10, crop_h, crop_w, C)"""
+    def __init__(self, crop_size, scale_size=None):
+        self.crop_size = crop_size if not isinstance(crop_size, int) else (crop_size, crop_size)
+        self.scale_worker = ClipScale(scale_size) if scale_size is not None else None
+
+    def __call__(self, clip):
+        if self.scale_worker is not None:
+            clip = self.scale_worker(clip)
+        clip = clip.contiguous().numpy()
+
+        n, image_h, image_w, c = clip.shape
+        crop_w, crop_h = self.crop_size
+        offsets = GroupMultiScaleCrop.fill_fix_offset(False, image_w, image_h, crop_w, crop_h)
+
+        out = np.empty((2 * len(offsets) * n, crop_h, crop_w, c), dtype=clip.dtype)
+        for k, (o_w, o_h) in enumerate(offsets):
+            crop = clip[:, o_h:o_h + crop_h, o_w:o_w + crop_w, :]
+            out[2 * k * n:(2 * k + 1) * n] = crop
+            out[(2 * k + 1) * n:(2 * k + 2) * n] = crop[:, :, ::-1, :]
+            if c == 1:
+                # flipped flow_x planes are inverted
+                flipped_x = out[(2 * k + 1) * n:(2 * k + 2) * n:2]
+                np.subtract(255, flipped_x, out=flipped_x)
+        return torch.from_numpy(out)
+
+    def decode_size_hint(self):
+        return None if self.scale_worker is None else self.scale_worker.size
+
+
+class ClipToTorchFormat(object):
+    """(N, H, W, C) uint8 clip -> (N * C, H, W) tensor, as Stack + ToTorchFormatTensor.
+    roll reverses RGB to BGR, div scales to [0, 1], uint8 keeps the bytes
+    (TSN normalizes them)."""
+    def __init__(self, roll=False, div=True, uint8=False):
+        self.roll = roll
+        self.div = div
+        self.uint8 = uint8
+
+    def __call__(self, clip):
+        if self.roll and clip.size(3) == 3:
+            clip = clip.flip(3)
+        n, h, w, c = clip.size()
+        out = clip.permute(0, 3, 1, 2).reshape(n * c, h, w)
+        if self.uint8:
+            return out.contiguous()
+        out = out.float()
+        return out.div_(255) if self.div else out
+
+
+class ClipNormalize(object):
+    def __init__(self, mean, std):
+        self.mean = torch.FloatTensor(mean).view(-1, 1, 1)
+        self.std = torch.FloatTensor(std).view(-1, 1, 1)
+
+    def __call__(self, tensor):
+        c, h, w = tensor.size()
+        view = tensor.view(-1, self.mean.size(0), h, w)
+        view.sub_(self.mean).div_(self.std)
+        return tensor
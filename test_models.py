@@ -6,8 +6,9 @@ import torch.nn.parallel
 import torch.optim
 from sklearn.metrics import confusion_matrix
 from dataset import TSNDataSet
-from models import TSN
+from models import TSN, load_tsn_state
 from transforms import *
+from tensor_transforms import *
 from ops import ConsensusModule
 import datasets_video
 import pdb
@@ -40,6 +41,16 @@ parser.add_argument('--test_reverse', default=False, action='store_true',
                             help='test with frames reversed')
 parser.add_argument('--test_shuffle', default=False, action='store_true', 
                             help='test with frames shuffled')
+parser.add_argument('--flow_format', type=str, default='rgb', choices=['rgb', 'xy'], 
+                            help="flow frames as (x, y, blank) RGB JPEGs or as 'xy' frames")
+parser.add_argument('--decoder', type=str, default='pil', choices=['pil', 'cv2', 'turbojpeg', 'auto'], 
+                            help="JPEG decoder, 'auto' picks the fastest on frames of the list")
+parser.add_argument('--all_relations', default=False, action='store_true', 
+                            help='TRNmultiscale: score all the relations of each scale instead of a random sample')
+parser.add_argument('--max_relations', type=int, default=256, 
+                            help='with --all_relations, relations scored per scale at most (0: no cap)')
+parser.add_argument('--tensor_transforms', default=False, action='store_true', 
+                            help='crop stacked clip tensors instead of lists of PIL images')
 
 args = parser.parse_args()
 
@@ -88,25 +99,54 @@ net = TSN(num_class, args.test_segments if args.crop_fusion_type in ['TRN','TRNm
           base_model=args.arch,
           consensus_type=args.crop_fusion_type,
           img_feature_dim=args.img_feature_dim,
+          all_relations=args.all_relations,
+          max_relations=args.max_relations or None,
           )
 
 checkpoint = torch.load(args.weights)
 print("model epoch {} best prec@1: {}".format(checkpoint['epoch'], checkpoint['best_prec1']))
 
 base_dict = {'.'.join(k.split('.')[1:]): v for k,v in list(checkpoint['state_dict'].items())}
-net.load_state_dict(base_dict)
-
-if args.test_crops == 1:
-    cropping = torchvision.transforms.Compose([
-        GroupScale(net.scale_size),
-        GroupCenterCrop(net.input_size),
-    ])
-elif args.test_crops == 10:
-    cropping = torchvision.transforms.Compose([
-        GroupOverSample(net.input_size, net.scale_size)
+# a head checkpoint of --train_features leaves the pretrained base_model
+load_tsn_state(net, base_dict)
+
+if args.tensor_transforms:
+    # crops are views of one stacked clip, see tensor_transforms.py
+    if args.test_crops == 1:
+        cropping = torchvision.transforms.Compose([
+            ToClipTensor(),
+            ClipScale(net.scale_size),
+            ClipCenterCrop(net.input_size),
+        ])
+    elif args.test_crops == 10:
+        cropping = torchvision.transforms.Compose([
+            ToClipTensor(),
+            ClipOverSample(net.input_size, net.scale_size)
+        ])
+    else:
+        raise ValueError("Only 1 and 10 crops are supported while we got {}".format(args.test_crops))
+    to_tensor = torchvision.transforms.Compose([
+        ClipToTorchFormat(roll=(args.arch in ['BNInception','InceptionV3']),
+                          div=(args.arch not in ['BNInception','InceptionV3'])),
+        ClipNormalize(net.input_mean, net.input_std),
     ])
 else:
-    raise ValueError("Only 1 and 10 crops are supported while we got {}".format(args.test_crops))
+    if args.test_crops == 1:
+        cropping = torchvision.transforms.Compose([
+            GroupScale(net.scale_size),
+            GroupCenterCrop(net.input_size),
+        ])
+    elif args.test_crops == 10:
+        cropping = torchvision.transforms.Compose([
+            GroupOverSample(net.input_size, net.scale_size)
+        ])
+    else:
+        raise ValueError("Only 1 and 10 crops are supported while we got {}".format(args.test_crops))
+    to_tensor = torchvision.transforms.Compose([
+        Stack(roll=(args.arch in ['BNInception','InceptionV3'])),
+        ToTorchFormatTensor(div=(args.arch not in ['BNInception','InceptionV3'])),
+        GroupNormalize(net.input_mean, net.input_std),
+    ])
 
 if args.test_reverse:
     test_temp_transform = ReverseFrames()
@@ -122,11 +162,11 @@ data_loader = torch.utils.data.DataLoader(
                    image_tmpl=prefix,
                    test_mode=True,
                    temp_transform=test_temp_transform, 
+                   flow_format=args.flow_format,
+                   decoder=args.decoder,
                    transform=torchvision.transforms.Compose([
                        cropping,
-                       Stack(roll=(args.arch in ['BNInception','InceptionV3'])),
-                       ToTorchFormatTensor(div=(args.arch not in ['BNInception','InceptionV3'])),
-                       GroupNormalize(net.input_mean, net.input_std),
+                       to_tensor,
                    ])),
         batch_size=1, shuffle=False,
         num_workers=args.workers * 2, pin_memory=True)
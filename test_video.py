@@ -16,6 +16,8 @@ import torch.nn.parallel
 import torch.optim
 from models import TSN
 from transforms import *
+from frame_planner import FramePlanner
+from video_storage import VideoFileReader
 import datasets_video
 from torch.nn import functional as F
 
@@ -49,6 +51,14 @@ def extract_frames(video_file, num_frames=8):
     return frames
 
 
+def decode_frames(video_file, num_frames=8):
+    # the center frame of each of the num_frames segments, decoded straight
+    # from the video file without extracting anything
+    with VideoFileReader(video_file) as reader:
+        offsets = FramePlanner(num_frames, 1).test_offsets([reader.num_frames])[0]
+        return [reader.decode(int(p)).convert('RGB') for p in offsets]
+
+
 def load_frames(frame_paths, num_frames=8):
     frames = [Image.open(frame).convert('RGB') for frame in frame_paths]
     if len(frames) >= num_frames:
@@ -79,6 +89,8 @@ parser.add_argument('--modality', type=str, default='RGB',
                     choices=['RGB', 'Flow', 'RGBDiff'], )
 parser.add_argument('--dataset', type=str, default='moments',
                     choices=['something', 'jester', 'moments'])
+parser.add_argument('--decode_video', default=False, action='store_true',
+                    help='decode the sampled frames of --video_file directly instead of extracting them with ffmpeg')
 parser.add_argument('--rendered_output', type=str, default=None)
 parser.add_argument('--arch', type=str, default="InceptionV3")
 parser.add_argument('--input_size', type=int, default=224)
@@ -126,6 +138,9 @@ if args.frame_folder is not None:
     # here make sure after sorting the frame paths have the correct temporal order
     frame_paths = sorted(glob.glob(os.path.join(args.frame_folder, '*.jpg')))
     frames = load_frames(frame_paths)
+elif args.decode_video:
+    print('Decoding frames of %s' % args.video_file)
+    frames = decode_frames(args.video_file, args.test_segments)
 else:
     print('Extracting frames using ffmpeg...')
     frames = extract_frames(args.video_file, args.test_segments)
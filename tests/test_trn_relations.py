@@ -0,0 +1,60 @@
+import itertools
+from math import comb
+
+import pytest
+import torch
+
+from TRNmodule import RelationModuleMultiScale
+
+NUM_FRAMES = 6
+FEATURE_DIM = 8
+NUM_CLASS = 5
+
+
+def _module(max_relations):
+    torch.manual_seed(0)
+    module = RelationModuleMultiScale(FEATURE_DIM, NUM_FRAMES, NUM_CLASS)
+    module.set_all_relations(max_relations=max_relations)
+    return module.eval()
+
+
+def _brute_force(module, input):
+    # subsample_scales times the mean of fc_fusion over every relation of a scale
+    out = 0
+    for scaleID, scale in enumerate(module.scales):
+        relations = list(itertools.combinations(range(NUM_FRAMES), scale))
+        acts = [module.fc_fusion_scales[scaleID](input[:, list(r), :].reshape(input.size(0), -1))
+                for r in relations]
+        out = out + torch.stack(acts).mean(0) * module.subsample_scales[scaleID]
+    return out
+
+
+@pytest.mark.parametrize('max_relations', [None, 0])
+def test_uncapped_scores_every_relation(max_relations):
+    module = _module(max_relations)
+    assert module.max_relations is None
+    for scaleID, scale in enumerate(module.scales):
+        relations = module.eval_relations(scaleID, torch.device('cpu')).tolist()
+        assert relations == [list(r) for r in itertools.combinations(range(NUM_FRAMES), scale)]
+    input = torch.randn(3, NUM_FRAMES, FEATURE_DIM)
+    with torch.no_grad():
+        assert torch.allclose(module(input), _brute_force(module, input), atol=1e-5)
+
+
+def test_cap_below_relation_count():
+    cap = 4
+    module = _module(cap)
+    for scaleID, scale in enumerate(module.scales):
+        relations = module.eval_relations(scaleID, torch.device('cpu')).tolist()
+        assert len(relations) == min(cap, comb(NUM_FRAMES, scale))
+        assert len(set(map(tuple, relations))) == len(relations)
+        assert all(list(r) == sorted(set(r)) and 0 <= r[0] and r[-1] < NUM_FRAMES for r in relations)
+    with torch.no_grad():
+        out = module(torch.randn(3, NUM_FRAMES, FEATURE_DIM))
+    assert out.shape == (3, NUM_CLASS)
+    assert torch.isfinite(out).all()
+
+
+def test_negative_cap_is_rejected():
+    with pytest.raises(ValueError):
+        _module(-1)
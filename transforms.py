@@ -299,9 +299,11 @@ class Stack(object):
 
 class ToTorchFormatTensor(object):
     """ Converts a PIL.Image (RGB) or numpy.ndarray (H x W x C) in the range [0, 255]
-    to a torch.FloatTensor of shape (C x H x W) in the range [0.0, 1.0] """
-    def __init__(self, div=True):
+    to a torch.FloatTensor of shape (C x H x W) in the range [0.0, 1.0]
+    With uint8=True the tensor stays a torch.ByteTensor, TSN normalizes it """
+    def __init__(self, div=True, uint8=False):
         self.div = div
+        self.uint8 = uint8
 
     def __call__(self, pic):
         if isinstance(pic, np.ndarray):
@@ -314,6 +316,8 @@ class ToTorchFormatTensor(object):
             # put it from HWC to CHW format
             # yikes, this transpose takes 80% of the loading time/CPU
             img = img.transpose(0, 1).transpose(0, 2).contiguous()
+        if self.uint8:
+            return img
         return img.float().div(255) if self.div else img.float()
 
 
@@ -323,6 +327,43 @@ class IdentityTransform(object):
         return data
 
 
+def decode_size_hint(transform):
+    """Smallest image short side the transform needs to see, or None when it
+    needs the full resolution. Used to decode JPEGs at a reduced size."""
+    hint = _decode_size_hint(transform)
+    return hint if hint else None
+
+
+def _decode_size_hint(transform):
+    # 0 when nothing in transform constrains the size
+    for t in getattr(transform, 'transforms', [transform]):
+        if hasattr(t, 'decode_size_hint'):
+            # transforms that know their own requirement (tensor_transforms.py)
+            hint = t.decode_size_hint()
+            if hint != 0:
+                return hint
+        elif isinstance(t, torchvision.transforms.Compose):
+            hint = _decode_size_hint(t)
+            if hint != 0:
+                return hint
+        elif isinstance(t, GroupScale):
+            size = t.worker.size
+            if isinstance(size, (list, tuple)):
+                return None if len(size) != 1 else size[0]
+            return size
+        elif isinstance(t, GroupOverSample):
+            return None if t.scale_worker is None else _decode_size_hint(t.scale_worker)
+        elif isinstance(t, GroupMultiScaleCrop):
+            # the smallest crop must still be at least input_size
+            return int(math.ceil(max(t.input_size) / float(min(t.scales))))
+        elif isinstance(t, (GroupRandomHorizontalFlip, IdentityTransform)):
+            continue
+        else:
+            # crops of the original resolution or unknown geometry
+            return None
+    return 0
+
+
 if __name__ == "__main__":
     trans = torchvision.transforms.Compose([
         GroupScale(256),
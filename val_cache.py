@@ -0,0 +1,113 @@
+# cache of the transformed validation clips
+#
+# The validation pipeline is deterministic (centered frames, GroupScale +
+# GroupCenterCrop, identity temp_transform), so the clips it produces are the
+# same at every --eval-freq. CachedValLoader writes the batches of the first
+# full pass over the val loader into a memory-mapped .npy file, and later
+# validations stream the clips from that file without reading or transforming
+# a frame. The file name is a hash of everything that changes the clips (list
+# file, the videos kept by the preflight scan, segments, crop and scale size,
+# normalization, ...): a run with other settings builds its own file, and a
+# file that does not hold one clip per video of the dataset is rebuilt. main.py
+# only caches with --preflight, without it a missing video is replaced by a
+# random one at every pass.
+#
+# The clips are stored as the loader returns them, uint8 with --uint8_input
+# (normalized in TSN.forward) or float32 otherwise, four times larger.
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import torch
+
+
+def val_cache_key(list_file, **settings):
+    """Hash of the list file (path, size, mtime) and the settings of the clips"""
+    stat = os.stat(list_file)
+    items = dict(settings, list_file=os.path.abspath(list_file), list_size=stat.st_size,
+                 list_mtime=stat.st_mtime)
+    return hashlib.md5(json.dumps(items, sort_keys=True, default=str).encode('utf-8')).hexdigest()[:16]
+
+
+class CachedValLoader(object):
+    def __init__(self, loader, cache_dir, key, batch_size):
+        self.loader = loader
+        self.batch_size = batch_size
+        self.path = os.path.join(cache_dir, 'val_%s.npy' % key)
+        self.labels_path = os.path.join(cache_dir, 'val_%s_labels.npy' % key)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.hits = 0
+        self.builds = 0
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if os.path.exists(self.path) and os.path.exists(self.labels_path):
+            clips = np.load(self.path, mmap_mode='r')
+            labels = np.load(self.labels_path)
+            if len(clips) == len(labels) == len(self.dataset):
+                return self._stream(clips, labels)
+            print('val cache: %s holds %d clips and %d labels for %d videos, rebuilding' % (
+                self.path, len(clips), len(labels), len(self.dataset)))
+            del clips
+            os.remove(self.path)
+            os.remove(self.labels_path)
+        return self._build()
+
+    def _stream(self, clips, labels):
+        start = time.time()
+        for i in range(0, len(clips), self.batch_size):
+            # copied out of the page cache, the tensors do not alias the file
+            yield torch.from_numpy(np.array(clips[i:i + self.batch_size])), \
+                torch.from_numpy(labels[i:i + self.batch_size])
+        self.hits += 1
+        print('val cache: hit %d, %d clips (%.2f GB) streamed from %s in %.1f sec' % (
+            self.hits, len(clips), clips.nbytes / 1024. ** 3, self.path, time.time() - start))
+
+    def _build(self):
+        # written while validating, the file is only renamed into place after
+        # a complete pass; a pass that stops early (an error, an interrupt or
+        # the loop leaving the generator) removes it
+        tmp_path = self.path + '.tmp'
+        num_clips = len(self.dataset)
+        clips = None
+        labels = np.zeros(num_clips, dtype=np.int64)
+        pos = 0
+        saved = False
+        start = time.time()
+        try:
+            for input, target in self.loader:
+                if clips is None:
+                    shape = (num_clips,) + tuple(input.shape[1:])
+                    dtype = input.numpy().dtype
+                    print('val cache: building %s, %d clips of %s %s (%.2f GB)' % (
+                        self.path, num_clips, 'x'.join(map(str, shape[1:])), dtype,
+                        num_clips * np.prod(shape[1:]) * np.dtype(dtype).itemsize / 1024. ** 3))
+                    clips = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=shape)
+                n = input.size(0)
+                clips[pos:pos + n] = input.numpy()
+                labels[pos:pos + n] = target.numpy()
+                pos += n
+                yield input, target
+            if clips is not None and pos == num_clips:
+                clips.flush()
+                clips = None
+                np.save(self.labels_path, labels)
+                os.rename(tmp_path, self.path)
+                saved = True
+        finally:
+            # the memmap is closed before its file is removed
+            clips = None
+            if not saved and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+                print('val cache: %d of %d clips seen, not saved' % (pos, num_clips))
+        if saved:
+            self.builds += 1
+            print('val cache: built %s in %.1f sec' % (self.path, time.time() - start))
@@ -0,0 +1,325 @@
+# reading frames straight out of video files (mp4, webm, ...) for TSNDataSet
+#
+# The rows of the list file name the videos under root_path (video_ext is
+# appended) and num_frames counts their frames, frame i being the i-th frame
+# in display order like img_{i:05d}.jpg of an extracted folder. A reader is
+# opened once per sample and only decodes the frames it is asked for: the
+# dataset asks in ascending order, and the reader either decodes forward from
+# where it is or seeks to the last keyframe at or before the next wanted
+# frame when that skips decoding. Decoded frames are kept until the reader is
+# closed.
+#
+# Where the keyframes are is read once per video and kept in an index file
+# next to it (video + '.<backend>.index.npz', rebuilt when the video changes,
+# kept in memory only when the folder is read only), so opening a video does
+# not scan it. OpenCV is the default backend: its index holds the keyframes
+# of the sync sample table of mp4/mov files; for other containers the
+# keyframes are unknown and far frames are reached through a seek of the
+# backend. backend='av' uses PyAV, whose index holds the timestamp of every
+# frame and the keyframes from one demux pass, and seeks by timestamp. Only
+# RGB based modalities can be read this way.
+import os
+import struct
+import numpy as np
+from PIL import Image
+
+try:
+    import av
+except ImportError:
+    av = None
+
+# cv2 without a keyframe index: decode forward up to this many frames
+# instead of seeking
+CV2_SEEK_GAP = 32
+INDEX_VERSION = 1
+
+
+def return_backend(backend=None):
+    if backend is None:
+        return 'cv2'
+    if backend == 'av' and av is None:
+        raise ImportError('the av backend needs PyAV (pip install av)')
+    if backend not in ('av', 'cv2'):
+        raise ValueError('Unknown video backend ' + backend)
+    return backend
+
+
+def _boxes(f, begin, end):
+    # (type, payload start, end) of the iso media boxes in [begin, end)
+    pos = begin
+    while pos + 8 <= end:
+        f.seek(pos)
+        size, kind = struct.unpack('>I4s', f.read(8))
+        start = pos + 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            start += 8
+        elif size == 0:
+            size = end - pos
+        if size < start - pos:
+            return
+        yield kind, start, pos + size
+        pos += size
+
+
+def _find_box(f, box, kind):
+    if box is None:
+        return None
+    for k, start, end in _boxes(f, box[0], box[1]):
+        if k == kind:
+            return start, end
+    return None
+
+
+def mp4_keyframes(path):
+    """0-based keyframes of the video track of an mp4/mov file, from its sync
+    sample table; None when the file has no sample tables to read"""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, 2)
+            moov = _find_box(f, (0, f.tell()), b'moov')
+            if moov is None:
+                return None
+            for kind, start, end in _boxes(f, moov[0], moov[1]):
+                if kind != b'trak':
+                    continue
+                mdia = _find_box(f, (start, end), b'mdia')
+                hdlr = _find_box(f, mdia, b'hdlr')
+                if hdlr is None:
+                    continue
+                # version/flags and pre_defined come before the handler type
+                f.seek(hdlr[0] + 8)
+                if f.read(4) != b'vide':
+                    continue
+                stbl = _find_box(f, _find_box(f, mdia, b'minf'), b'stbl')
+                stsz = _find_box(f, stbl, b'stsz')
+                if stsz is None:
+                    return None
+                f.seek(stsz[0] + 8)
+                num_samples = struct.unpack('>I', f.read(4))[0]
+                if num_samples == 0:
+                    # fragmented file, the samples are in the fragments
+                    return None
+                stss = _find_box(f, stbl, b'stss')
+                if stss is None:
+                    # no table: every sample is a sync sample
+                    return np.arange(num_samples, dtype=np.int64)
+                f.seek(stss[0] + 4)
+                count = struct.unpack('>I', f.read(4))[0]
+                return np.frombuffer(f.read(4 * count), dtype='>u4').astype(np.int64) - 1
+    except (IOError, OSError, struct.error):
+        return None
+    return None
+
+
+def _build_av_index(path):
+    # one demux pass, without decoding, for the timestamps and keyframes
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        pts, keyframe = [], []
+        for packet in container.demux(stream):
+            if packet.pts is None:
+                continue
+            pts.append(packet.pts)
+            keyframe.append(packet.is_keyframe)
+    order = np.argsort(pts)
+    return (np.asarray(pts, dtype=np.int64)[order],
+            np.nonzero(np.asarray(keyframe, dtype=bool)[order])[0])
+
+
+def _build_cv2_index(path):
+    # no timestamps needed, an empty keyframe array means unknown keyframes
+    keyframes = mp4_keyframes(path)
+    if keyframes is None:
+        keyframes = np.zeros(0, dtype=np.int64)
+    return np.zeros(0, dtype=np.int64), keyframes
+
+
+def load_index(path, backend):
+    """(pts, keyframes) of the video at path for the backend, read from its
+    index file or built and saved there when missing or stale"""
+    stat = os.stat(path)
+    index_file = '%s.%s.index.npz' % (path, backend)
+    try:
+        with np.load(index_file) as index:
+            if (int(index['version']) == INDEX_VERSION and float(index['mtime']) == stat.st_mtime
+                    and int(index['size']) == stat.st_size):
+                return index['pts'], index['keyframes']
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    build = _build_av_index if backend == 'av' else _build_cv2_index
+    pts, keyframes = build(path)
+    tmp = '%s.tmp%d.npz' % (index_file, os.getpid())
+    try:
+        np.savez(tmp, version=INDEX_VERSION, mtime=stat.st_mtime, size=stat.st_size,
+                 pts=pts, keyframes=keyframes)
+        os.rename(tmp, index_file)
+    except (IOError, OSError):
+        # read only folder, the store keeps the index in memory
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return pts, keyframes
+
+
+def _seek_target(keyframes, t, pos):
+    """Keyframe to seek to before decoding frame t with pos the last decoded
+    frame (None when nothing is), None to decode forward from pos"""
+    k = keyframes[max(np.searchsorted(keyframes, t, side='right') - 1, 0)]
+    if pos is None or t <= pos or k > pos + 1:
+        return int(k)
+    return None
+
+
+class _AVVideo(object):
+    def __init__(self, path, index):
+        self.container = av.open(path)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = 'AUTO'
+        self.pts, self.keyframes = index
+        self.num_frames = len(self.pts)
+        self._frames = None
+        self._pos = -1
+
+    def frame(self, t):
+        """Frame t (0-based, display order) as an RGB image"""
+        if t >= self.num_frames:
+            raise IndexError('frame %d out of range' % (t + 1))
+        k = _seek_target(self.keyframes, t, None if self._frames is None else self._pos)
+        if k is not None:
+            # lands on the keyframe at or before the timestamp of frame k
+            self.container.seek(int(self.pts[k]), stream=self.stream, backward=True, any_frame=False)
+            self._frames = self.container.decode(self.stream)
+        target = self.pts[t]
+        for frame in self._frames:
+            if frame.pts is None or frame.pts < target:
+                continue
+            self._pos = int(np.searchsorted(self.pts, frame.pts))
+            return frame.to_image()
+        self._frames = None
+        raise IOError('could not decode frame %d' % (t + 1))
+
+    def close(self):
+        self.container.close()
+
+
+class _CV2Video(object):
+    def __init__(self, path, index):
+        import cv2
+        self.cv2 = cv2
+        self.cap = cv2.VideoCapture(path)
+        if not self.cap.isOpened():
+            raise IOError('could not open video %s' % path)
+        self.num_frames = int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.keyframes = index[1]
+        self._pos = -1
+
+    def frame(self, t):
+        if len(self.keyframes):
+            k = _seek_target(self.keyframes, t, self._pos)
+        elif t <= self._pos or t - self._pos > CV2_SEEK_GAP:
+            # the backend seeks to the preceding keyframe and decodes up to t
+            k = t
+        else:
+            k = None
+        if k is not None:
+            self.cap.set(self.cv2.CAP_PROP_POS_FRAMES, k)
+            self._pos = k - 1
+        while self._pos < t - 1:
+            # grab() skips the color conversion of the frames in between
+            self.cap.grab()
+            self._pos += 1
+        ok, img = self.cap.read()
+        if not ok:
+            raise IOError('could not decode frame %d' % (t + 1))
+        self._pos = t
+        return Image.fromarray(self.cv2.cvtColor(img, self.cv2.COLOR_BGR2RGB))
+
+    def close(self):
+        self.cap.release()
+
+
+class VideoFileStore(object):
+    """Frames decoded out of root_path/directory + video_ext"""
+    rgb_only = True
+
+    def __init__(self, root_path, video_ext='', backend=None):
+        self.root_path = root_path
+        self.video_ext = video_ext
+        self.backend = return_backend(backend)
+        # path -> (mtime, size, index), see load_index
+        self._indexes = {}
+
+    def video_path(self, directory):
+        return os.path.join(self.root_path, directory + self.video_ext)
+
+    def exists(self, directory):
+        return os.path.exists(self.video_path(directory))
+
+    def index(self, path):
+        stat = os.stat(path)
+        cached = self._indexes.get(path)
+        if cached is None or cached[:2] != (stat.st_mtime, stat.st_size):
+            cached = self._indexes[path] = (stat.st_mtime, stat.st_size,
+                                            load_index(path, self.backend))
+        return cached[2]
+
+    def open(self, directory):
+        path = self.video_path(directory)
+        return VideoFileReader(path, self.backend, self.index(path))
+
+    def describe(self):
+        return 'video:%s:%s' % (self.root_path, self.video_ext)
+
+    def signature(self, directory, files=False):
+        try:
+            return os.stat(self.video_path(directory)).st_mtime
+        except OSError:
+            return -1.
+
+    def list_frames(self, directory, num_frames):
+        try:
+            reader = self.open(directory)
+        except (IOError, OSError):
+            return []
+        with reader:
+            return list(range(1, min(num_frames, reader.num_frames) + 1))
+
+    def frame_sizes(self, directory, num_frames):
+        # nothing to preload, the frames only exist decoded
+        return np.zeros(num_frames, dtype=np.int64)
+
+
+class VideoFileReader(object):
+    def __init__(self, path, backend=None, index=None):
+        self.path = path
+        backend = return_backend(backend)
+        if index is None:
+            index = load_index(path, backend)
+        self._video = (_AVVideo if backend == 'av' else _CV2Video)(path, index)
+        self.num_frames = self._video.num_frames
+        self._decoded = {}
+
+    def decode(self, idx):
+        # frame indices are 1-based like image_tmpl
+        img = self._decoded.get(idx)
+        if img is None:
+            if idx < 1:
+                raise IndexError('frame %d out of range in %s' % (idx, self.path))
+            img = self._decoded[idx] = self._video.frame(idx - 1)
+        return img
+
+    def read(self, idx):
+        raise IOError('frames of %s are decoded, not read' % self.path)
+
+    def name(self, idx):
+        return '%s[%d]' % (self.path, idx)
+
+    def close(self):
+        self._decoded = {}
+        self._video.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()